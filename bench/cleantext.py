@@ -0,0 +1,139 @@
+"""
+Check that clean_text gives exactly what it did when it ran every
+title and description through bleach, and time the two against each
+other.
+
+The corpus is a set of awkward fragments, random junk made of HTML
+syntax, and the titles and descriptions of any feeds given (files or
+URLs):
+
+    $ python bench/cleantext.py http://www.niemanlab.org/feed/ saved/*.xml
+
+Exits with status 1 if anything comes out different.
+"""
+import os
+import sys
+import time
+import random
+import bleach
+import argparse
+import feedparser
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from riverpy.parse import clean_text
+from riverpy.sanitize import strip_tags
+
+FRAGMENTS = [
+    u'',
+    u'Plain title',
+    u'  padded \n ',
+    u'<p>A <b>bold</b> <a href="http://example.com/?a=1&b=2">link</a>.</p>',
+    u'<img src="x.png" alt="a > b"/>After the image',
+    u'<script>if (a < b && c) alert("x")</script>after',
+    u'<style>p > a { color: red }</style>text',
+    u'<pre>\nfirst line</pre>',
+    u'<table>before<tr><td>cell</td></tr></table>after',
+    u'<title>a <b>b</b></title>',
+    u'<!-- comment --> <!--> <!---> <!----> <!-- a --!> b',
+    u'<!DOCTYPE html PUBLIC "-//W3C//DTD>x">text',
+    u'<![CDATA[ cdata ]]>text',
+    u'<?xml version="1.0"?>text',
+    u'a < b > c & d',
+    u'<>empty</>tags</ >bogus</3>',
+    u'&amp; &amp &lt; &gt; &quot; &apos; &nbsp; &copy &notit; &notin; &bogus;',
+    u'&#65; &#x41; &#X41 &#0; &#128; &#150; &#xD800; &#x110000; &#x1F600; &#; &#x;',
+    u'line\r\nbreaks\rand\nmore',
+    u'nul\x00chars',
+    u'\ufeffbyte order mark',
+    u'caf\xe9 \u2014 \u201cquoted\u201d \U0001F600',
+    u'<a href="unterminated>text',
+    u"<a b='c'd e=f g>text",
+    u'<a =x>y<a b="c"/>z',
+    u'<p>' + u'word ' * 200 + u'</p>',
+    u'<div>' + u'<span>x</span>&amp;' * 100 + u'</div>',
+    u' ' * 300 + u'late start',
+    u'x' * 280,
+    u'x' * 281,
+    u'x' * 280 + u'   ',
+    u'x' * 279 + u'&amp;y',
+]
+
+JUNK = list(u'<>/!-?=\'"&#;xX019aZ \n\r\t\x00\xe9') + [
+    u'amp', u'lt', u'nbsp', u'not', u'notin', u'<!--', u'-->', u'<a ', u'</',
+    u'<br/>', u'&#x', u'DOCTYPE', u'<script>', u'<p>', u'\ud800',
+]
+
+def junk(rnd, count, size):
+    for n in xrange(count):
+        yield u''.join(rnd.choice(JUNK) for _ in xrange(rnd.randint(1, size)))
+
+def feed_texts(source):
+    parsed = feedparser.parse(source)
+    for entry in parsed.entries:
+        for key in ['title', 'description']:
+            if entry.get(key):
+                yield entry[key]
+        for content in entry.get('content', []):
+            yield content.value
+
+def bleach_clean_text(text, limit=280, suffix='&nbsp;...'):
+    """
+    clean_text as it was.
+    """
+    cleaned = bleach.clean(text, tags=[], strip=True).strip()
+    if len(cleaned) > limit:
+        return ''.join(cleaned[:limit]) + suffix
+    else:
+        return cleaned
+
+def check(corpus):
+    mismatches = 0
+    for text in corpus:
+        expected = bleach.clean(text, tags=[], strip=True)
+        results = [
+            ('strip_tags', expected, strip_tags(text)),
+            ('clean_text', bleach_clean_text(text), clean_text(text)),
+        ]
+        for (name, expected, got) in results:
+            if expected != got:
+                mismatches += 1
+                print '%s(%r)\n  bleach: %r\n  got:    %r' % (name, text[:200], expected[:200], got[:200])
+    return mismatches
+
+def timeit(func, corpus, repeat):
+    start = time.time()
+    for n in xrange(repeat):
+        for text in corpus:
+            func(text)
+    return time.time() - start
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('feeds', nargs='*', help='Feed files or URLs to take titles and descriptions from.')
+    parser.add_argument('--junk', default=20000, type=int, help='Random fragments to check. [default: %(default)s]')
+    parser.add_argument('--junk-size', default=40, type=int, help='Max pieces per random fragment. [default: %(default)s]')
+    parser.add_argument('--repeat', default=5, type=int, help='Times to clean the feed texts when timing. [default: %(default)s]')
+    parser.add_argument('--seed', default=0, type=int, help='Random seed. [default: %(default)s]')
+    args = parser.parse_args()
+
+    texts = []
+    for source in args.feeds:
+        texts.extend(feed_texts(source))
+    corpus = FRAGMENTS + texts + list(junk(random.Random(args.seed), args.junk, args.junk_size))
+
+    mismatches = check(corpus)
+    print 'Checked %d texts (%d from feeds): %d mismatches' % (len(corpus), len(texts), mismatches)
+
+    timed = texts or FRAGMENTS
+    before = timeit(bleach_clean_text, timed, args.repeat)
+    after = timeit(clean_text, timed, args.repeat)
+    count = len(timed) * args.repeat
+    print 'bleach     %8.1fus/text' % (1e6 * before / count)
+    print 'strip_tags %8.1fus/text (%.1fx faster)' % (1e6 * after / count, before / (after or 1e-9))
+
+    if mismatches:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""
+Run several `river --distributed' workers against one redis DB and a
+local feed farm, and report how many checks each made.
+
+    $ python bench/cluster.py --nodes 1 2 4 --feeds 2000 --duration 120
+
+The redis DB given by --redis-db is flushed before every run.
+"""
+import os
+import sys
+import time
+import redis
+import signal
+import argparse
+import tempfile
+import subprocess
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from riverpy.updates import check_redis_version
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, '..')
+
+RIVER = 'import sys, riverpy; sys.argv[0] = "river"; riverpy.main()'
+
+def start_farm(args, subscription_list):
+    return subprocess.Popen([
+        sys.executable, os.path.join(HERE, 'feedfarm.py'),
+        '--feeds', str(args.feeds),
+        '--port', str(args.port),
+        '--churn', str(args.churn),
+        '--slow', str(args.slow),
+        '--stall', str(args.stall),
+        '--list', subscription_list,
+    ])
+
+def start_node(args, n, subscription_list, log):
+    return subprocess.Popen([
+        sys.executable, '-c', RIVER,
+        '--distributed',
+        '--node-id', 'node-%d' % n,
+        '--engine', args.engine,
+        # Every feed is on the one farm host, so the per-host limits
+        # would be all that's measured.
+        '--host-rate', '0',
+        '--host-concurrency', '0',
+        '--redis-host', args.redis_host,
+        '--redis-port', str(args.redis_port),
+        '--redis-db', str(args.redis_db),
+        subscription_list,
+    ], cwd=ROOT, stdout=log, stderr=subprocess.STDOUT)
+
+def count_checks(log_names):
+    checks = Counter()
+    lost = 0
+    per_node = []
+    for name in log_names:
+        node_checks = 0
+        with open(name) as fp:
+            for line in fp:
+                if ' - riverpy.download - Checked ' in line:
+                    checks[line.split(' - Checked ', 1)[1].rsplit(' (', 1)[0]] += 1
+                    node_checks += 1
+                elif 'Lost the lease' in line:
+                    lost += 1
+        per_node.append(node_checks)
+    return (checks, per_node, lost)
+
+def run(args, nodes, subscription_list):
+    redis_client = redis.Redis(host=args.redis_host, port=args.redis_port, db=args.redis_db)
+    check_redis_version(redis_client)
+    redis_client.flushdb()
+
+    logs = [tempfile.NamedTemporaryFile(prefix='river-node-%d-' % n, suffix='.log', delete=False)
+            for n in xrange(nodes)]
+    procs = [start_node(args, n, subscription_list, log) for (n, log) in enumerate(logs)]
+    try:
+        time.sleep(args.duration)
+    finally:
+        for proc in procs:
+            proc.send_signal(signal.SIGINT)
+        for proc in procs:
+            proc.wait()
+        for log in logs:
+            log.close()
+
+    (checks, per_node, lost) = count_checks([log.name for log in logs])
+    total = sum(per_node)
+    print '%d node(s): %6.1f checks/sec, %d unique feeds, per node %s, %d dropped after losing a lease' % (
+        nodes, total / float(args.duration), len(checks), per_node, lost)
+
+    for log in logs:
+        os.unlink(log.name)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nodes', default=[1, 2, 4], type=int, nargs='+', help='Worker counts to try. [default: %(default)s]')
+    parser.add_argument('--feeds', default=2000, type=int, help='Feeds in the farm. [default: %(default)s]')
+    parser.add_argument('--duration', default=120, type=int, help='Seconds to run each worker count. [default: %(default)s]')
+    parser.add_argument('--engine', default='threads', help='Engine each worker uses. [default: %(default)s]')
+    parser.add_argument('--churn', default=60, type=int, help='Seconds between new items in each feed. [default: %(default)s]')
+    parser.add_argument('--slow', default=0.2, type=float, help='Fraction of slow feeds. [default: %(default)s]')
+    parser.add_argument('--stall', default=0.0, type=float, help='Fraction of feeds that never answer. [default: %(default)s]')
+    parser.add_argument('--port', default=8111, type=int, help='Port for the feed farm. [default: %(default)s]')
+    parser.add_argument('--redis-host', default='127.0.0.1')
+    parser.add_argument('--redis-port', default=6379, type=int)
+    parser.add_argument('--redis-db', default=9, type=int)
+    args = parser.parse_args()
+
+    subscription_list = tempfile.mktemp(suffix='.txt')
+    farm = start_farm(args, subscription_list)
+    try:
+        time.sleep(1)
+        for nodes in args.nodes:
+            run(args, nodes, subscription_list)
+    finally:
+        farm.terminate()
+        farm.wait()
+        if os.path.exists(subscription_list):
+            os.unlink(subscription_list)
+
+if __name__ == '__main__':
+    main()
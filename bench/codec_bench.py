@@ -0,0 +1,64 @@
+"""
+Compare the size and encode/decode speed of each river update codec.
+
+    $ python bench/codec_bench.py --updates 2000 --items 5
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from riverpy.codec import CODECS, get_codec
+
+def river_update(n, items):
+    return {
+        'feedDescription': u'Synthetic feed number %d with some unicode: caf\xe9' % n,
+        'feedTitle': u'Feed %d' % n,
+        'feedUrl': u'http://127.0.0.1:8111/feeds/%d.xml' % n,
+        'item': [{
+            'id': unicode(n * items + i),
+            'pubDate': u'Sun, 18 Oct 2026 14:54:27 +0000',
+            'title': u'Item %d from feed %d' % (i, n),
+            'body': u'Lorem ipsum dolor sit amet, consectetur adipiscing elit. ' * 4,
+            'link': u'http://example.com/%d/%d' % (n, i),
+        } for i in xrange(items)],
+        'websiteUrl': u'http://example.com/%d' % n,
+        'whenLastUpdate': u'Sun, 18 Oct 2026 14:54:27 +0000',
+    }
+
+def timed(func, objs, repeat):
+    start = time.time()
+    for _ in xrange(repeat):
+        for obj in objs:
+            func(obj)
+    return (len(objs) * repeat) / (time.time() - start)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--updates', default=2000, type=int, help='Number of river updates. [default: %(default)s]')
+    parser.add_argument('--items', default=5, type=int, help='Items per update. [default: %(default)s]')
+    parser.add_argument('--repeat', default=5, type=int, help='Passes over the updates. [default: %(default)s]')
+    args = parser.parse_args()
+
+    updates = [river_update(n, args.items) for n in xrange(args.updates)]
+
+    print '%-8s %10s %12s %12s %12s' % ('codec', 'avg bytes', 'encode/s', 'decode/s', 'to_json/s')
+    for name in sorted(CODECS):
+        try:
+            codec = get_codec(name)
+        except SystemExit as ex:
+            print '%-8s skipped (%s)' % (name, ex)
+            continue
+        encoded = [codec.dumps(update) for update in updates]
+        print '%-8s %10d %12d %12d %12d' % (
+            name,
+            sum(len(data) for data in encoded) / len(encoded),
+            timed(codec.dumps, updates, args.repeat),
+            timed(codec.loads, encoded, args.repeat),
+            timed(codec.to_json, encoded, args.repeat),
+        )
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,269 @@
+"""
+Run `river' and `river-writer' against a local feed farm and report
+throughput, how long new items take to reach river.js, redis commands
+per feed check and peak memory.
+
+    $ python bench/endtoend.py --feeds 100 1000 10000 --duration 300
+
+Every item the farm serves has a known publication time, so the delay
+of an item is when the firehose river.js it first shows up in was
+written, minus when it was published. Items that were already in a
+feed when the run started are left out.
+
+The redis DB given by --redis-db is flushed before every run. Pass
+extra options to `river' with --river-args, e.g. to compare engines:
+
+    $ python bench/endtoend.py --river-args '--engine gevent -c 500'
+
+Every feed is served from the one farm host, so `river' runs without
+per-host limits unless --river-args sets --host-rate or
+--host-concurrency.
+
+With --storage sqlite, `river --sqlite' keeps its state in a fresh
+database and writes the rivers itself, so there's no river-writer and
+no redis commands to count. Give both to compare them:
+
+    $ python bench/endtoend.py --feeds 1000 10000 --storage redis sqlite
+"""
+import os
+import re
+import sys
+import json
+import time
+import redis
+import shutil
+import signal
+import urllib2
+import argparse
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from riverpy.updates import check_redis_version
+from feedfarm import published_at
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, '..')
+
+RIVER = 'import sys, riverpy; sys.argv[0] = "river"; riverpy.main()'
+RIVER_WRITER = 'import sys, riverpy; sys.argv[0] = "river-writer"; riverpy.river_writer()'
+
+ITEM_TITLE = re.compile(r'^Item (\d+) from feed (\d+)$')
+
+def start_farm(args, feeds, subscription_list):
+    return subprocess.Popen([
+        sys.executable, os.path.join(HERE, 'feedfarm.py'),
+        '--feeds', str(feeds),
+        '--rivers', str(args.rivers),
+        '--port', str(args.port),
+        '--entries', str(args.entries),
+        '--body-size', str(args.body_size),
+        '--churn', str(args.churn),
+        '--slow', str(args.slow),
+        '--delay', str(args.delay),
+        '--stall', str(args.stall),
+        '--etag', args.etag,
+        '--list', subscription_list,
+    ])
+
+def redis_args(args):
+    return [
+        '--redis-host', args.redis_host,
+        '--redis-port', str(args.redis_port),
+        '--redis-db', str(args.redis_db),
+    ]
+
+def start_river(args, subscription_list, log, sqlite=None, output=None):
+    if sqlite is not None:
+        storage_args = ['--sqlite', sqlite, '--json', '--output', output] + args.writer_args.split()
+    else:
+        storage_args = redis_args(args)
+    return subprocess.Popen([
+        sys.executable, '-c', RIVER,
+        '--metrics-port', str(args.metrics_port),
+        '--entries', '1000',
+        # The farm is one host, so its limits would cap every run at
+        # about a feed a second. --river-args can put them back.
+        '--host-rate', '0',
+        '--host-concurrency', '0',
+    ] + args.river_args.split() + storage_args + [subscription_list],
+        cwd=ROOT, stdout=log, stderr=subprocess.STDOUT)
+
+def start_writer(args, output, log):
+    return subprocess.Popen([
+        sys.executable, '-c', RIVER_WRITER,
+        '--json',
+        '--output', output,
+        '--metrics-port', str(args.metrics_port + 1),
+    ] + args.writer_args.split() + redis_args(args), cwd=ROOT, stdout=log, stderr=subprocess.STDOUT)
+
+def scrape(port):
+    """
+    Return the metrics a process serves as a dict.
+    """
+    metrics = {}
+    try:
+        body = urllib2.urlopen('http://127.0.0.1:%d/metrics' % port, timeout=10).read()
+    except (urllib2.URLError, IOError):
+        return metrics
+    for line in body.splitlines():
+        (name, value) = line.rsplit(' ', 1)
+        metrics[name] = float(value)
+    return metrics
+
+def peak_rss(pid):
+    """
+    Return the peak resident set size of `pid' in MB (Linux only).
+    """
+    try:
+        with open('/proc/%d/status' % pid) as fp:
+            for line in fp:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except IOError:
+        pass
+    return 0
+
+def percentile(values, pct):
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+class DelayWatcher(object):
+    """
+    Notices each item the first time it's written to river.js.
+    """
+    def __init__(self, fname, churn, since):
+        self.fname = fname
+        self.churn = churn
+        self.since = since
+        self.mtime = None
+        self.seen = set()
+        self.delays = []
+
+    def poll(self):
+        try:
+            mtime = os.stat(self.fname).st_mtime
+            if mtime == self.mtime:
+                return
+            with open(self.fname) as fp:
+                river = json.load(fp)
+        except (OSError, IOError, ValueError):
+            # Not written yet.
+            return
+        self.mtime = mtime
+
+        for update in river['updatedFeeds']['updatedFeed']:
+            for item in update['item']:
+                match = ITEM_TITLE.match(item.get('title', ''))
+                if match is None or match.groups() in self.seen:
+                    continue
+                self.seen.add(match.groups())
+                published = published_at(int(match.group(2)), int(match.group(1)), self.churn)
+                if published >= self.since:
+                    self.delays.append(mtime - published)
+
+def run(args, feeds, storage):
+    redis_client = redis.Redis(host=args.redis_host, port=args.redis_port, db=args.redis_db)
+    if storage == 'redis':
+        check_redis_version(redis_client)
+    redis_client.flushdb()
+
+    scratch = tempfile.mkdtemp(prefix='riverpy-bench-')
+    subscription_list = os.path.join(scratch, 'feeds.txt')
+    output = os.path.join(scratch, 'output')
+    river_log = open(os.path.join(scratch, 'river.log'), 'w')
+    writer_log = open(os.path.join(scratch, 'river-writer.log'), 'w')
+
+    farm = start_farm(args, feeds, subscription_list)
+    procs = []
+    try:
+        while not os.path.exists(subscription_list):
+            time.sleep(0.1)
+        time.sleep(1)
+
+        if storage == 'sqlite':
+            start = time.time()
+            procs.append(start_river(args, subscription_list, river_log,
+                                     os.path.join(scratch, 'river.db'), output))
+        else:
+            procs.append(start_writer(args, output, writer_log))
+            time.sleep(1)
+            commands_before = redis_client.info()['total_commands_processed']
+            start = time.time()
+            procs.append(start_river(args, subscription_list, river_log))
+
+        watcher = DelayWatcher(os.path.join(output, 'rivers', 'firehose.js'), args.churn, start)
+        while time.time() - start < args.duration:
+            watcher.poll()
+            time.sleep(0.2)
+        elapsed = time.time() - start
+
+        if storage == 'sqlite':
+            commands = None
+        else:
+            commands = redis_client.info()['total_commands_processed'] - commands_before
+        metrics = scrape(args.metrics_port)
+        rss = [peak_rss(proc.pid) for proc in procs]
+    finally:
+        for proc in procs:
+            proc.send_signal(signal.SIGINT)
+        for proc in procs:
+            proc.wait()
+        farm.terminate()
+        farm.wait()
+        river_log.close()
+        writer_log.close()
+
+    checks = metrics.get('riverpy_stage_seconds_count{stage="check"}', 0)
+    items = metrics.get('riverpy_entries_total', 0)
+    delays = sorted(watcher.delays)
+    print '%6d feeds %-6s: %7.1f feeds/sec %8.1f items/sec  delay p50 %6.1fs p99 %6.1fs (%d items)  %5s redis commands/feed  peak RSS river %.0fMB writer %.0fMB' % (
+        feeds,
+        storage,
+        checks / elapsed,
+        items / elapsed,
+        percentile(delays, 50),
+        percentile(delays, 99),
+        len(delays),
+        '-' if commands is None else '%.1f' % (commands / (checks or 1)),
+        rss[-1],
+        rss[0] if len(rss) > 1 else 0,
+    )
+
+    if args.keep:
+        print '        logs and output kept in %s' % scratch
+    else:
+        shutil.rmtree(scratch)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--feeds', default=[100, 1000, 10000], type=int, nargs='+', help='Farm sizes to try. [default: %(default)s]')
+    parser.add_argument('--duration', default=300, type=int, help='Seconds to run each size. [default: %(default)s]')
+    parser.add_argument('--storage', default=['redis'], choices=['redis', 'sqlite'], nargs='+', help='Where river keeps its state. [default: %(default)s]')
+    parser.add_argument('--river-args', default='', help='Extra options for river.')
+    parser.add_argument('--writer-args', default='', help='Extra options for river-writer.')
+    parser.add_argument('--rivers', default=10, type=int, help='Rivers in the subscription list. [default: %(default)s]')
+    parser.add_argument('--entries', default=20, type=int, help='Items per feed. [default: %(default)s]')
+    parser.add_argument('--body-size', default=500, type=int, help='Bytes of description per item. [default: %(default)s]')
+    parser.add_argument('--churn', default=300, type=int, help='Seconds between new items in each feed. [default: %(default)s]')
+    parser.add_argument('--slow', default=0.0, type=float, help='Fraction of slow feeds. [default: %(default)s]')
+    parser.add_argument('--delay', default=10.0, type=float, help='Max seconds a slow feed waits. [default: %(default)s]')
+    parser.add_argument('--stall', default=0.0, type=float, help='Fraction of feeds that never answer. [default: %(default)s]')
+    parser.add_argument('--etag', default='yes', choices=['yes', 'none', 'changing'], help='ETag behaviour of the farm. [default: %(default)s]')
+    parser.add_argument('--port', default=8111, type=int, help='Port for the feed farm. [default: %(default)s]')
+    parser.add_argument('--metrics-port', default=9111, type=int, help='Port for river\'s metrics; river-writer uses the next one. [default: %(default)s]')
+    parser.add_argument('--keep', action='store_true', help='Keep the logs and output of each run.')
+    parser.add_argument('--redis-host', default='127.0.0.1')
+    parser.add_argument('--redis-port', default=6379, type=int)
+    parser.add_argument('--redis-db', default=9, type=int)
+    args = parser.parse_args()
+
+    for feeds in args.feeds:
+        for storage in args.storage:
+            run(args, feeds, storage)
+
+if __name__ == '__main__':
+    main()
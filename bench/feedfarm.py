@@ -0,0 +1,152 @@
+"""
+Serve thousands of synthetic RSS feeds from one local HTTP server.
+
+Point `river` at the subscription list this writes to exercise the
+download path without touching the network:
+
+    $ python bench/feedfarm.py -n 5000 --stall 0.05 --list /tmp/farm.txt
+    $ river --engine gevent --redis-db 9 /tmp/farm.txt
+
+With --hub, every feed names that WebSub hub (see stubhub.py).
+"""
+import time
+import random
+import hashlib
+import argparse
+import BaseHTTPServer
+import SocketServer
+from email.utils import formatdate
+
+ITEM = '''<item><title>Item %(n)d from feed %(feed)d</title>
+<link>http://example.com/%(feed)d/%(n)d</link>
+<guid>http://example.com/%(feed)d/%(n)d</guid>%(date)s
+<description>%(body)s</description></item>'''
+
+FEED = '''<?xml version="1.0" encoding="utf-8"?>
+<rss version="2.0" xmlns:atom="http://www.w3.org/2005/Atom"><channel><title>Feed %(feed)d</title>
+<link>http://example.com/%(feed)d</link>%(links)s
+<description>Synthetic feed %(feed)d</description>
+%(items)s
+</channel></rss>'''
+
+def feed_phase(feed, churn):
+    """
+    How many seconds ahead of the clock `feed' runs, so that the feeds
+    don't all change at the same moment.
+    """
+    return (feed * 0.618033988749895) % 1 * churn
+
+def feed_generation(feed, churn, now=None):
+    if not churn:
+        return 0
+    return int(((now or time.time()) + feed_phase(feed, churn)) / churn)
+
+def published_at(feed, n, churn):
+    """
+    When item `n' first appeared in `feed'.
+    """
+    return n * churn - feed_phase(feed, churn)
+
+HUB_LINKS = '''
+<atom:link rel="hub" href="%(hub)s"/>
+<atom:link rel="self" href="%(topic)s"/>'''
+
+def render_feed(feed, generation, entries, body_size, churn=0, hub=None, topic=None):
+    """
+    Return the feed body as of `generation'. Each generation adds one
+    new item to the top. Items get a pubDate if `churn' is given.
+    """
+    items = []
+    for n in xrange(generation, generation - entries, -1):
+        date = ''
+        if churn:
+            date = '\n<pubDate>%s</pubDate>' % formatdate(published_at(feed, n, churn), usegmt=True)
+        items.append(ITEM % {'n': n, 'feed': feed, 'date': date, 'body': 'x' * body_size})
+    links = HUB_LINKS % {'hub': hub, 'topic': topic} if hub else ''
+    return FEED % {'feed': feed, 'items': '\n'.join(items), 'links': links}
+
+class FeedFarm(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+class FeedHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        farm = self.server.farm_args
+        try:
+            feed = int(self.path.strip('/').split('/')[-1].split('.')[0])
+        except ValueError:
+            self.send_error(404)
+            return
+
+        rnd = random.Random(feed)
+        if rnd.random() < farm.stall:
+            # Accept the request, then never answer.
+            time.sleep(60 * 60)
+            return
+        if rnd.random() < farm.slow:
+            time.sleep(rnd.uniform(0, farm.delay))
+
+        generation = feed_generation(feed, farm.churn)
+        topic = 'http://%s:%d%s' % (farm.host, farm.port, self.path)
+        body = render_feed(feed, generation, farm.entries, farm.body_size, farm.churn, farm.hub, topic)
+        if farm.etag == 'changing':
+            # Like servers that put a timestamp or the backend's name
+            # in their ETags.
+            etag = '"%s"' % hashlib.sha1('%s%r' % (body, time.time())).hexdigest()
+        else:
+            etag = '"%s"' % hashlib.sha1(body).hexdigest()
+
+        if farm.etag == 'yes' and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/rss+xml')
+        self.send_header('Content-Length', str(len(body)))
+        if farm.etag != 'none':
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+def write_subscription_list(fname, host, port, feeds, rivers):
+    with open(fname, 'w') as fp:
+        for river in xrange(rivers):
+            fp.write('River %d:\n' % river)
+            for feed in xrange(river, feeds, rivers):
+                fp.write('  - http://%s:%d/feeds/%d.xml\n' % (host, port, feed))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--feeds', default=1000, type=int, help='Number of feeds to serve. [default: %(default)s]')
+    parser.add_argument('-r', '--rivers', default=10, type=int, help='Number of rivers in the subscription list. [default: %(default)s]')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on. [default: %(default)s]')
+    parser.add_argument('--port', default=8111, type=int, help='Port to listen on. [default: %(default)s]')
+    parser.add_argument('--entries', default=20, type=int, help='Items per feed. [default: %(default)s]')
+    parser.add_argument('--body-size', default=500, type=int, help='Bytes of description per item. [default: %(default)s]')
+    parser.add_argument('--churn', default=300, type=int, help='Seconds between new items (0 never changes). [default: %(default)s]')
+    parser.add_argument('--slow', default=0.2, type=float, help='Fraction of feeds that answer slowly. [default: %(default)s]')
+    parser.add_argument('--delay', default=10.0, type=float, help='Max seconds a slow feed waits. [default: %(default)s]')
+    parser.add_argument('--stall', default=0.01, type=float, help='Fraction of feeds that never answer. [default: %(default)s]')
+    parser.add_argument('--etag', default='yes', choices=['yes', 'none', 'changing'], help='Send ETags and honour If-None-Match, send none, or send a new one every time. [default: %(default)s]')
+    parser.add_argument('--hub', help='Name this WebSub hub in every feed.')
+    parser.add_argument('--list', help='Write a subscription list for the farm here.')
+    args = parser.parse_args()
+
+    if args.list:
+        write_subscription_list(args.list, args.host, args.port, args.feeds, args.rivers)
+
+    server = FeedFarm((args.host, args.port), FeedHandler)
+    server.farm_args = args
+    print 'Serving %d feeds on http://%s:%d/' % (args.feeds, args.host, args.port)
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+"""
+Time reading a subscription list that includes a tree of other lists.
+
+Serves a generated tree of nested OPML lists from a local HTTP server
+that answers every request after --latency seconds and honours ETags
+and Last-Modified, then loads it the way `river` does:
+
+    $ python bench/opmltree.py --rivers 20 --depth 2 --fanout 3 --latency 0.05
+
+Every list also includes one list shared by all of them, and the
+deepest lists include the top of their own tree again, so duplicate
+includes and loops are part of every run.
+"""
+import os
+import sys
+import time
+import shutil
+import logging
+import hashlib
+import argparse
+import tempfile
+import threading
+import BaseHTTPServer
+import SocketServer
+from email.utils import formatdate
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from riverpy.parser import ListCache, ListResolver
+
+# The loops are on purpose.
+logging.getLogger('riverpy').setLevel(logging.ERROR)
+
+OPML = '''<?xml version="1.0" encoding="utf-8"?>
+<opml version="2.0"><head><title>%(title)s</title></head><body>
+%(outlines)s
+</body></opml>'''
+
+FEED = '<outline type="rss" text="Feed %(n)s" xmlUrl="http://example.com/%(list)s/%(n)d.xml"/>'
+
+INCLUDE = '<outline type="include" text="%(name)s" url="%(url)s"/>'
+
+def render_tree(rivers, depth, fanout, feeds, version=None):
+    """
+    Return {path: body} for every list in the tree. `version' maps
+    paths to a number that's added to their feeds' URLs, to change
+    them.
+    """
+    version = version or {}
+    lists = {}
+
+    def render(path, title, outlines):
+        feed_lines = [FEED % {'list': '%s/%d' % (path, version.get(path, 0)), 'n': n} for n in xrange(feeds)]
+        lists[path] = OPML % {'title': title, 'outlines': '\n'.join(feed_lines + outlines)}
+
+    for river in xrange(rivers):
+        level = ['%d' % river]
+        for d in xrange(depth + 1):
+            next_level = []
+            for name in level:
+                outlines = [INCLUDE % {'name': 'shared', 'url': 'shared.opml'}]
+                if d == depth:
+                    # Back to the top, which is this list's ancestor.
+                    outlines.append(INCLUDE % {'name': 'loop', 'url': '%d.opml' % river})
+                else:
+                    for child in xrange(fanout):
+                        child_name = '%s-%d' % (name, child)
+                        outlines.append(INCLUDE % {'name': child_name, 'url': '%s.opml' % child_name})
+                        next_level.append(child_name)
+                render('/lists/%s.opml' % name, 'List %s' % name, outlines)
+            level = next_level
+
+    render('/lists/shared.opml', 'Shared', [])
+    summits = [INCLUDE % {'name': 'River %d' % river, 'url': 'lists/%d.opml' % river} for river in xrange(rivers)]
+    lists['/master.opml'] = OPML % {'title': 'Master', 'outlines': '\n'.join(summits)}
+    return lists
+
+class TreeServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def reset(self):
+        with self.lock:
+            (self.full, self.not_modified) = (0, 0)
+
+    def count(self, status):
+        with self.lock:
+            if status == 304:
+                self.not_modified += 1
+            else:
+                self.full += 1
+
+class TreeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        time.sleep(server.latency)
+        body = server.lists.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        last_modified = server.modified.get(self.path, server.started)
+        if (self.headers.get('If-None-Match') == etag or
+            self.headers.get('If-Modified-Since') == last_modified):
+            server.count(304)
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        server.count(200)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/x-opml')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', last_modified)
+        self.end_headers()
+        self.wfile.write(body)
+
+class CountingResolver(ListResolver):
+    parsed = 0
+
+    def parse(self, location, content, top_level):
+        self.parsed += 1
+        return ListResolver.parse(self, location, content, top_level)
+
+def timed(label, server, resolver, location):
+    server.reset()
+    resolver.parsed = 0
+    start = time.time()
+    resolver.load(location)
+    rivers = list(resolver.rivers(location))
+    elapsed = time.time() - start
+    print '%-22s %7.2fs  %5d x 200  %5d x 304  %5d parsed  %4d rivers  %6d feeds' % (
+        label, elapsed, server.full, server.not_modified, resolver.parsed,
+        len(rivers), sum(len(river['feeds']) for river in rivers),
+    )
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', '--rivers', default=20, type=int, help='Rivers in the master list, each the top of a tree. [default: %(default)s]')
+    parser.add_argument('--depth', default=2, type=int, help='Levels of includes below each river. [default: %(default)s]')
+    parser.add_argument('--fanout', default=3, type=int, help='Lists each list includes. [default: %(default)s]')
+    parser.add_argument('--feeds', default=10, type=int, help='Feeds in each list. [default: %(default)s]')
+    parser.add_argument('--latency', default=0.05, type=float, help='Seconds the server waits before every answer. [default: %(default)s]')
+    parser.add_argument('--list-workers', default=8, type=int, help='Lists to download at once. [default: %(default)s]')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on. [default: %(default)s]')
+    parser.add_argument('--port', default=8222, type=int, help='Port to listen on. [default: %(default)s]')
+    args = parser.parse_args()
+
+    server = TreeServer((args.host, args.port), TreeHandler)
+    server.lock = threading.Lock()
+    server.latency = args.latency
+    server.lists = render_tree(args.rivers, args.depth, args.fanout, args.feeds)
+    server.started = formatdate(time.time(), usegmt=True)
+    server.modified = {}
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    location = 'http://%s:%d/master.opml' % (args.host, args.port)
+    print 'Serving %d lists on %s' % (len(server.lists), location)
+
+    cache_dir = tempfile.mkdtemp(prefix='opmltree-')
+    caches = [ListCache(), ListCache(cache_dir), ListCache(cache_dir)]
+    try:
+        serial = timed('cold, 1 worker', server, CountingResolver(caches[0], 1), location)
+        concurrent = timed('cold, %d workers' % args.list_workers, server,
+                           CountingResolver(caches[1], args.list_workers), location)
+
+        # A new process with the same --list-cache.
+        resolver = CountingResolver(caches[2], args.list_workers)
+        timed('restart, warm cache', server, resolver, location)
+        timed('reload, unchanged', server, resolver, location)
+
+        changed = '/lists/%d-%s.opml' % (args.rivers - 1, '-'.join(['0'] * args.depth)) if args.depth else '/lists/0.opml'
+        server.lists = render_tree(args.rivers, args.depth, args.fanout, args.feeds, {changed: 1})
+        server.modified[changed] = formatdate(time.time() + 1, usegmt=True)
+        timed('reload, 1 list changed', server, resolver, location)
+
+        print '%d workers are %.1fx as fast as 1 on a cold start' % (args.list_workers, serial / concurrent)
+    finally:
+        # Hang up first so no handler is left waiting on a request.
+        for cache in caches:
+            cache.session.close()
+        shutil.rmtree(cache_dir)
+        server.shutdown()
+
+if __name__ == '__main__':
+    main()
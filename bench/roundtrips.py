@@ -0,0 +1,84 @@
+"""
+Count the redis round trips ParseFeed makes per feed check.
+
+Runs against a scratch redis DB (flushed first!) with synthetic feeds
+from feedfarm.py, so no network access is needed:
+
+    $ python bench/roundtrips.py --redis-db 9 --items 50 --rivers 3
+
+Check out an older commit and run it again to compare.
+"""
+import os
+import sys
+import redis
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.dirname(__file__))
+
+from riverpy import river_parser
+from riverpy.download import ParseFeed
+from feedfarm import render_feed
+
+class CountingConnection(redis.Connection):
+    round_trips = 0
+    commands = 0
+
+    def send_packed_command(self, command):
+        CountingConnection.round_trips += 1
+        redis.Connection.send_packed_command(self, command)
+
+    def pack_command(self, *args):
+        CountingConnection.commands += 1
+        return redis.Connection.pack_command(self, *args)
+
+def reset():
+    CountingConnection.round_trips = 0
+    CountingConnection.commands = 0
+
+def main():
+    parser = argparse.ArgumentParser(epilog='Anything else is read the way river reads it, e.g. --dedup bloom.')
+    parser.add_argument('--feeds', default=100, type=int, help='Feeds to check. [default: %(default)s]')
+    parser.add_argument('--items', default=50, type=int, help='Items per feed. [default: %(default)s]')
+    parser.add_argument('--new', default=3, type=int, help='New items per feed on the second check. [default: %(default)s]')
+    parser.add_argument('--rivers', default=2, type=int, help='Rivers each feed belongs to. [default: %(default)s]')
+    (bench_args, river_argv) = parser.parse_known_args()
+
+    crawler = river_parser()
+    # A scratch DB, since it's flushed, and no per-host limits since
+    # every feed is on the same made-up host.
+    crawler.set_defaults(redis_db=9, host_concurrency=0, host_rate=0)
+    # The subscription list is never read, but river insists on one.
+    args = crawler.parse_args(river_argv + ['-'])
+
+    checker = ParseFeed(None, args)
+    checker.redis_client.flushdb()
+    checker.redis_client.connection_pool = redis.ConnectionPool(
+        connection_class=CountingConnection,
+        host=args.redis_host,
+        port=args.redis_port,
+        db=args.redis_db,
+    )
+
+    feed_urls = ['http://127.0.0.1/feeds/%d.xml' % n for n in xrange(bench_args.feeds)]
+    for feed_url in feed_urls:
+        for river in xrange(bench_args.rivers):
+            checker.redis_client.sadd('%s:rivers' % feed_url, 'river-%d' % river)
+
+    checks = [
+        ('first check', bench_args.items),
+        ('no new items', bench_args.items),
+        ('%d new items' % bench_args.new, bench_args.items + bench_args.new),
+    ]
+    for (label, generation) in checks:
+        reset()
+        for (n, feed_url) in enumerate(feed_urls):
+            checker.process_feed(feed_url, render_feed(n, generation, bench_args.items, 200))
+        print '%-16s %6.1f round trips/feed  %7.1f commands/feed' % (
+            label,
+            CountingConnection.round_trips / float(bench_args.feeds),
+            CountingConnection.commands / float(bench_args.feeds),
+        )
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+"""
+Replay recorded feed histories against the scheduling model to see
+how many fetches it spends per new item and how long items wait to
+be noticed. The old fixed "average of the last ten intervals" model
+is run alongside for comparison.
+
+Histories are JSON lines, one feed per line:
+
+    {"feed": "http://example.com/rss", "timestamps": [1400000000, ...]}
+
+Or read the `<url>:timestamps' lists older versions of riverpy kept:
+
+    $ python bench/simulate.py --redis-db 0 --export histories.jsonl
+    $ python bench/simulate.py histories.jsonl --halflife 21600
+"""
+import os
+import sys
+import json
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from riverpy.interval import IntervalModel
+
+class LegacyModel(object):
+    """
+    The scheduling riverpy used before the interval model.
+    """
+    def __init__(self):
+        self.history = []
+        self.found_new = False
+
+    def update(self, now, timestamps):
+        self.history = sorted(self.history + timestamps, reverse=True)[:100]
+        self.found_new = bool(timestamps)
+
+    def next_interval(self, now):
+        if self.found_new:
+            history = self.history[:10]
+        else:
+            history = [now] + self.history[:9]
+        # Same as the old average_update_interval: the span of the
+        # history divided by its length.
+        interval = (history[0] - history[-1]) / float(len(history))
+        if interval < 60:
+            return 60
+        elif interval > 2*60*60:
+            return random.uniform(60*60, 2*60*60)
+        return interval
+
+def replay(timestamps, next_interval, update):
+    """
+    Return (fetches, latencies) for one feed.
+    """
+    timestamps = sorted(timestamps)
+    now = timestamps[0]
+    (fetches, latencies) = (1, [])
+    seen = sum(1 for ts in timestamps if ts <= now)
+    update(now, timestamps[:seen], True)
+
+    while seen < len(timestamps):
+        now += next_interval(now)
+        fetches += 1
+        new = []
+        while seen < len(timestamps) and timestamps[seen] <= now:
+            new.append(timestamps[seen])
+            seen += 1
+        latencies.extend(now - ts for ts in new)
+        update(now, new, False)
+    return (fetches, latencies)
+
+def run_model(histories, make_model):
+    total_fetches = 0
+    all_latencies = []
+    for timestamps in histories:
+        (next_interval, update) = make_model()
+        (fetches, latencies) = replay(timestamps, next_interval, update)
+        total_fetches += fetches
+        all_latencies.extend(latencies)
+    return (total_fetches, sorted(all_latencies))
+
+def percentile(values, pct):
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+def report(name, histories, make_model):
+    (fetches, latencies) = run_model(histories, make_model)
+    items = len(latencies)
+    print '%-8s %8d fetches %8d items %6.2f fetches/item  latency p50 %6.0fs p90 %6.0fs mean %6.0fs' % (
+        name, fetches, items, fetches / float(items or 1),
+        percentile(latencies, 50), percentile(latencies, 90),
+        sum(latencies) / float(items or 1),
+    )
+
+def load_histories(fname):
+    with open(fname) as fp:
+        for line in fp:
+            if line.strip():
+                yield json.loads(line)
+
+def export_histories(args):
+    import redis
+    redis_client = redis.Redis(host=args.redis_host, port=args.redis_port, db=args.redis_db)
+    with open(args.export, 'w') as fp:
+        for key in redis_client.keys('*:timestamps'):
+            timestamps = [int(ts) for ts in redis_client.lrange(key, 0, -1)]
+            fp.write(json.dumps({'feed': key.rsplit(':', 1)[0], 'timestamps': timestamps}) + '\n')
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('histories', nargs='?', help='JSON lines file of feed histories.')
+    parser.add_argument('--export', help='Write the histories stored in redis to this file and exit.')
+    parser.add_argument('--min-interval', default=60, type=int, help='[default: %(default)s]')
+    parser.add_argument('--max-interval', default=2*60*60, type=int, help='[default: %(default)s]')
+    parser.add_argument('--halflife', default=12*60*60, type=int, help='[default: %(default)s]')
+    parser.add_argument('--target', default=1.0, type=float, help='New items to expect per check. [default: %(default)s]')
+    parser.add_argument('--seed', default=0, type=int, help='Random seed. [default: %(default)s]')
+    parser.add_argument('--redis-host', default='127.0.0.1')
+    parser.add_argument('--redis-port', default=6379, type=int)
+    parser.add_argument('--redis-db', default=0, type=int)
+    args = parser.parse_args()
+
+    if args.export:
+        export_histories(args)
+        return
+    if not args.histories:
+        parser.error('need a histories file (or --export)')
+
+    histories = [h['timestamps'] for h in load_histories(args.histories) if len(h['timestamps']) > 1]
+    print 'Replaying %d feeds' % len(histories)
+
+    def interval_model():
+        model = IntervalModel(args.min_interval, args.max_interval, args.halflife, args.target)
+        state = {}
+        def next_interval(now):
+            return model.next_interval(state, now)
+        def update(now, timestamps, new_feed):
+            state.update(model.update(state, now, timestamps, new_feed))
+        return (next_interval, update)
+
+    def legacy_model():
+        model = LegacyModel()
+        def next_interval(now):
+            return model.next_interval(now)
+        def update(now, timestamps, new_feed):
+            model.update(now, timestamps)
+        return (next_interval, update)
+
+    random.seed(args.seed)
+    report('legacy', histories, legacy_model)
+    random.seed(args.seed)
+    report('interval', histories, interval_model)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+"""
+A bare-bones WebSub hub for trying out `river --push-url' locally.
+
+    $ python bench/feedfarm.py -n 100 --churn 30 --hub http://127.0.0.1:8113/ --list /tmp/farm.txt
+    $ python bench/stubhub.py --port 8113 --poll 5
+    $ river --push-url http://127.0.0.1:8112 --redis-db 9 -o /tmp/out /tmp/farm.txt
+
+Subscriptions are confirmed by calling the subscriber back like a
+real hub would. Every --poll seconds each topic with subscribers is
+fetched, and if it changed it's pushed to them signed with their
+secret. Publishers can also POST hub.mode=publish&hub.url=<topic> to
+have a topic pushed right away. --forge signs that fraction of pushes
+with the wrong secret, which the subscriber should ignore.
+"""
+import os
+import hmac
+import time
+import random
+import hashlib
+import urllib
+import urlparse
+import argparse
+import requests
+import threading
+import BaseHTTPServer
+import SocketServer
+
+class Hub(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, handler, args):
+        BaseHTTPServer.HTTPServer.__init__(self, address, handler)
+        self.args = args
+        self.lock = threading.Lock()
+        # topic -> {callback: secret}
+        self.subscribers = {}
+        # topic -> last body pushed
+        self.bodies = {}
+        self.session = requests.Session()
+        self.counts = {'verified': 0, 'pushed': 0, 'forged': 0, 'gone': 0}
+
+    def verify(self, mode, topic, callback, secret, lease_seconds):
+        challenge = os.urandom(8).encode('hex')
+        params = {
+            'hub.mode': mode,
+            'hub.topic': topic,
+            'hub.challenge': challenge,
+            'hub.lease_seconds': lease_seconds or self.args.lease,
+        }
+        separator = '&' if '?' in callback else '?'
+        try:
+            response = self.session.get(callback + separator + urllib.urlencode(params), timeout=15)
+        except requests.exceptions.RequestException as ex:
+            print 'Failed to verify %s for %s: %s' % (mode, callback, ex)
+            return
+        if response.status_code != 200 or response.content != challenge:
+            print 'Subscriber refused %s for %s (%d)' % (mode, topic, response.status_code)
+            return
+
+        with self.lock:
+            callbacks = self.subscribers.setdefault(topic, {})
+            if mode == 'subscribe':
+                callbacks[callback] = secret
+            else:
+                callbacks.pop(callback, None)
+            self.counts['verified'] += 1
+
+    def distribute(self, topic, force=False):
+        try:
+            body = self.session.get(topic, timeout=15).content
+        except requests.exceptions.RequestException as ex:
+            print 'Failed to fetch %s: %s' % (topic, ex)
+            return
+        with self.lock:
+            if body == self.bodies.get(topic) and not force:
+                return
+            self.bodies[topic] = body
+            callbacks = self.subscribers.get(topic, {}).items()
+
+        for (callback, secret) in callbacks:
+            if random.random() < self.args.forge:
+                (secret, count) = ('not the secret', 'forged')
+            else:
+                count = 'pushed'
+            signature = hmac.new(secret or '', body, hashlib.sha1).hexdigest()
+            try:
+                response = self.session.post(callback, data=body, timeout=15, headers={
+                    'Content-Type': 'application/rss+xml',
+                    'X-Hub-Signature': 'sha1=%s' % signature,
+                })
+            except requests.exceptions.RequestException as ex:
+                print 'Failed to push %s to %s: %s' % (topic, callback, ex)
+                continue
+            with self.lock:
+                self.counts[count] += 1
+                if response.status_code == 410:
+                    self.subscribers.get(topic, {}).pop(callback, None)
+                    self.counts['gone'] += 1
+
+    def poll(self):
+        while True:
+            time.sleep(self.args.poll)
+            with self.lock:
+                topics = [topic for (topic, callbacks) in self.subscribers.items() if callbacks]
+            for topic in topics:
+                self.distribute(topic)
+            with self.lock:
+                print '%d topics  %s' % (len(topics), '  '.join('%s %d' % item for item in sorted(self.counts.items())))
+
+class HubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def respond(self, status, body=''):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        form = dict(urlparse.parse_qsl(self.rfile.read(length)))
+        mode = form.get('hub.mode')
+        hub = self.server
+
+        if mode in ('subscribe', 'unsubscribe'):
+            if not form.get('hub.topic') or not form.get('hub.callback'):
+                self.respond(400, 'hub.topic and hub.callback are required')
+                return
+            self.respond(202)
+            hub.verify(mode, form['hub.topic'], form['hub.callback'], form.get('hub.secret'), form.get('hub.lease_seconds'))
+        elif mode == 'publish':
+            self.respond(204)
+            hub.distribute(form.get('hub.url') or form.get('hub.topic'), force=True)
+        else:
+            self.respond(400, 'unknown hub.mode')
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on. [default: %(default)s]')
+    parser.add_argument('--port', default=8113, type=int, help='Port to listen on. [default: %(default)s]')
+    parser.add_argument('--poll', default=5, type=int, help='Seconds between fetching every topic. [default: %(default)s]')
+    parser.add_argument('--lease', default=24*60*60, type=int, help='Lease to grant when none is asked for. [default: %(default)s]')
+    parser.add_argument('--forge', default=0.0, type=float, help='Fraction of pushes to sign with the wrong secret. [default: %(default)s]')
+    args = parser.parse_args()
+
+    hub = Hub((args.host, args.port), HubHandler, args)
+    poller = threading.Thread(target=hub.poll)
+    poller.daemon = True
+    poller.start()
+    print 'Hub listening on http://%s:%d/' % (args.host, args.port)
+    hub.serve_forever()
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,33 @@
+import os
 import json
 import time
 import redis
 import arrow
 import Queue
 import random
-import cPickle
+import socket
 import logging
 import operator
 import argparse
-from path import path
+import threading
 
 from bucket import Bucket
+from directory import Directory
+from codec import get_codec, allow_pickle, loads
 from download import ParseFeed
+from fetch import GeventEngine
+from metrics import REGISTRY, serve_metrics, report_stats, time_sockets
+from push import serve_push
+from parse import feed_parser
+from scheduler import Scheduler
+from storage import open_storage, close_storage
+from timing import StageTimings, StageProfiler
+from recording import FetchArchive, ReplayAdapter, replay_session, replay_messages
 from utils import format_timestamp, slugify
-from riverjs import serialize_riverjs
-from parser import parse_subscription_list
+from riverjs import serialize_fragments, to_fragment, FragmentCache, DeltaLog
+from timeline import RiverStore, river_store
+from subscriptions import SubscriptionList, FIREHOSE, sync_subscriptions
+from updates import UpdateStream, UpdateReader, WRITERS_KEY, WRITTEN_KEY, check_redis_version
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -24,63 +37,175 @@ fmt = logging.Formatter('[%(levelname)-5s] %(asctime)s - %(name)s - %(message)s'
 ch.setFormatter(fmt)
 logger.addHandler(ch)
 
-def generate_river_obj(redis_client, river_name):
+# Archive pages never change once they're written.
+ARCHIVE_CACHE_CONTROL = 'public, max-age=31536000'
+
+# How long a bucket has to have been over before it's archived, so
+# checks that were committing as it ended still make it in.
+SETTLE_SECONDS = 60
+
+# head.js is polled, so it can't be cached for long.
+HEAD_CACHE_CONTROL = 'public, max-age=10'
+
+def river_metadata(older_page=None, head=None):
+    metadata = {
+        'docs': 'http://riverjs.org/',
+        'whenGMT': format_timestamp(arrow.utcnow()),
+        'whenLocal': format_timestamp(arrow.utcnow().to('local')),
+        'version': '3',
+        'secs': '',
+    }
+    if older_page is not None:
+        # Not part of the river.js spec.
+        metadata['olderPage'] = older_page
+    if head is not None:
+        # Neither is this; the update id clients poll head.js from.
+        metadata['head'] = head
+    return metadata
+
+def generate_riverjs(store, buckets, cache, create_json, limit, older_page=None, deltas=None, river_name=None):
     """
-    Return a dict that matches the river.js spec.
+    Return (riverjs, uploads, stale) where riverjs is the river.js
+    document for the newest `limit' updates in `buckets', only
+    decoding updates that aren't already in `cache'.
+
+    With `deltas' (a DeltaLog), uploads are the river's delta and
+    head.js documents and stale are the deltas that head.js no longer
+    lists.
     """
-    river_key = 'rivers:%s' % river_name
-    river_updates = [cPickle.loads(update) for update in redis_client.lrange(river_key, 0, -1)]
-    return {
-        'updatedFeeds': {
-            'updatedFeed': river_updates,
-        },
-        'metadata': {
-            'docs': 'http://riverjs.org/',
-            'whenGMT': format_timestamp(arrow.utcnow()),
-            'whenLocal': format_timestamp(arrow.utcnow().to('local')),
-            'version': '3',
-            'secs': '',
-        },
+    if deltas is None:
+        fragments = cache.fragments_for(store.latest(buckets, limit))
+        return (serialize_fragments(fragments, river_metadata(older_page), create_json), [], [])
+
+    updates = store.latest(buckets, limit, withscores=True)
+    fragments = cache.fragments_for([stored_update for (stored_update, update_id) in updates])
+    delta = deltas.update(river_name, zip(fragments, [update_id for (stored_update, update_id) in updates]))
+    head = deltas.head(river_name)
+    riverjs = serialize_fragments(fragments, river_metadata(older_page, head), create_json)
+
+    (uploads, stale) = ([], [])
+    if delta is not None:
+        (since, head, new_fragments, dropped) = delta
+        doc = serialize_fragments(new_fragments, river_metadata(head=head), create_json)
+        uploads.append((delta_key(river_name, since, head), doc, 'application/json', ARCHIVE_CACHE_CONTROL))
+        stale = [delta_key(river_name, *pair) for pair in dropped]
+
+    head_obj = {
+        'head': head,
+        'river': 'rivers/%s.js' % river_name,
+        'pageSize': limit,
+        'deltas': [{'since': pair[0], 'head': pair[1], 'url': delta_key(river_name, *pair)}
+                   for pair in deltas.deltas(river_name)],
     }
+    if create_json:
+        head_js = json.dumps(head_obj, sort_keys=True)
+    else:
+        head_js = 'onGetRiverHead(%s)' % json.dumps(head_obj, sort_keys=True)
+    uploads.append(('rivers/%s/head.js' % river_name, head_js, 'application/json', HEAD_CACHE_CONTROL))
+    return (riverjs, uploads, stale)
 
-def outdated_feeds(redis_client):
-    """
-    Return all the feeds that need to be checked.
-    """
-    return redis_client.zrangebyscore('next_check', '-inf', arrow.utcnow().timestamp)
+def delta_key(river_name, since, head):
+    return 'rivers/%s/deltas/%d-%d.js' % (river_name, since, head)
+
+def page_key(river_name, start):
+    return 'rivers/%s/%s.js' % (river_name, arrow.get(start).format('YYYYMMDD-HHmm'))
 
-def upcoming_feeds(redis_client, num=5):
+def archived_key(river_name):
+    return 'archived:%s' % river_name
+
+def generate_archive(store, river_name, buckets, create_json, archived):
     """
-    Return the feeds that are next to be checked.
+    Return (uploads, newest_page, starts) where uploads are the pages
+    for any of a river's closed buckets whose start isn't in
+    `archived' yet, newest_page is the key of the newest closed
+    bucket's page, and starts are the starts of the buckets in
+    uploads.
+
+    A bucket is closed once the next one has been going for a while.
+    Each page points at the one before it.
     """
-    return redis_client.zrange('next_check', 0, num - 1, withscores=True)
+    (uploads, starts) = ([], [])
+    newest_page = None
+    now = time.time()
+    for (n, (start, keys)) in enumerate(buckets):
+        if n == 0 or buckets[n - 1][0] + SETTLE_SECONDS > now:
+            continue
+        key = page_key(river_name, start)
+        if newest_page is None:
+            newest_page = key
+        if start in archived:
+            continue
+        older_page = page_key(river_name, buckets[n + 1][0]) if n + 1 < len(buckets) else None
+        fragments = [to_fragment(update) for update in store.bucket_updates(keys)]
+        page = serialize_fragments(fragments, river_metadata(older_page), create_json)
+        logger.info('Archiving %s (%d bytes)' % (key, len(page)))
+        uploads.append((key, page, 'application/json', ARCHIVE_CACHE_CONTROL))
+        starts.append(start)
+    return (uploads, newest_page, starts)
+
+def manifest_entry(river_obj):
+    return {
+        'title': river_obj['title'],
+        'url': 'rivers/%s.js' % river_obj['name'],
+    }
 
-def write_to_bucket(bucket, key, data):
-    if bucket is not None:
-        bucket.write_string(key, data, 'application/json')
+def add_writer_arguments(parser):
+    parser.add_argument('-b', '--bucket', help='Destination S3 bucket.')
+    parser.add_argument('-o', '--output', help='Destination directory.')
+    parser.add_argument('--json', action='store_true', help='Generate JSON instead of JSONP. [default: %(default)s]')
+    parser.add_argument('--page-size', default=100, type=int, help='Number of grouped feed updates in each river.js. [default: %(default)s]')
+    parser.add_argument('--archive', action='store_true', help='Also write a page of older updates for each closed time bucket. [default: %(default)s]')
+    parser.add_argument('--deltas', action='store_true', help='Also write delta documents of what is new since each update id, and a head.js pointing at them. [default: %(default)s]')
+    parser.add_argument('--delta-history', default=100, type=int, help='Number of deltas head.js lists with --deltas. [default: %(default)s]')
+    parser.add_argument('--cache-size', default=10000, type=int, help='Number of serialized updates to keep in memory. [default: %(default)s]')
+    parser.add_argument('--gzip', action='store_true', help='Gzip files uploaded to S3. [default: %(default)s]')
+    parser.add_argument('--upload-workers', default=8, type=int, help='Number of files to upload to S3 at once. [default: %(default)s]')
+    parser.add_argument('--s3-host', help='Use this S3-compatible host instead of Amazon S3.')
+    parser.add_argument('--s3-port', type=int, help='Port of --s3-host.')
+    parser.add_argument('--s3-insecure', action='store_true', help='Talk plain HTTP to --s3-host. [default: %(default)s]')
+    parser.add_argument('--gzip-files', action='store_true', help='Also write a gzipped .gz copy of each file in --output. [default: %(default)s]')
+    parser.add_argument('--debounce', default=1.0, type=float, help='Seconds to wait for more updates before writing. [default: %(default)s]')
+    parser.add_argument('--read-pickle', action='store_true', help='Also read updates stored with the pickle codec by older versions of riverpy. Unpickling runs whatever the data says to, so only use this with a redis no one else can write to.')
+
+def output_destinations(args):
+    destinations = []
 
-def write_to_file(directory, key, data):
-    if directory is not None:
-        fname = directory.joinpath(key)
-        fname.parent.makedirs_p()
-        with fname.open('w') as fp:
-            fp.write(data)
+    if args.bucket:
+        destinations.append(Bucket(
+            args.bucket,
+            host=args.s3_host,
+            port=args.s3_port,
+            secure=not args.s3_insecure,
+            compress=args.gzip,
+            workers=args.upload_workers,
+        ))
+
+    if args.output:
+        destinations.append(Directory(args.output, compress=args.gzip_files))
+
+    return destinations
 
 def river_writer():
     parser = argparse.ArgumentParser()
-    parser.add_argument('-b', '--bucket', help='Destination S3 bucket.')
-    parser.add_argument('-o', '--output', help='Destination directory.')
-    parser.add_argument('--json', action='store_true', help='Generate JSON instead of JSONP. [default: %(default)s]')
+    add_writer_arguments(parser)
+    parser.add_argument('--metrics-port', default=0, type=int, help='Serve Prometheus metrics on this local port; 0 to disable. [default: %(default)s]')
+    parser.add_argument('--stats-interval', default=60, type=int, help='Write stats to stats:river-writer:<pid> in redis every this many seconds; 0 to disable. [default: %(default)s]')
     parser.add_argument('--redis-host', default='127.0.0.1', help='Redis host to use. [default: %(default)s]')
     parser.add_argument('--redis-port', default=6379, type=int, help='Redis port to use. [default: %(default)s]')
     parser.add_argument('--redis-db', default=0, type=int, help='Redis DB to use. [default: %(default)s]')
+    parser.add_argument('--writers', default=1, type=int, help='Number of river-writer processes sharing the rivers; must match river --writers. [default: %(default)s]')
+    parser.add_argument('--writer-index', default=0, type=int, help='Which of the --writers this one is, counting from 0. [default: %(default)s]')
     args = parser.parse_args()
 
     if not args.bucket and not args.output:
         raise SystemExit('Need either a -b/--bucket or -o/--output directory. Exiting.')
+    if not 0 <= args.writer_index < args.writers:
+        raise SystemExit('--writer-index must be from 0 to --writers minus one. Exiting.')
+    if args.read_pickle:
+        allow_pickle()
 
-    # Need two clients as redis_client can't do anything else once it
-    # subscribes to the channel.
+    # Need two clients as redis_client is blocked waiting for updates
+    # most of the time.
     redis_client = redis.Redis(
         host=args.redis_host,
         port=args.redis_port,
@@ -92,74 +217,125 @@ def river_writer():
         port=args.redis_port,
         db=args.redis_db,
     )
+    check_redis_version(river_client)
+
+    announced = river_client.get(WRITERS_KEY)
+    if announced is not None and int(announced) != args.writers:
+        logger.warning('river is splitting updates between %s writers, not %d' % (announced, args.writers))
+
+    destinations = output_destinations(args)
+
+    if args.metrics_port:
+        serve_metrics(args.metrics_port)
+    if args.stats_interval:
+        report_stats(river_client, 'stats:river-writer:%d' % os.getpid(), args.stats_interval)
+
+    # Only the first writer writes the manifest; the others tell it
+    # when they've written a river for the first time.
+    manifest_requests = UpdateStream(river_client, get_codec('json'), args.writers) if args.writer_index else None
+
+    messages = UpdateReader(redis_client, args.writer_index).messages(args.debounce)
+    write_rivers(river_client, messages, destinations, args, manifest_requests)
+
+def write_files(destinations, uploads, stale=()):
+    for destination in destinations:
+        kind = destination.__class__.__name__.lower()
+        with REGISTRY.timer('write_seconds', destination=kind):
+            written = destination.write_many(uploads)
+        REGISTRY.incr('files_written_total', written, destination=kind)
+        REGISTRY.incr('files_unchanged_total', len(uploads) - written, destination=kind)
+        if stale:
+            # Clients that were this far behind reload river.js.
+            destination.delete_many(stale)
+
+def write_rivers(river_client, messages, destinations, args, manifest_requests=None):
+    """
+    Write the rivers named in each update message from `messages' to
+    `destinations', along with the manifest of every river written so
+    far.
 
-    if args.bucket:
-        s3_bucket = Bucket(args.bucket)
-    else:
-        s3_bucket = None
-
-    if args.output:
-        output_directory = path(args.output)
-        output_directory.makedirs_p()
-    else:
-        output_directory = None
-
-    pubsub = redis_client.pubsub()
-    pubsub.subscribe('update:%d' % args.redis_db)
-
-    manifest = []
-    for item in pubsub.listen():
-        if item['type'] != 'message': continue
-
-        update_msg = cPickle.loads(item['data'])
+    A writer that leaves the manifest to another passes the
+    UpdateStream to ask that one for it in `manifest_requests'.
+    """
+    store = RiverStore(river_client)
+    cache = FragmentCache(args.cache_size)
+    # River name -> starts of the buckets it's archived. Kept in
+    # redis so a restarted writer doesn't archive them all again.
+    archived = {}
+    deltas = DeltaLog(river_client, args.delta_history) if args.deltas else None
+    manifest = None
+    for update_msg in messages:
         available_rivers = update_msg['available_rivers']
         updated_rivers = update_msg['updated_rivers']
-        updated_manifest = False
+        uploads = []
+        stale = []
+        new_pages = {}
 
+        river_buckets = store.buckets(updated_rivers)
         for river_name in updated_rivers:
-            river_obj = generate_river_obj(river_client, river_name)
-            riverjs = serialize_riverjs(river_obj, args.json)
+            with REGISTRY.timer('render_seconds'):
+                older_page = None
+                if args.archive:
+                    if river_name not in archived:
+                        archived[river_name] = set(int(start) for start in river_client.zrange(archived_key(river_name), 0, -1))
+                    (pages, older_page, new_pages[river_name]) = generate_archive(
+                        store, river_name, river_buckets[river_name], args.json, archived[river_name])
+                    uploads.extend(pages)
+                (riverjs, delta_uploads, stale_deltas) = generate_riverjs(
+                    store, river_buckets[river_name], cache, args.json, args.page_size, older_page, deltas, river_name)
+                uploads.extend(delta_uploads)
+                stale.extend(stale_deltas)
             key = 'rivers/%s.js' % river_name
             logger.info('Writing %s.js (%d bytes)' % (river_name, len(riverjs)))
 
-            write_to_bucket(s3_bucket, key, riverjs)
-            write_to_file(output_directory, key, riverjs)
-
-            for river_obj in available_rivers:
-                if river_obj['name'] == river_name:
-                    break
-
-            manifest_obj = {
-                'title': river_obj['title'],
-                'url': 'rivers/%s.js' % river_obj['name'],
-            }
+            uploads.append((key, riverjs, 'application/json'))
 
-            if manifest_obj not in manifest:
-                updated_manifest = True
-                manifest.append(manifest_obj)
+        write_files(destinations, uploads, stale)
 
-            river_client.srem('updated_rivers', river_name)
+        if any(new_pages.values()):
+            pipe = river_client.pipeline(transaction=False)
+            for (river_name, starts) in new_pages.items():
+                if not starts:
+                    continue
+                archived[river_name].update(starts)
+                pipe.zadd(archived_key(river_name), **dict((str(start), start) for start in starts))
+                # Buckets older than the oldest left are gone for good.
+                pipe.zremrangebyscore(archived_key(river_name), '-inf', '(%d' % river_buckets[river_name][-1][0])
+            pipe.execute()
 
-        if updated_manifest:
-            manifest = sorted(manifest, key=operator.itemgetter('title'))
+        # Only once they're written, so the manifest never lists a
+        # river that isn't there yet.
+        pipe = river_client.pipeline(transaction=False)
+        for river_name in updated_rivers:
+            pipe.sadd(WRITTEN_KEY, river_name)
+        if manifest_requests is None:
+            pipe.smembers(WRITTEN_KEY)
+        results = pipe.execute()
+        if manifest_requests is not None:
+            if any(results):
+                manifest_requests.request_manifest(available_rivers)
+            continue
+
+        # Rivers dropped from the subscription list leave the manifest.
+        written_rivers = results[-1]
+        current_manifest = sorted([manifest_entry(river_obj) for river_obj in available_rivers
+                                   if river_obj['name'] in written_rivers], key=operator.itemgetter('title'))
+        if current_manifest != manifest:
+            manifest = current_manifest
             if args.json:
                 manifest_js = json.dumps(manifest)
             else:
                 manifest_js = 'onGetRiverManifest(%s)' % json.dumps(manifest)
             logger.info('Writing manifest.js (%d bytes)' % len(manifest_js))
-            write_to_bucket(s3_bucket, 'manifest.js', manifest_js)
-            write_to_file(output_directory, 'manifest.js', manifest_js)
-            updated_manifest = False
+            write_files(destinations, [('manifest.js', manifest_js, 'application/json')])
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument('-t', '--threads', default=4, type=int, help='Number of threads to use for downloading feeds. [default: %(default)s]')
-    parser.add_argument('-e', '--entries', default=100, type=int, help='Display this many grouped feed updates. [default: %(default)s]')
-    parser.add_argument('-i', '--initial', default=5, type=int, help='Limit new feeds to this many new items. [default: %(default)s]')
+def migrate():
+    parser = argparse.ArgumentParser(description='Re-encode stored river updates with a different codec.')
+    parser.add_argument('--codec', default='json', choices=['json', 'msgpack', 'pickle'], help='Codec to convert to. [default: %(default)s]')
+    parser.add_argument('--read-pickle', action='store_true', help='Also read updates stored with the pickle codec by older versions of riverpy. Unpickling runs whatever the data says to, so only use this with a redis no one else can write to.')
     parser.add_argument('--redis-host', default='127.0.0.1', help='Redis host to use. [default: %(default)s]')
     parser.add_argument('--redis-port', default=6379, type=int, help='Redis port to use. [default: %(default)s]')
     parser.add_argument('--redis-db', default=0, type=int, help='Redis DB to use. [default: %(default)s]')
-    parser.add_argument('feeds', help='Subscription list to use. Accepts URLs and filenames.')
     args = parser.parse_args()
 
     redis_client = redis.Redis(
@@ -167,40 +343,228 @@ def main():
         port=args.redis_port,
         db=args.redis_db,
     )
-    total_feeds = 0
-    inbox = Queue.Queue()
+    if args.read_pickle:
+        allow_pickle()
+    codec = get_codec(args.codec)
+
+    for river_key in redis_client.keys('rivers:*'):
+        if river_key.endswith(':buckets'):
+            continue
+        # `river' may add to the river while we're converting it, so
+        # retry until nothing changed underneath us.
+        while True:
+            pipe = redis_client.pipeline()
+            try:
+                pipe.watch(river_key)
+                if pipe.type(river_key) == 'list':
+                    # Stored by older versions of riverpy.
+                    updates = [codec.dumps(loads(update)) for update in pipe.lrange(river_key, 0, -1)]
+                    count = len(updates)
+                    pipe.multi()
+                    pipe.delete(river_key)
+                    if updates:
+                        pipe.rpush(river_key, *updates)
+                else:
+                    # A time bucket. Adding before removing keeps the
+                    # key, and with it the expiry.
+                    stored = pipe.zrange(river_key, 0, -1, withscores=True)
+                    updates = dict((codec.dumps(loads(update)), score) for (update, score) in stored)
+                    count = len(stored)
+                    pipe.multi()
+                    if stored:
+                        pipe.zadd(river_key, **updates)
+                        stale = [update for (update, score) in stored if update not in updates]
+                        if stale:
+                            pipe.zrem(river_key, *stale)
+                pipe.execute()
+            except redis.WatchError:
+                continue
+            finally:
+                pipe.reset()
+            break
+        logger.info('Converted %s (%d updates) to %s' % (river_key, count, args.codec))
+
+def replay(args, redis_client, rivers, codec, parser):
+    """
+    Check every feed download recorded in --replay and write the
+    rivers they update, all in this thread.
 
-    rivers = list(parse_subscription_list(args.feeds))
+    Replaying into an empty redis DB or --sqlite database gives the
+    same rivers every time, which makes for repeatable benchmarks.
+    """
+    try:
+        archive = FetchArchive(args.replay)
+    except (IOError, ValueError) as ex:
+        raise SystemExit('Can\'t replay %s: %s. Exiting.' % (args.replay, ex))
+
+    # Whatever the recorded hosts were spared is already in the
+    # archive.
+    args.host_concurrency = args.host_rate = 0
+
+    adapter = ReplayAdapter()
+    checker = ParseFeed(None, args, session=replay_session(adapter), parser=parser)
+    scheduler = Scheduler(redis_client, None, args, rivers, codec, parser.timings)
+    messages = replay_messages(archive, adapter, checker, scheduler, args.debounce, args.replay_speed)
+
+    start = time.time()
+    write_rivers(redis_client, messages, output_destinations(args), args)
+    elapsed = time.time() - start
+    archive.close()
+
+    checks = parser.timings.counts['check']
+    logger.info('Replayed %d checks in %.1f seconds (%.1f/s)' % (checks, elapsed, checks / max(elapsed, 0.001)))
+    logger.info('Timings: %s' % parser.timings.summary())
+    if args.profile:
+        for path in parser.timings.profiler.dump(args.profile):
+            logger.info('Wrote %s' % path)
+
+def river_parser():
+    """
+    Return the parser for river's command line.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--engine', default='threads', choices=['threads', 'gevent'], help='How to download feeds. [default: %(default)s]')
+    parser.add_argument('-t', '--threads', default=4, type=int, help='Number of threads to use for downloading feeds. [default: %(default)s]')
+    parser.add_argument('-c', '--concurrency', default=200, type=int, help='Max feeds checked at once with --engine gevent. [default: %(default)s]')
+    parser.add_argument('--per-host', default=4, type=int, help='Max open connections per host with --engine gevent. [default: %(default)s]')
+    parser.add_argument('--fetch-timeout', default=60, type=int, help='Give up on a feed download after this many seconds with --engine gevent. [default: %(default)s]')
+    parser.add_argument('-p', '--parse-workers', default=0, type=int, help='Number of processes to parse feeds with; 0 parses in the downloading thread. [default: %(default)s]')
+    parser.add_argument('--batch-size', default=100, type=int, help='Max feeds to hand out at once. [default: %(default)s]')
+    parser.add_argument('--claim-timeout', default=15*60, type=int, help='Seconds before a feed handed out but never checked is handed out again. [default: %(default)s]')
+    parser.add_argument('--max-wait', default=60, type=int, help='Max seconds to wait between looking for due feeds. [default: %(default)s]')
+    parser.add_argument('--min-interval', default=60, type=int, help='Never check a feed more often than every this many seconds. [default: %(default)s]')
+    parser.add_argument('--max-interval', default=2*60*60, type=int, help='Always check a feed at least every this many seconds. [default: %(default)s]')
+    parser.add_argument('--rate-halflife', default=12*60*60, type=int, help='Seconds after which a feed\'s past activity counts half as much when scheduling it. [default: %(default)s]')
+    parser.add_argument('--target-items', default=1.0, type=float, help='Time checks so about this many new items are expected each time. [default: %(default)s]')
+    parser.add_argument('--host-concurrency', default=2, type=int, help='Max requests to one host at once across all river processes; 0 for no limit. [default: %(default)s]')
+    parser.add_argument('--host-rate', default=1.0, type=float, help='Max requests per second to one host across all river processes; 0 for no limit. [default: %(default)s]')
+    parser.add_argument('--backoff-base', default=120, type=int, help='Seconds to wait after a feed first fails; doubles with each failure in a row. [default: %(default)s]')
+    parser.add_argument('--backoff-max', default=6*60*60, type=int, help='Max seconds to wait after a feed fails. [default: %(default)s]')
+    parser.add_argument('--distributed', action='store_true', help='Share the redis DB with other river processes, leasing each feed to one of them.')
+    parser.add_argument('--node-id', default='%s:%d' % (socket.gethostname(), os.getpid()), help='Name of this process when --distributed. [default: %(default)s]')
+    parser.add_argument('--reload-interval', default=0, type=int, help='Look for changes to the subscription list every this many seconds; 0 to disable. [default: %(default)s]')
+    parser.add_argument('--list-cache', help='Keep downloaded subscription lists, and the OPML lists they include, in this directory so a restart only has to ask whether they changed.')
+    parser.add_argument('--list-workers', default=8, type=int, help='Number of included OPML lists to download at once. [default: %(default)s]')
+    parser.add_argument('-e', '--entries', default=100, type=int, help='Keep at least this many grouped feed updates per river. [default: %(default)s]')
+    parser.add_argument('--max-age', default=0, type=int, help='Drop grouped feed updates older than this many seconds; 0 to keep them until there are more than --entries. [default: %(default)s]')
+    parser.add_argument('--bucket-seconds', default=60*60, type=int, help='Store each river in time buckets this many seconds long. [default: %(default)s]')
+    parser.add_argument('--firehose-shards', default=1, type=int, help='Spread each firehose bucket over this many keys. [default: %(default)s]')
+    parser.add_argument('-i', '--initial', default=5, type=int, help='Limit new feeds to this many new items. [default: %(default)s]')
+    parser.add_argument('--dedup', default='zset', choices=['zset', 'bloom'], help='How to remember which entries have been seen. [default: %(default)s]')
+    parser.add_argument('--codec', default='json', choices=['json', 'msgpack', 'pickle'], help='How to encode river updates in redis. [default: %(default)s]')
+    parser.add_argument('--body-store', default='hash', choices=['hash', 'zlib', 'plain'], help='How to keep the last copy of each feed in redis. [default: %(default)s]')
+    parser.add_argument('--max-body-size', default=32*1024*1024, type=int, help='Give up on feeds bigger than this many bytes. [default: %(default)s]')
+    parser.add_argument('--streaming', action='store_true', help='Parse feeds as they download, stopping once enough entries have been seen before. Needs --body-store hash.')
+    parser.add_argument('--seen-run', default=10, type=int, help='With --streaming, stop reading a feed after this many seen entries in a row. [default: %(default)s]')
+    parser.add_argument('--push-url', help='Public URL that --push-port is reachable at; enables WebSub subscriptions to feeds that name a hub.')
+    parser.add_argument('--push-host', default='0.0.0.0', help='Address to accept WebSub callbacks on. [default: %(default)s]')
+    parser.add_argument('--push-port', default=8112, type=int, help='Port to accept WebSub callbacks on. [default: %(default)s]')
+    parser.add_argument('--push-lease', default=7*24*60*60, type=int, help='Seconds to ask hubs to keep a subscription for. [default: %(default)s]')
+    parser.add_argument('--push-interval', default=6*60*60, type=int, help='Poll feeds that are pushed to us at least this many seconds apart. [default: %(default)s]')
+    parser.add_argument('--metrics-port', default=0, type=int, help='Serve Prometheus metrics on this local port; 0 to disable. [default: %(default)s]')
+    parser.add_argument('--stats-interval', default=60, type=int, help='Write stats to stats:river:<node id> in redis every this many seconds; 0 to disable. [default: %(default)s]')
+    parser.add_argument('--redis-host', default='127.0.0.1', help='Redis host to use. [default: %(default)s]')
+    parser.add_argument('--redis-port', default=6379, type=int, help='Redis port to use. [default: %(default)s]')
+    parser.add_argument('--redis-db', default=0, type=int, help='Redis DB to use. [default: %(default)s]')
+    parser.add_argument('--writers', default=1, type=int, help='Split updated rivers between this many river-writer processes. [default: %(default)s]')
+    parser.add_argument('--sqlite', help='Keep everything in this SQLite database instead of redis, and write the rivers from this process too.')
+    parser.add_argument('--record', help='Append every feed download to this archive file for --replay.')
+    parser.add_argument('--replay', help='Check the feeds downloaded in this archive file instead of the network, write the rivers and exit.')
+    parser.add_argument('--replay-speed', default=0, type=float, help='With --replay, check feeds at the pace they were recorded (1) or this many times faster; 0 for as fast as possible. [default: %(default)s]')
+    parser.add_argument('--profile', help='With --replay, write a cProfile profile of each stage to this directory.')
+    parser.add_argument('feeds', help='Subscription list to use. Accepts URLs and filenames.')
+    add_writer_arguments(parser.add_argument_group('writing rivers with --sqlite or --replay'))
+    return parser
+
+def main():
+    args = river_parser().parse_args()
+
+    if args.streaming and args.body_store != 'hash':
+        raise SystemExit('--streaming never has the whole body to store; use --body-store hash. Exiting.')
+    if args.sqlite and args.distributed:
+        raise SystemExit('--sqlite can only be used by one process; it can\'t be --distributed. Exiting.')
+    if args.sqlite and not args.replay and not args.bucket and not args.output:
+        raise SystemExit('--sqlite writes the rivers itself; it needs either a -b/--bucket or -o/--output directory. Exiting.')
+    if args.sqlite and args.writers != 1:
+        raise SystemExit('--sqlite writes every river from this process; it can\'t have --writers. Exiting.')
+    if args.sqlite and args.engine == 'gevent':
+        # Waiting on the database would block every greenlet.
+        raise SystemExit('--sqlite only works with --engine threads. Exiting.')
+    if args.record and args.streaming:
+        raise SystemExit('--record needs the whole body of every feed; it can\'t be used with --streaming. Exiting.')
+    if args.replay and (args.record or args.distributed or args.push_url):
+        raise SystemExit('--replay can\'t be used with --record, --distributed or --push-url. Exiting.')
+    if args.profile and not args.replay:
+        raise SystemExit('--profile only works with --replay. Exiting.')
+
+    # Start the parsing processes before any threads.
+    parser = feed_parser(args.parse_workers, StageTimings(profiler=StageProfiler() if args.profile else None))
+
+    redis_client = open_storage(args)
+    if not args.sqlite:
+        check_redis_version(redis_client)
+    try:
+        run(args, parser, redis_client)
+    finally:
+        # With --sqlite, whatever hasn't been committed yet.
+        close_storage()
+
+def run(args, parser, redis_client):
+    """
+    Check feeds with `parser' and keep track of them in `redis_client'
+    until killed, or with --replay until the archive runs out.
+    """
+    if args.read_pickle:
+        allow_pickle()
+    codec = get_codec(args.codec)
+
+    subscriptions = SubscriptionList(args.feeds, args.list_cache, args.list_workers)
+    rivers = subscriptions.read()
+    (added, removed) = sync_subscriptions(redis_client, rivers)
+    total_feeds = sum(len(river['feeds']) for river in rivers)
+
+    rivers.append(FIREHOSE)
+    logger.info('In total, found %d categories (%d feeds, %d new, %d dropped)' % (len(rivers), total_feeds, added, removed))
+
+    store = river_store(redis_client, args)
     for river in rivers:
-        for feed_url in river['feeds']:
-            redis_client.sadd('%s:rivers' % feed_url, river['name'])
-            if redis_client.zrank('next_check', feed_url) is None:
-                redis_client.zadd('next_check', feed_url, -1)
-        total_feeds += len(river['feeds'])
-
-    rivers.append({'title': 'Firehose', 'name': 'firehose'})
-    logger.info('In total, found %d categories (%d feeds)' % (len(rivers), total_feeds))
-
-    for t in xrange(args.threads):
-        p = ParseFeed(inbox, args)
-        p.daemon = True
-        p.start()
-
-    while True:
-        for feed_url in outdated_feeds(redis_client):
-            inbox.put(feed_url)
-        inbox.join()
-
-        update_msg = {
-            'available_rivers': rivers,
-            'updated_rivers': redis_client.smembers('updated_rivers'),
-        }
-        redis_client.publish('update:%d' % args.redis_db, cPickle.dumps(update_msg))
-
-        for (feed_url, timestamp) in upcoming_feeds(redis_client):
-            obj = arrow.get(timestamp).to('local')
-            future = obj - arrow.utcnow()
-            logger.debug((feed_url, obj, future.seconds))
-
-        logger.debug('')
-        time.sleep(15)
+        moved = store.adopt_legacy(river['name'])
+        if moved:
+            logger.info('Moved %d updates in %s into time buckets' % (moved, river['name']))
+
+    if args.replay:
+        replay(args, redis_client, rivers, codec, parser)
+        return
+
+    if args.engine == 'gevent':
+        inbox = GeventEngine(args, parser)
+    else:
+        inbox = Queue.Queue(args.threads * 2)
+        for t in xrange(args.threads):
+            p = ParseFeed(inbox, args, parser=parser)
+            p.daemon = True
+            p.start()
+
+    # After gevent has patched the socket module, if it's going to.
+    time_sockets()
+    REGISTRY.gauge('inbox_depth', inbox.qsize)
+    if args.engine == 'gevent':
+        REGISTRY.gauge('checks_running', inbox.running)
+    if args.push_url:
+        serve_push(args.push_port, args.push_host, ParseFeed(None, args, parser=parser))
+    if args.metrics_port:
+        serve_metrics(args.metrics_port)
+    if args.stats_interval:
+        report_stats(redis_client, 'stats:river:%s' % args.node_id, args.stats_interval)
+
+    UpdateStream(redis_client, codec, args.writers).announce()
+    if args.sqlite:
+        # Nothing outside this process can reach the database.
+        messages = UpdateReader(redis_client).messages(args.debounce)
+        writer = threading.Thread(target=write_rivers, args=(redis_client, messages, output_destinations(args), args))
+        writer.daemon = True
+        writer.start()
+
+    scheduler = Scheduler(redis_client, inbox, args, rivers, codec, parser.timings,
+                          subscriptions if args.reload_interval else None)
+    scheduler.run()
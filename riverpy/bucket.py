@@ -1,21 +1,109 @@
 import boto
+import gzip
 import time
+import hashlib
 import logging
+import threading
+from StringIO import StringIO
 from boto.s3.key import Key
+from boto.s3.connection import OrdinaryCallingFormat
+from multiprocessing.pool import ThreadPool
 
 logger = logging.getLogger(__name__)
 
+def gzip_string(string):
+    """
+    Gzip `string' with a fixed mtime so the same input always gives
+    the same bytes (and the same ETag).
+    """
+    buf = StringIO()
+    fp = gzip.GzipFile(fileobj=buf, mode='wb', mtime=0)
+    fp.write(string)
+    fp.close()
+    return buf.getvalue()
+
 class Bucket(object):
-    def __init__(self, bucket_name):
-        conn = boto.connect_s3()
-        self.bucket = conn.lookup(bucket_name)
-        if self.bucket is None:
+    """
+    An S3 bucket that only uploads keys whose contents changed.
+
+    Every thread gets its own connection (boto connections aren't
+    thread-safe), and each connection keeps its HTTP connections
+    alive between uploads.
+    """
+    def __init__(self, bucket_name, host=None, port=None, secure=True, compress=False, workers=8):
+        self.bucket_name = bucket_name
+        self.conn_kwargs = {'is_secure': secure}
+        if host is not None:
+            # S3-compatible stand-ins don't do virtual-host buckets.
+            self.conn_kwargs.update(host=host, calling_format=OrdinaryCallingFormat())
+        if port is not None:
+            self.conn_kwargs['port'] = port
+        self.compress = compress
+        self.local = threading.local()
+        self.pool = ThreadPool(workers)
+
+        conn = self.connect()
+        bucket = conn.lookup(bucket_name)
+        if bucket is None:
             logger.debug("%s doesn't exist, creating" % bucket_name)
-            self.bucket = conn.create_bucket(bucket_name)
+            bucket = conn.create_bucket(bucket_name)
+        self.local.bucket = bucket
 
-    def write_string(self, path, string, content_type=None):
-        key = Key(self.bucket, path)
+        # ETags of what's already up there, so unchanged keys can be
+        # skipped.
+        self.etags = dict((key.name, key.etag.strip('"')) for key in bucket.list())
+
+    def connect(self):
+        return boto.connect_s3(**self.conn_kwargs)
+
+    @property
+    def bucket(self):
+        if getattr(self.local, 'bucket', None) is None:
+            self.local.bucket = self.connect().get_bucket(self.bucket_name, validate=False)
+        return self.local.bucket
+
+    def write_string(self, path, string, content_type=None, cache_control=None):
+        """
+        Upload `string' to `path' unless it's already there. Returns
+        True if anything was uploaded.
+        """
         headers = {}
         if content_type is not None:
             headers['Content-Type'] = content_type
-        key.set_contents_from_string(string, headers=headers, policy='public-read')
+        if cache_control is not None:
+            headers['Cache-Control'] = cache_control
+        if self.compress:
+            string = gzip_string(string)
+            headers['Content-Encoding'] = 'gzip'
+
+        md5 = hashlib.md5(string)
+        if self.etags.get(path) == md5.hexdigest():
+            logger.debug('%s is unchanged, skipping' % path)
+            return False
+
+        key = Key(self.bucket, path)
+        key.set_contents_from_string(string, headers=headers, policy='public-read',
+                                     md5=(md5.hexdigest(), md5.digest().encode('base64').strip()))
+        self.etags[path] = md5.hexdigest()
+        return True
+
+    def write_many(self, items):
+        """
+        Upload a batch of (path, string, content_type) in parallel,
+        optionally followed by a Cache-Control value. Returns how many
+        were actually uploaded.
+        """
+        start = time.time()
+        uploaded = self.pool.map(lambda item: self.write_string(*item), items)
+        logger.info('Uploaded %d of %d keys to %s in %.2fs' % (
+            sum(uploaded), len(items), self.bucket_name, time.time() - start))
+        return sum(uploaded)
+
+    def delete_many(self, keys):
+        """
+        Delete `keys' (up to 1000 per request).
+        """
+        for n in xrange(0, len(keys), 1000):
+            self.bucket.delete_keys(keys[n:n + 1000], quiet=True)
+        for key in keys:
+            self.etags.pop(key, None)
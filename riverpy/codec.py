@@ -0,0 +1,101 @@
+import json
+import cPickle
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+class JSONCodec(object):
+    """
+    Stores updates as the JSON that ends up in river.js, so the
+    writer can splice them in without decoding anything.
+    """
+    name = 'json'
+
+    def dumps(self, obj):
+        return json.dumps(obj, sort_keys=True)
+
+    def loads(self, data):
+        return json.loads(data)
+
+    def to_json(self, data):
+        return data
+
+class MsgpackCodec(object):
+    name = 'msgpack'
+
+    def __init__(self):
+        if msgpack is None:
+            raise SystemExit('The msgpack codec requires msgpack-python to be installed. Exiting.')
+
+    def dumps(self, obj):
+        return msgpack.packb(obj)
+
+    def loads(self, data):
+        return msgpack.unpackb(data, encoding='utf-8')
+
+    def to_json(self, data):
+        return json.dumps(self.loads(data), sort_keys=True)
+
+class PickleCodec(object):
+    """
+    What riverpy used to store. Kept so older databases can still be
+    read, but only once it's asked for: see allow_pickle().
+    """
+    name = 'pickle'
+
+    def dumps(self, obj):
+        return cPickle.dumps(obj)
+
+    def loads(self, data):
+        return cPickle.loads(data)
+
+    def to_json(self, data):
+        return json.dumps(self.loads(data), sort_keys=True)
+
+CODECS = {
+    'json': JSONCodec,
+    'msgpack': MsgpackCodec,
+    'pickle': PickleCodec,
+}
+
+_codecs = {}
+
+def get_codec(name):
+    if name not in _codecs:
+        _codecs[name] = CODECS[name]()
+    return _codecs[name]
+
+def allow_pickle():
+    """
+    Let loads() and to_json() read pickled updates. Unpickling runs
+    whatever the data tells it to, so anything that can write to
+    redis could run code here; it's only done when asked for.
+    """
+    get_codec('pickle')
+
+def codec_for(data):
+    """
+    Return the codec that wrote `data'.
+
+    Everything stored is a dict: JSON starts with '{', msgpack with a
+    map header (0x80-0x8f, 0xde or 0xdf) and a protocol 0 pickle with
+    '('.
+    """
+    first = data[:1]
+    if first == '{':
+        return get_codec('json')
+    elif first == '(':
+        if 'pickle' not in _codecs:
+            raise ValueError('refusing to unpickle %r without --read-pickle' % data[:16])
+        return _codecs['pickle']
+    elif '\x80' <= first <= '\x8f' or first in ('\xde', '\xdf'):
+        return get_codec('msgpack')
+    raise ValueError('unrecognized encoding: %r' % data[:16])
+
+def loads(data):
+    return codec_for(data).loads(data)
+
+def to_json(data):
+    return codec_for(data).to_json(data)
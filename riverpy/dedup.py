@@ -0,0 +1,206 @@
+import time
+import hashlib
+import logging
+
+from storage import local_script
+
+logger = logging.getLogger(__name__)
+
+class SeenIndex(object):
+    """
+    Remembers the fingerprints of the last `limit' entries seen in
+    each feed.
+
+    Every lookup and every add is one pipelined round trip no matter
+    how many entries the feed has.
+    """
+    def __init__(self, redis_client, limit=1000):
+        self.redis_client = redis_client
+        self.limit = limit
+
+    def legacy_key(self, feed_url):
+        return '%s:entries' % feed_url
+
+    def migrate_legacy(self, feed_url):
+        """
+        Seed the index from the old `<url>:entries' list, if there is
+        one. Returns True if anything was migrated.
+        """
+        legacy_key = self.legacy_key(feed_url)
+        fingerprints = self.redis_client.lrange(legacy_key, 0, -1)
+        if not fingerprints:
+            return False
+        logger.debug('Migrating %d fingerprints for %s' % (len(fingerprints), feed_url))
+        # The list is newest-first; add oldest-first so the insert
+        # order is kept.
+        pipe = self.redis_client.pipeline()
+        self.add(feed_url, list(reversed(fingerprints)), pipe)
+        pipe.delete(legacy_key)
+        pipe.execute()
+        return True
+
+    def lookup(self, feed_url, fingerprints):
+        """
+        Return (new_feed, seen) where new_feed is True if nothing has
+        ever been recorded for this feed and seen is a list of bools
+        matching `fingerprints'.
+        """
+        pipe = self.redis_client.pipeline(transaction=False)
+        self.queue_lookup(pipe, feed_url, fingerprints)
+        pipe.exists(self.legacy_key(feed_url))
+        results = pipe.execute()
+        (new_feed, seen) = self.read_lookup(results[:-1], fingerprints)
+        if new_feed and results[-1] and self.migrate_legacy(feed_url):
+            return self.lookup(feed_url, fingerprints)
+        return (new_feed, seen)
+
+    def watch(self, pipe, feed_url):
+        """
+        WATCH on `pipe' whatever every add to this feed writes, so a
+        transaction queued after a lookup fails if another check
+        recorded entries in between.
+        """
+        pipe.watch(*self.watched_keys(feed_url))
+
+    def add(self, feed_url, fingerprints, pipe=None):
+        """
+        Record `fingerprints' (oldest first) as seen.
+
+        If `pipe' is given the commands are only queued on it and it's
+        up to the caller to execute it.
+        """
+        if not fingerprints:
+            return
+        if pipe is None:
+            pipe = self.redis_client.pipeline()
+            self.queue_add(pipe, feed_url, fingerprints)
+            pipe.execute()
+        else:
+            self.queue_add(pipe, feed_url, fingerprints)
+
+class SortedSetIndex(SeenIndex):
+    """
+    Fingerprints live in a sorted set scored by when they were first
+    seen so the oldest can be trimmed.
+    """
+    def key(self, feed_url):
+        return '%s:seen' % feed_url
+
+    def watched_keys(self, feed_url):
+        return [self.key(feed_url)]
+
+    def queue_lookup(self, pipe, feed_url, fingerprints):
+        key = self.key(feed_url)
+        pipe.zcard(key)
+        for fingerprint in fingerprints:
+            pipe.zscore(key, fingerprint)
+
+    def read_lookup(self, results, fingerprints):
+        return (results[0] == 0, [score is not None for score in results[1:]])
+
+    def queue_add(self, pipe, feed_url, fingerprints):
+        key = self.key(feed_url)
+        now = time.time()
+        pairs = []
+        for (n, fingerprint) in enumerate(fingerprints):
+            # Spread scores out slightly so entries added in the same
+            # batch still trim in order.
+            pairs.extend([fingerprint, now + n * 1e-6])
+        pipe.zadd(key, *pairs)
+        pipe.zremrangebyrank(key, 0, -(self.limit + 1))
+
+# KEYS: current, previous, count
+# ARGV: limit, number of fingerprints, bit offsets...
+BLOOM_ADD = """
+local count = redis.call('INCRBY', KEYS[3], ARGV[2])
+if count > tonumber(ARGV[1]) then
+    if redis.call('EXISTS', KEYS[1]) == 1 then
+        redis.call('RENAME', KEYS[1], KEYS[2])
+    end
+    redis.call('SET', KEYS[3], ARGV[2])
+end
+for i = 3, #ARGV do
+    redis.call('SETBIT', KEYS[1], ARGV[i], 1)
+end
+"""
+
+@local_script(BLOOM_ADD)
+def bloom_add(client, keys, args):
+    count = client.incrby(keys[2], args[1])
+    if count > int(args[0]):
+        if client.exists(keys[0]):
+            client.rename(keys[0], keys[1])
+        client.set(keys[2], args[1])
+    for offset in args[2:]:
+        client.setbit(keys[0], offset, 1)
+
+class BloomIndex(SeenIndex):
+    """
+    Fingerprints are hashed into a pair of Bloom filters. Once the
+    current filter has taken `limit' fingerprints it becomes the
+    previous one and a fresh filter is started, so memory stays
+    bounded and roughly the last `limit' to 2*`limit' entries are
+    remembered.
+
+    Ten bits and seven hashes per entry keep false positives under
+    1%. There are never false negatives.
+    """
+    bits_per_entry = 10
+    hashes = 7
+
+    def __init__(self, redis_client, limit=1000):
+        SeenIndex.__init__(self, redis_client, limit)
+        self.size = self.limit * self.bits_per_entry
+        self.bloom_add = redis_client.register_script(BLOOM_ADD)
+
+    def keys(self, feed_url):
+        return ('%s:bloom:current' % feed_url,
+                '%s:bloom:previous' % feed_url,
+                '%s:bloom:count' % feed_url)
+
+    def watched_keys(self, feed_url):
+        # Every add counts its fingerprints in here.
+        return [self.keys(feed_url)[2]]
+
+    def offsets(self, fingerprint):
+        if isinstance(fingerprint, unicode):
+            fingerprint = fingerprint.encode('utf-8', 'ignore')
+        digest = hashlib.sha1(fingerprint).hexdigest()
+        (h1, h2) = (int(digest[:16], 16), int(digest[16:32], 16))
+        return [(h1 + n * h2) % self.size for n in xrange(self.hashes)]
+
+    def queue_lookup(self, pipe, feed_url, fingerprints):
+        (current, previous, count) = self.keys(feed_url)
+        pipe.exists(count)
+        for fingerprint in fingerprints:
+            for offset in self.offsets(fingerprint):
+                pipe.getbit(current, offset)
+            for offset in self.offsets(fingerprint):
+                pipe.getbit(previous, offset)
+
+    def read_lookup(self, results, fingerprints):
+        seen = []
+        for n in xrange(len(fingerprints)):
+            start = 1 + n * self.hashes * 2
+            in_current = all(results[start:start + self.hashes])
+            in_previous = all(results[start + self.hashes:start + self.hashes * 2])
+            seen.append(in_current or in_previous)
+        return (not results[0], seen)
+
+    def queue_add(self, pipe, feed_url, fingerprints):
+        offsets = []
+        for fingerprint in fingerprints:
+            offsets.extend(self.offsets(fingerprint))
+        self.bloom_add(
+            keys=self.keys(feed_url),
+            args=[self.limit, len(fingerprints)] + offsets,
+            client=pipe,
+        )
+
+INDEXES = {
+    'zset': SortedSetIndex,
+    'bloom': BloomIndex,
+}
+
+def seen_index(redis_client, kind='zset', limit=1000):
+    return INDEXES[kind](redis_client, limit)
@@ -0,0 +1,76 @@
+import os
+import hashlib
+import logging
+import tempfile
+from path import path
+
+from bucket import gzip_string
+
+logger = logging.getLogger(__name__)
+
+class Directory(object):
+    """
+    A local output directory that files are swapped into atomically,
+    so a web server never serves a half-written file.
+
+    Files whose contents haven't changed aren't rewritten.
+    """
+    def __init__(self, directory, compress=False):
+        self.directory = path(directory)
+        self.directory.makedirs_p()
+        self.compress = compress
+        self.hashes = {}
+
+    def unchanged(self, fname, digest):
+        if fname not in self.hashes and fname.isfile():
+            with fname.open('rb') as fp:
+                self.hashes[fname] = hashlib.sha1(fp.read()).hexdigest()
+        return self.hashes.get(fname) == digest
+
+    def replace(self, fname, data):
+        (fd, tmp) = tempfile.mkstemp(dir=fname.parent, prefix='.%s.' % fname.name)
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(data)
+            # mkstemp creates files only the owner can read.
+            os.chmod(tmp, 0644)
+            os.rename(tmp, fname)
+        except:
+            os.unlink(tmp)
+            raise
+
+    def write_string(self, key, string, content_type=None, cache_control=None):
+        """
+        Write `string' to `key' under the directory unless it's
+        already there. Returns True if anything was written.
+
+        Headers like `cache_control' are up to the web server.
+        """
+        fname = self.directory.joinpath(key)
+        digest = hashlib.sha1(string).hexdigest()
+        if self.unchanged(fname, digest):
+            logger.debug('%s is unchanged, skipping' % key)
+            return False
+
+        fname.parent.makedirs_p()
+        self.replace(fname, string)
+        if self.compress:
+            # For servers that can send a pre-compressed sibling
+            # (e.g., nginx's gzip_static).
+            self.replace(path(fname + '.gz'), gzip_string(string))
+        self.hashes[fname] = digest
+        return True
+
+    def write_many(self, items):
+        written = 0
+        for item in items:
+            written += self.write_string(*item)
+        return written
+
+    def delete_many(self, keys):
+        for key in keys:
+            fname = self.directory.joinpath(key)
+            for stale in (fname, path(fname + '.gz')):
+                if stale.isfile():
+                    stale.remove()
+            self.hashes.pop(fname, None)
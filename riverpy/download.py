@@ -1,267 +1,585 @@
 import sys
+import time
+import zlib
 import redis
 import arrow
-import random
-import bleach
 import logging
-import cPickle
+import socket
 import hashlib
+import itertools
 import requests
 import threading
-import feedparser
-from datetime import datetime, timedelta
+from datetime import timedelta
+from codec import get_codec
+from metrics import REGISTRY
+from dedup import seen_index
+from parse import InlineParser
+from stream import FeedStream, read_content, discard, release_when_read
+from scheduler import notify_checked, lease_key
+from storage import open_storage
+from recording import open_recorder
+from timeline import river_store
+from push import PushSubscriber, push_key
+from interval import IntervalModel, rate_key
+from politeness import HostLimiter, RetryLater, feed_host, parse_retry_after, backoff_delay
 from utils import format_timestamp
 
 logger = logging.getLogger(__name__)
 
+# Stored alongside the response headers in http:headers:<url>.
+BODY_HASH = 'riverpy-body-sha1'
+
+# First byte of a zlib stream at the default compression level.
+ZLIB_HEADER = '\x78'
+
+def stats_key(feed_url):
+    return '%s:stats' % feed_url
+
 class ParseFeed(threading.Thread):
-    def __init__(self, inbox, args):
+    def __init__(self, inbox, args, session=None, parser=None):
         threading.Thread.__init__(self)
         self.inbox = inbox
         self.cli_args = args
-        self.redis_client = redis.Redis(
-            host=args.redis_host,
-            port=args.redis_port,
-            db=args.redis_db,
-        )
+        self.redis_client = open_storage(args)
 
-    def entry_timestamp(self, entry):
-        """
-        Return an entry's timestamp as best that can be figured.
+        # Reuse connections to the same host across checks.
+        self.session = session or requests.Session()
+        self.seen_index = seen_index(self.redis_client, args.dedup)
+        self.codec = get_codec(args.codec)
+        self.river_store = river_store(self.redis_client, args)
 
-        If no timestamp can be found, return the current time.
-        """
-        for key in ['published_parsed', 'updated_parsed', 'created_parsed']:
-            if key not in entry: continue
-            if entry[key] is None: continue
-            val = (entry[key])[:6]
-            reported_timestamp = arrow.get(datetime(*val))
-            if reported_timestamp < arrow.utcnow():
-                return reported_timestamp
-        return arrow.utcnow()
-
-    def clean_text(self, text, limit=280, suffix='&nbsp;...'):
-        cleaned = bleach.clean(text, tags=[], strip=True).strip()
-        if len(cleaned) > limit:
-            return ''.join(cleaned[:limit]) + suffix
+        if args.push_url:
+            self.push = PushSubscriber(self.redis_client, self.session, args.push_url,
+                                       args.push_lease, args.push_interval)
         else:
-            return cleaned
+            self.push = None
+
+        self.interval_model = IntervalModel(
+            min_interval=args.min_interval,
+            max_interval=args.max_interval,
+            halflife=args.rate_halflife,
+            target=args.target_items,
+        )
 
-    def entry_fingerprint(self, entry):
-        if entry.get('guid'):
-            return entry.get('guid')
+        # Shared through redis with every other worker.
+        if args.host_concurrency or args.host_rate:
+            self.host_limiter = HostLimiter(self.redis_client, args.host_concurrency, args.host_rate)
         else:
-            s = ''.join([
-                entry.get('title', ''),
-                entry.get('link', ''),
-            ])
-            s = s.encode('utf-8', 'ignore')
-            return hashlib.sha1(s).hexdigest()
-
-    def new_entry(self, feed_key, entry):
-        """
-        Return True if this entry hasn't been seen before in this feed.
+            self.host_limiter = None
+
+        # Shared between all the workers so the timings add up.
+        self.parser = parser or InlineParser()
+        self.timings = self.parser.timings
+
+        self.recorder = open_recorder(args.record) if args.record else None
+
+    def new_entries(self, feed_url, entries):
         """
-        return (self.entry_fingerprint(entry) not in
-                set(self.redis_client.lrange(feed_key, 0, -1)))
+        Return (new_feed, entries) where entries are the ones that
+        haven't been seen before in this feed.
 
-    def add_feed_entry(self, feed_key, entry, limit=1000):
+        All entries are checked in a single round trip.
         """
-        Add the entry to the feed key, capping at `limit'.
+        fingerprints = [entry['fingerprint'] for entry in entries]
+        (new_feed, seen) = self.seen_index.lookup(feed_url, fingerprints)
+
+        unseen = []
+        batch = set()
+        for (entry, fingerprint, was_seen) in zip(entries, fingerprints, seen):
+            # Feeds occasionally repeat an entry within one document.
+            if was_seen or fingerprint in batch:
+                continue
+            batch.add(fingerprint)
+            unseen.append(entry)
+        return (new_feed, unseen)
+
+    def stream_entries(self, feed_url, stream):
         """
-        entry_key = self.entry_fingerprint(entry)
-        self.redis_client.lpush(feed_key, entry_key)
-        self.redis_client.ltrim(feed_key, 0, limit - 1)
-
-    def populate_feed_update(self, entry):
-        obj = {
-            'id': str(self.redis_client.incr('id-generator')),
-            'pubDate': format_timestamp(self.entry_timestamp(entry)),
-        }
+        Return (parsed, new_feed, entries) for a FeedStream, where
+        parsed is how many entries were read and entries are the ones
+        that haven't been seen before.
+
+        Entries are looked up in batches as they're parsed. Feeds list
+        their newest entries first, so reading stops once --seen-run
+        entries in a row have been seen before, or after the first
+        batch of a new feed as only --initial of those are kept.
+        """
+        batch_size = max(25, self.cli_args.initial)
+        seen_run = self.cli_args.seen_run
+        (parsed, new_feed, run) = (0, False, 0)
+        unseen = []
+        batch = set()
+        entries = iter(stream)
+        try:
+            while run < seen_run:
+                with self.timings.stage('parse'):
+                    chunk = list(itertools.islice(entries, batch_size))
+                if not chunk:
+                    break
+                parsed += len(chunk)
 
-        # If both <title> and <description> exist:
-        #   title -> <title>
-        #   body -> <description>
-        if entry.get('title') and entry.get('description'):
-            obj['title'] = self.clean_text(entry.get('title'))
-            obj['body'] = self.clean_text(entry.get('description'))
+                with self.timings.stage('dedup'):
+                    (new_feed, seen) = self.seen_index.lookup(feed_url, [entry['fingerprint'] for entry in chunk])
 
-            # Drop the body if it's just a duplicate of the title.
-            if obj['title'] == obj['body']:
-                obj['body'] == ''
+                for (entry, was_seen) in zip(chunk, seen):
+                    if was_seen:
+                        run += 1
+                        if run >= seen_run:
+                            break
+                        continue
+                    run = 0
+                    if entry['fingerprint'] in batch:
+                        continue
+                    batch.add(entry['fingerprint'])
+                    unseen.append(entry)
 
-        # If <description> exists but <title> doesn't:
-        #   title -> <description>
-        #   body -> ''
-        #
-        # See http://scripting.com/2014/04/07/howToDisplayTitlelessFeedItems.html
-        # for an ad-hoc spec.
-        elif not entry.get('title') and entry.get('description'):
-            obj['title'] = self.clean_text(entry.get('description'))
-            obj['body'] = ''
-
-        # If neither of the above work but <title> exists:
-        #   title -> <title>
-        #   body -> ''
-        #
-        # A rare occurance -- just about everybody uses both <title>
-        # and <description> and those with title-less feeds just use
-        # <description> (in keeping with the RSS spec) -- but the
-        # Nieman Journalism Lab's RSS feed [1] needs this conditional
-        # so I assume it's not the only one out there.
-        #
-        # [1] http://www.niemanlab.org/feed/
-        elif entry.get('title'):
-            obj['title'] = self.clean_text(entry.get('title'))
-            obj['body'] = ''
+                if new_feed:
+                    break
+        finally:
+            stream.close()
 
-        if entry.get('link'):
-            obj['link'] = entry.get('link')
+        if run >= seen_run:
+            logger.debug('Stopped reading %s after %d entries' % (feed_url, parsed))
+        return (parsed, new_feed, unseen)
 
-        if entry.get('comments'):
-            obj['comments'] = entry.get('comments')
+    def add_feed_entries(self, feed_url, entries, pipe=None):
+        """
+        Record all the entries as seen in one batch.
+        """
+        # Entries are listed newest-first, store them oldest-first.
+        fingerprints = [entry['fingerprint'] for entry in reversed(entries)]
+        self.seen_index.add(feed_url, fingerprints, pipe)
 
+    def populate_feed_update(self, update, update_id):
+        obj = {'id': str(update_id)}
+        obj.update(update)
         return obj
 
-    def request_feed(self, feed_url):
+    def cached_response(self, feed_url):
+        """
+        Return (request_headers, body_hash) where request_headers are
+        the If-Modified-Since/If-None-Match headers to send and
+        body_hash is the hash of the last body seen for this feed.
+        """
         headers_key = 'http:headers:%s' % feed_url
-        body_key = 'http:body:%s' % feed_url
-
         request_headers = {}
-        (last_modified, etag) = self.redis_client.hmget(headers_key, 'last-modified', 'etag')
+        (last_modified, etag, body_hash) = self.redis_client.hmget(
+            headers_key, 'last-modified', 'etag', BODY_HASH)
         if last_modified:
             request_headers['If-Modified-Since'] = last_modified
         if etag:
             request_headers['If-None-Match'] = etag
+        return (request_headers, body_hash)
 
-        response = requests.get(feed_url, headers=request_headers, timeout=15, verify=False)
-        response.raise_for_status()
+    def load_body(self, feed_url):
+        body = self.redis_client.get('http:body:%s' % feed_url)
+        if body and body[:1] == ZLIB_HEADER:
+            return zlib.decompress(body)
+        return body
 
-        logger.info('Checked %s (%d)' % (feed_url, response.status_code))
+    def dump_body(self, body):
+        body = body.encode('utf-8')
+        if self.cli_args.body_store == 'zlib':
+            return zlib.compress(body)
+        return body
 
-        self.redis_client.hmset(headers_key, response.headers)
-
-        if response.status_code == 200:
-            self.redis_client.set(body_key, response.text)
-            return response.text
-        elif response.status_code == 304:
-            return self.redis_client.get(body_key)
-
-    def average_update_interval(self, history_timestamps):
-        it = iter(history_timestamps)
-        first = arrow.get(next(it))
-        delta = timedelta()
-        for timestamp in it:
-            delta += (first - arrow.get(timestamp))
-            first = arrow.get(timestamp)
-        return delta / len(history_timestamps)
+    def read_response(self, feed_url, response, body_hash):
+        """
+        Return (feed_content, response_cache). feed_content is None if
+        the feed hasn't changed since the last check.
 
-    def run(self):
-        while True:
-            feed_url = self.inbox.get()
-            try:
-                feed_content = self.request_feed(feed_url)
-            except requests.exceptions.RequestException as ex:
-                logger.exception('Failed to check %s' % feed_url)
-                future = arrow.utcnow() + timedelta(seconds=60*60)
-                fmt = format_timestamp(future.to('local'))
-                logger.info('Next check for %s: %s (%d seconds)' % (feed_url, fmt, 60*60))
-                self.redis_client.zadd('next_check', feed_url, future.timestamp)
-            else:
-                try:
-                    feed_parsed = feedparser.parse(feed_content)
-                except ValueError as ex:
-                    logger.exception('Failed to parse %s' % feed_url)
-                    break
+        response_cache holds what process_feed should store once the
+        check has been committed.
+        """
+        logger.info('Checked %s (%d)' % (feed_url, response.status_code))
+        REGISTRY.incr('responses_total', status=response.status_code)
 
-                feed_key = '%s:entries' % feed_url
-                new_feed = (self.redis_client.llen(feed_key) == 0)
-
-                feed_updates = []
-                timestamps = []
-
-                for entry in feed_parsed.entries:
-                    # We must keep track of feed updates so they're only seen
-                    # once. Here's how that happens:
-                    #
-                    # Redis stores a list at `feed_key` that contains
-                    # the 1000 (by default) most recently seen feed
-                    # update fingerprints. See self.entry_fingerprint
-                    # for how the fingerprint is calculated.
-                    #
-                    # If the fingerprint hasn't been seen before, add it
-                    # to `feed_key`.
-                    #
-                    # If it has, this feed update has already been seen
-                    # so we can skip it.
-                    if self.new_entry(feed_key, entry):
-                        self.add_feed_entry(feed_key, entry)
-                    else:
-                        continue
+        response_cache = {
+            'headers': dict(response.headers),
+            'body': None,
+            'links': response.links,
+        }
 
-                    update = self.populate_feed_update(entry)
-                    feed_updates.append(update)
-                    timestamps.append(self.entry_timestamp(entry))
+        if response.status_code == 304:
+            # Only re-parse an unchanged feed if asked to keep bodies.
+            if self.cli_args.body_store == 'hash':
+                return (None, response_cache)
+            return (self.load_body(feed_url), response_cache)
 
-                timestamp_key = '%s:timestamps' % feed_url
+        digest = hashlib.sha1(response.content).hexdigest()
+        response_cache['headers'][BODY_HASH] = digest
+        if digest == body_hash:
+            logger.debug('%s is unchanged' % feed_url)
+            REGISTRY.incr('unchanged_total')
+            return (None, response_cache)
 
-                # Add any new timestamps found during this check
-                if timestamps:
-                    logger.info('%d new entries for %s' % (len(timestamps), feed_url))
-                    new_timestamps = [obj.timestamp for obj in timestamps]
-                    self.redis_client.lpush(timestamp_key, *new_timestamps)
-                    self.redis_client.sort(timestamp_key, desc=True, store=timestamp_key)
-                    self.redis_client.ltrim(timestamp_key, 0, 99)
-                else:
-                    logger.info('No new entries for %s' % feed_url)
+        if self.cli_args.body_store != 'hash':
+            response_cache['body'] = self.dump_body(response.text)
+        return (response.text, response_cache)
 
-                history = self.redis_client.lrange(timestamp_key, 0, 9 if timestamps else 8)
-                if not timestamps:
-                    # See http://goo.gl/X6QhWN for why we do this
-                    history.insert(0, arrow.utcnow().timestamp)
+    def request_feed(self, feed_url):
+        (request_headers, body_hash) = self.cached_response(feed_url)
+        start = time.time()
+        try:
+            response = self.session.get(feed_url, headers=request_headers, timeout=15, verify=False, stream=True)
+        except requests.exceptions.RequestException as ex:
+            if self.recorder is not None:
+                self.recorder.record_error(feed_url, start, ex)
+            raise
+
+        # requests stops the clock on `elapsed' once the headers are
+        # in; the rest is reading the body.
+        first_byte = response.elapsed.total_seconds()
+        self.timings.record('fetch-headers', first_byte)
+
+        if response.status_code >= 400 and self.recorder is not None:
+            # Only the status and headers matter; the body's thrown
+            # away.
+            self.recorder.record_response(feed_url, start, first_byte, response, '')
+        if response.status_code in (429, 503):
+            discard(response)
+            REGISTRY.incr('responses_total', status=response.status_code)
+            retry_after = parse_retry_after(response.headers.get('retry-after'))
+            raise RetryLater(retry_after, '%d from %s' % (response.status_code, feed_url), response=response)
+        if response.status_code >= 400:
+            discard(response)
+            response.raise_for_status()
+
+        if self.cli_args.streaming and response.status_code == 200:
+            # The body is read as it's parsed, which is timed as part
+            # of parsing.
+            logger.info('Checked %s (%d)' % (feed_url, response.status_code))
+            REGISTRY.incr('responses_total', status=response.status_code)
+            feed_content = FeedStream(response, self.cli_args.max_body_size)
+            response_cache = {'headers': dict(response.headers), 'body': None, 'links': response.links}
+            response_cache['stats'] = {
+                'status': response.status_code,
+                'fetch-headers': first_byte,
+            }
+            return (feed_content, response_cache)
+
+        try:
+            read_content(response, self.cli_args.max_body_size)
+        except requests.exceptions.RequestException as ex:
+            if self.recorder is not None:
+                self.recorder.record_error(feed_url, start, ex)
+            raise
+        elapsed = time.time() - start
+        if self.recorder is not None:
+            self.recorder.record_response(feed_url, start, first_byte, response, response.content)
+        self.timings.record('fetch', elapsed)
+        self.timings.record('fetch-body', max(0, elapsed - first_byte))
+
+        (feed_content, response_cache) = self.read_response(feed_url, response, body_hash)
+        response_cache['stats'] = {
+            'status': response.status_code,
+            'bytes': len(response.content),
+            'fetch': elapsed,
+            'fetch-headers': first_byte,
+        }
+        return (feed_content, response_cache)
 
-                delta = self.average_update_interval(history)
+    def store_response(self, pipe, feed_url, response_cache):
+        pipe.hmset('http:headers:%s' % feed_url, response_cache['headers'])
+        body_key = 'http:body:%s' % feed_url
+        if response_cache['body'] is not None:
+            pipe.set(body_key, response_cache['body'])
+        elif self.cli_args.body_store == 'hash':
+            # Drop any body stored before switching to --body-store hash.
+            pipe.delete(body_key)
 
-                # Don't check more than once a minute
-                if delta.seconds < 60:
-                    delta = timedelta(seconds=60)
+    def reschedule(self, feed_url, seconds):
+        """
+        Set the next check of a feed that couldn't be checked this
+        time around.
+        """
+        future = arrow.utcnow() + timedelta(seconds=seconds)
+        fmt = format_timestamp(future.to('local'))
+        logger.info('Next check for %s: %s (%d seconds)' % (feed_url, fmt, seconds))
+        pipe = self.redis_client.pipeline()
+        pipe.zadd('next_check', feed_url, future.timestamp)
+        notify_checked(pipe, feed_url, self.cli_args.node_id)
+        pipe.execute()
+
+    def reschedule_failed(self, feed_url, retry_after=None):
+        """
+        Push back the next check of a feed that couldn't be fetched,
+        backing off further each time it fails in a row.
+        """
+        failures = self.redis_client.incr('%s:failures' % feed_url)
+        delay = backoff_delay(failures, self.cli_args.backoff_base, self.cli_args.backoff_max)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        self.reschedule(feed_url, delay)
 
-                # Cap the next check at two hours.
-                elif delta.seconds > (2*60*60):
-                    logger.debug('Randomly scheduling %s' % feed_url)
-                    delta = timedelta(seconds=random.uniform(60*60, 2*60*60))
+    def hold_lease(self, pipe, feed_url):
+        """
+        Start a transaction on `pipe' that only goes through if this
+        node still holds the feed's lease. Returns False (and resets
+        `pipe') if the lease already ran out and another node may be
+        checking the feed.
+        """
+        key = lease_key(feed_url)
+        pipe.watch(key)
+        if pipe.get(key) != self.cli_args.node_id:
+            logger.warning('Lost the lease on %s, dropping check' % feed_url)
+            pipe.reset()
+            return False
+        pipe.multi()
+        pipe.delete(key)
+        return True
+
+    def check_feed(self, feed_url):
+        with self.timings.stage('check'):
+            self.check_host(feed_url)
+
+    def check_host(self, feed_url):
+        host = feed_host(feed_url)
+        release = lambda: None
+        if self.host_limiter is not None:
+            (token, wait) = self.host_limiter.acquire(host)
+            if token is None:
+                logger.debug('Deferring %s for %.1f seconds' % (feed_url, wait))
+                self.reschedule(feed_url, max(1, int(wait + 0.5)))
+                return
+            release = lambda: self.host_limiter.release(host, token)
+
+        try:
+            # With --streaming the host is still being read from
+            # until the body's been parsed.
+            try:
+                (feed_content, response_cache) = self.request_feed(feed_url)
+            except:
+                release()
+                raise
+            release_when_read(feed_content, release)
+        except RetryLater as ex:
+            logger.warning('Asked to back off: %s' % ex)
+            if ex.retry_after and self.host_limiter is not None:
+                self.host_limiter.block(host, ex.retry_after)
+            self.reschedule_failed(feed_url, ex.retry_after)
+        except requests.exceptions.RequestException as ex:
+            logger.exception('Failed to check %s' % feed_url)
+            REGISTRY.incr('errors_total', error=ex.__class__.__name__)
+            self.reschedule_failed(feed_url)
+        else:
+            self.process_feed(feed_url, feed_content, response_cache)
 
-                future_update = arrow.utcnow() + delta
-                fmt = format_timestamp(future_update.to('local'))
+    def process_feed(self, feed_url, feed_content, response_cache=None, leased=True):
+        """
+        Parse the feed content, record any new entries and schedule
+        the next check.
 
-                logger.info('Next check for %s: %s (%d seconds)' % (feed_url, fmt, delta.seconds))
-                self.redis_client.zadd('next_check', feed_url, future_update.timestamp)
+        If feed_content is None the feed is known to be unchanged so
+        it's only rescheduled. Content that was pushed to us rather
+        than downloaded isn't covered by a lease.
+        """
+        stats = dict(response_cache.get('stats', {})) if response_cache else {}
+
+        # A push and a poll of the same feed can be processed at once,
+        # lease or no lease. The feed's seen entries are then watched
+        # from before they're looked up, so if both find an entry
+        # unseen only the first to commit adds it; the other looks its
+        # entries up again. Polls alone never overlap as each feed is
+        # only handed out once.
+        pipe = self.redis_client.pipeline()
+        try:
+            if self.push is not None:
+                self.seen_index.watch(pipe, feed_url)
+            checked = self.read_entries(feed_url, feed_content, stats)
+            if checked is None:
+                return
+            (feed, parsed, new_feed, entries) = checked
+            while True:
+                try:
+                    self.commit_check(pipe, feed_url, feed, parsed, new_feed, entries, stats, response_cache, leased)
+                    return
+                except redis.WatchError:
+                    logger.info('%s was committed by another check, looking up its entries again' % feed_url)
+                    self.seen_index.watch(pipe, feed_url)
+                    (new_feed, entries) = self.new_entries(feed_url, entries)
+        finally:
+            pipe.reset()
+
+    def read_entries(self, feed_url, feed_content, stats):
+        """
+        Return (feed, parsed, new_feed, entries) where parsed is how
+        many entries were read and entries are the ones that haven't
+        been seen before, or None if the feed couldn't be read.
+        """
+        streaming = isinstance(feed_content, FeedStream)
+        if streaming:
+            start = time.time()
+            try:
+                (parsed, new_feed, entries) = self.stream_entries(feed_url, feed_content)
+            except ValueError as ex:
+                logger.exception('Failed to parse %s' % feed_url)
+                REGISTRY.incr('errors_total', error='parse')
+                return None
+            except (requests.exceptions.RequestException, socket.error) as ex:
+                # The body is still being downloaded while it's parsed.
+                logger.exception('Failed to check %s' % feed_url)
+                REGISTRY.incr('errors_total', error=ex.__class__.__name__)
+                self.reschedule_failed(feed_url)
+                return None
+            stats['parse'] = time.time() - start
+            stats['bytes'] = feed_content.size
+            return (feed_content.feed, parsed, new_feed, entries)
+
+        if feed_content is None:
+            (feed, parsed_entries) = ({}, [])
+        else:
+            start = time.time()
+            try:
+                (feed, parsed_entries) = self.parser.parse(feed_content)
+            except ValueError as ex:
+                logger.exception('Failed to parse %s' % feed_url)
+                REGISTRY.incr('errors_total', error='parse')
+                return None
+            stats['parse'] = time.time() - start
+
+        # We must keep track of feed updates so they're only seen
+        # once. Here's how that happens:
+        #
+        # Redis remembers the fingerprints of the 1000 (by default)
+        # most recently seen feed updates. See
+        # riverpy.parse.entry_fingerprint for how the fingerprint is
+        # calculated and riverpy.dedup for how they're stored.
+        #
+        # Every entry in the feed is checked against it at once and
+        # only the ones that haven't been seen before are kept. Those
+        # are then recorded so they'll be skipped next time. With
+        # --streaming that already happened a batch at a time as the
+        # feed was read.
+        if parsed_entries:
+            start = time.time()
+            with self.timings.stage('dedup'):
+                (new_feed, entries) = self.new_entries(feed_url, parsed_entries)
+            stats['dedup'] = time.time() - start
+        else:
+            (new_feed, entries) = (False, [])
+        return (feed, len(parsed_entries), new_feed, entries)
 
-                # Keep --initial most recent updates if this is the
-                # first time we've seen the feed
-                if new_feed:
-                    feed_updates = feed_updates[:self.cli_args.initial]
-
-                if feed_updates:
-                    river_update = {
-                        'feedDescription': feed_parsed.feed.get('description', ''),
-                        'feedTitle': feed_parsed.feed.get('title', ''),
-                        'feedUrl': feed_url,
-                        'item': feed_updates,
-                        'websiteUrl': feed_parsed.feed.get('link', ''),
-                        'whenLastUpdate': format_timestamp(arrow.utcnow()),
-                    }
-
-                    for river_name in self.redis_client.smembers('%s:rivers' % feed_url):
-                        river_key = 'rivers:%s' % river_name
-                        self.redis_client.lpush(river_key, cPickle.dumps(river_update))
-                        self.redis_client.ltrim(river_key, 0, self.cli_args.entries - 1)
-                        self.redis_client.sadd('updated_rivers', river_name)
-
-                    firehose_key = 'rivers:firehose'
-                    self.redis_client.lpush(firehose_key, cPickle.dumps(river_update))
-                    self.redis_client.ltrim(firehose_key, 0, self.cli_args.entries - 1)
-                    self.redis_client.sadd('updated_rivers', 'firehose')
+    def commit_check(self, pipe, feed_url, feed, parsed, new_feed, entries, stats, response_cache, leased):
+        """
+        Record the new `entries' and schedule the next check in one
+        MULTI/EXEC on `pipe'. Raises redis.WatchError if `pipe' is
+        watching the feed's seen entries and another check recorded
+        some first.
+        """
+        # Keep --initial most recent updates if this is the
+        # first time we've seen the feed
+        updated_entries = entries[:self.cli_args.initial] if new_feed else entries
+
+        # Only read by older versions of riverpy; used to seed the
+        # interval model for feeds it hasn't seen yet.
+        timestamp_key = '%s:timestamps' % feed_url
+
+        # Everything that needs reading happens in one round trip,
+        # including reserving a block of ids for the new updates.
+        with self.timings.stage('read'):
+            read_pipe = self.redis_client.pipeline(transaction=False)
+            read_pipe.incr('id-generator', len(updated_entries))
+            read_pipe.hgetall(rate_key(feed_url))
+            read_pipe.lrange(timestamp_key, 0, 9)
+            read_pipe.smembers('%s:rivers' % feed_url)
+            read_pipe.hgetall(push_key(feed_url))
+            (last_id, rate_state, history, river_names, push_state) = read_pipe.execute()
+        first_id = last_id - len(updated_entries) + 1
+
+        start = time.time()
+        feed_updates = []
+        for (n, update) in enumerate(self.parser.clean(updated_entries)):
+            feed_updates.append(self.populate_feed_update(update, first_id + n))
+        if updated_entries:
+            stats['clean'] = time.time() - start
+
+        timestamps = [entry['timestamp'] for entry in entries]
+        if timestamps:
+            logger.info('%d new entries for %s' % (len(timestamps), feed_url))
+        else:
+            logger.info('No new entries for %s' % feed_url)
+
+        now = time.time()
+        rate_state = self.interval_model.load(rate_state)
+        if not rate_state and history:
+            rate_state = self.interval_model.update(rate_state, now, [int(timestamp) for timestamp in history], True)
+        rate_state = self.interval_model.update(rate_state, now, timestamps, new_feed)
+        interval = self.interval_model.next_interval(rate_state, now)
+        if self.push is not None and self.push.is_active(push_state, now):
+            # New entries are pushed as they're published, so polling
+            # is only a backstop.
+            interval = max(interval, self.cli_args.push_interval)
+        delta = timedelta(seconds=interval)
+
+        future_update = arrow.utcnow() + delta
+        fmt = format_timestamp(future_update.to('local'))
+        logger.info('Next check for %s: %s (%d seconds)' % (feed_url, fmt, delta.total_seconds()))
+
+        # Everything that needs writing happens in one MULTI/EXEC so
+        # river_writer never sees a half-updated river.
+        with self.timings.stage('commit'):
+            if self.cli_args.distributed and leased:
+                if not self.hold_lease(pipe, feed_url):
+                    return
+            else:
+                pipe.multi()
+
+            self.add_feed_entries(feed_url, entries, pipe)
+            pipe.delete('%s:failures' % feed_url)
+
+            # The response is only cached once the entries it contained
+            # have been recorded, so an interrupted check is retried in
+            # full instead of being skipped as unchanged.
+            if response_cache is not None:
+                self.store_response(pipe, feed_url, response_cache)
+
+            pipe.hmset(rate_key(feed_url), rate_state)
+            if history:
+                pipe.delete(timestamp_key)
+
+            pipe.zadd('next_check', feed_url, future_update.timestamp)
+
+            # How the latest check went, for looking into a single feed.
+            stats.update(checked=int(now), entries=parsed, new=len(entries))
+            pipe.delete(stats_key(feed_url))
+            pipe.hmset(stats_key(feed_url), stats)
+
+            if feed_updates:
+                river_update = {
+                    'feedDescription': feed['description'],
+                    'feedTitle': feed['title'],
+                    'feedUrl': feed_url,
+                    'item': feed_updates,
+                    'websiteUrl': feed['link'],
+                    'whenLastUpdate': format_timestamp(arrow.utcnow()),
+                }
+                serialized = self.codec.dumps(river_update)
+
+                # Old buckets are dropped by the scheduler when it
+                # publishes the update.
+                for river_name in list(river_names) + ['firehose']:
+                    self.river_store.add(pipe, river_name, first_id, serialized, feed_url, now)
+                    pipe.sadd('updated_rivers', river_name)
+
+            notify_checked(pipe, feed_url, self.cli_args.node_id)
+            try:
+                pipe.execute()
+            except redis.WatchError:
+                if self.cli_args.distributed and leased and self.redis_client.get(lease_key(feed_url)) != self.cli_args.node_id:
+                    logger.warning('Lost the lease on %s while committing, dropping check' % feed_url)
+                    return
+                raise
+        REGISTRY.incr('entries_total', len(feed_updates))
+
+        if self.push is not None:
+            links = response_cache.get('links') if response_cache else None
+            self.push.update(feed_url, feed, links, push_state)
 
+    def run(self):
+        while True:
+            feed_url = self.inbox.get()
+            try:
+                self.check_feed(feed_url)
             finally:
                 self.inbox.task_done()
@@ -0,0 +1,98 @@
+import logging
+import requests
+from collections import defaultdict
+
+try:
+    import gevent
+    from gevent import monkey
+    from gevent.pool import Pool
+    from gevent.lock import BoundedSemaphore
+except ImportError:
+    gevent = None
+
+from parse import PoolParser
+from politeness import feed_host
+from stream import release_when_read
+from download import ParseFeed
+
+logger = logging.getLogger(__name__)
+
+class GeventChecker(ParseFeed):
+    """
+    A ParseFeed that's never started as a thread. Downloads are
+    capped per host and given a hard deadline.
+    """
+    def __init__(self, args, session, parser=None):
+        ParseFeed.__init__(self, None, args, session=session, parser=parser)
+        self.host_slots = defaultdict(lambda: BoundedSemaphore(args.per_host))
+
+    def request_feed(self, feed_url):
+        # Stalled hosts trickling bytes would otherwise hold a slot
+        # forever as the requests timeout is per-read. With
+        # --streaming the body is read after this returns, so the slot
+        # and deadline last until it's been read.
+        slot = self.host_slots[feed_host(feed_url)]
+        slot.acquire()
+        deadline = gevent.Timeout(self.cli_args.fetch_timeout, requests.exceptions.Timeout)
+        deadline.start()
+
+        def release():
+            deadline.cancel()
+            slot.release()
+
+        try:
+            (feed_content, response_cache) = ParseFeed.request_feed(self, feed_url)
+        except:
+            release()
+            raise
+        release_when_read(feed_content, release)
+        return (feed_content, response_cache)
+
+class GeventEngine(object):
+    """
+    Check feeds cooperatively on a pool of greenlets.
+
+    Quacks like the Queue.Queue that feeds the ParseFeed threads
+    (put/full/qsize/join) so main() can drive either one.
+    """
+    def __init__(self, args, parser=None):
+        if gevent is None:
+            raise SystemExit('--engine gevent requires gevent to be installed. Exiting.')
+
+        # Leave threading alone; only the blocking I/O needs to yield.
+        monkey.patch_all(thread=False)
+
+        self.pool = Pool(args.concurrency)
+
+        # One keep-alive pool per host, sized to match the host cap.
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=args.concurrency,
+            pool_maxsize=args.per_host,
+        )
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+        self.checker = GeventChecker(args, session, parser)
+
+        # Wait on the parsing processes from a real thread so the
+        # other greenlets keep running.
+        if isinstance(parser, PoolParser):
+            parser.wait = gevent.get_hub().threadpool.apply
+
+    def put(self, feed_url):
+        self.pool.spawn(self.checker.check_feed, feed_url)
+
+    def full(self):
+        return self.pool.full()
+
+    def qsize(self):
+        # Nothing waits in between: put() blocks until a greenlet is
+        # free to check the feed.
+        return 0
+
+    def running(self):
+        return len(self.pool)
+
+    def join(self):
+        self.pool.join()
@@ -0,0 +1,103 @@
+import math
+import time
+import random
+
+class IntervalModel(object):
+    """
+    Decides how long to wait before checking a feed again.
+
+    Each feed's state is a handful of numbers kept in a redis hash
+    (see rate_key) and updated in constant time on every check:
+
+    - `rate': new items per second, as an exponentially weighted
+      average whose weight halves every `halflife' seconds.
+    - `last': when the feed was last checked.
+    - `h0'..`h23': how many items were published in each hour of the
+      day (UTC), halved whenever they add up to `hours_limit', so
+      feeds that only post during office hours are checked less
+      often at night.
+
+    The next check is timed so that about `target' new items are
+    expected by then, kept between `min_interval' and `max_interval'.
+    """
+    hours_limit = 1000
+
+    def __init__(self, min_interval=60, max_interval=2*60*60, halflife=12*60*60, target=1.0):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.halflife = halflife
+        self.target = target
+
+    def load(self, stored):
+        """
+        Turn the hash stored in redis into a state dict.
+        """
+        return dict((key, float(value)) for (key, value) in (stored or {}).items())
+
+    def update(self, state, now, timestamps, new_feed=False):
+        """
+        Return the state after a check at `now' that found new items
+        published at `timestamps'.
+        """
+        state = dict(state)
+        last = state.get('last')
+
+        # The first check turns up a feed's backlog. How far apart
+        # those items were published is the best first guess there is.
+        if 'rate' not in state and len(timestamps) > 1:
+            span = max(timestamps) - min(timestamps)
+            if span > 0:
+                state['rate'] = (len(timestamps) - 1) / float(span)
+        elif last is not None and not new_feed and now > last:
+            elapsed = now - last
+            weight = 1 - math.exp(-elapsed * math.log(2) / self.halflife)
+            observed = len(timestamps) / float(elapsed)
+            state['rate'] = weight * observed + (1 - weight) * state.get('rate', observed)
+        state['last'] = now
+
+        for timestamp in timestamps:
+            hour = 'h%d' % time.gmtime(timestamp).tm_hour
+            state[hour] = state.get(hour, 0) + 1
+        if sum(state.get('h%d' % hour, 0) for hour in xrange(24)) > self.hours_limit:
+            for hour in xrange(24):
+                state['h%d' % hour] = state.get('h%d' % hour, 0) / 2.0
+
+        return state
+
+    def hour_factor(self, state, now):
+        """
+        How much busier than average the feed is at this hour.
+        """
+        counts = [state.get('h%d' % hour, 0) for hour in xrange(24)]
+        total = sum(counts)
+        if not total:
+            return 1.0
+        current = counts[time.gmtime(now).tm_hour]
+        # Smooth towards the average so quiet hours aren't written off
+        # after a handful of items.
+        return (current + 1.0) / (total / 24.0 + 1.0)
+
+    def next_interval(self, state, now):
+        """
+        Return the seconds to wait before the next check.
+        """
+        rate = state.get('rate')
+        if rate is None:
+            return self.min_interval
+
+        predicted = rate * self.hour_factor(state, now)
+        if predicted <= 0:
+            interval = self.max_interval
+        else:
+            interval = self.target / predicted
+
+        if interval < self.min_interval:
+            return self.min_interval
+        elif interval >= self.max_interval:
+            # Spread out the slow feeds so they don't all come due at
+            # once.
+            return random.uniform(self.max_interval / 2.0, self.max_interval)
+        return interval
+
+def rate_key(feed_url):
+    return '%s:rate' % feed_url
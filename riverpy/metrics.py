@@ -0,0 +1,208 @@
+import time
+import socket
+import logging
+import threading
+import BaseHTTPServer
+from SocketServer import ThreadingMixIn
+from contextlib import contextmanager
+from collections import defaultdict
+
+try:
+    import gevent
+    from gevent import monkey
+except ImportError:
+    gevent = None
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (in seconds) of the latency histogram buckets.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for (key, value) in labels)
+
+class Metrics(object):
+    """
+    Thread-safe counters, gauges and latency histograms, named and
+    labelled the way Prometheus expects them.
+    """
+    def __init__(self, prefix='riverpy'):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.counters = defaultdict(float)
+        self.histograms = {}
+        self.gauges = {}
+
+    def key(self, name, labels):
+        return ('%s_%s' % (self.prefix, name), tuple(sorted(labels.items())))
+
+    def incr(self, name, amount=1, **labels):
+        with self.lock:
+            self.counters[self.key(name, labels)] += amount
+
+    def observe(self, name, seconds, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = {'buckets': [0] * len(BUCKETS), 'count': 0, 'sum': 0.0}
+            histogram = self.histograms[key]
+            for (n, bound) in enumerate(BUCKETS):
+                if seconds <= bound:
+                    histogram['buckets'][n] += 1
+            histogram['count'] += 1
+            histogram['sum'] += seconds
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def gauge(self, name, func, **labels):
+        """
+        Report whatever `func' returns whenever the metrics are read.
+        """
+        with self.lock:
+            self.gauges[self.key(name, labels)] = func
+
+    def samples(self):
+        """
+        Yield (name, labels, value) for everything recorded so far.
+        """
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, dict(value, buckets=list(value['buckets'])))
+                                for (key, value) in self.histograms.items())
+            gauges = sorted(self.gauges.items())
+
+        for ((name, labels), value) in counters:
+            yield (name, labels, value)
+        for ((name, labels), func) in gauges:
+            try:
+                yield (name, labels, func())
+            except Exception:
+                logger.exception('Failed to read %s' % name)
+        for ((name, labels), histogram) in histograms:
+            for (bound, count) in zip(BUCKETS, histogram['buckets']):
+                yield (name + '_bucket', labels + (('le', bound),), count)
+            yield (name + '_bucket', labels + (('le', '+Inf'),), histogram['count'])
+            yield (name + '_count', labels, histogram['count'])
+            yield (name + '_sum', labels, histogram['sum'])
+
+    def render(self):
+        """
+        Return everything in the Prometheus text exposition format.
+        """
+        lines = []
+        for (name, labels, value) in self.samples():
+            lines.append('%s%s %s' % (name, format_labels(labels), repr(float(value))))
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """
+        Return the counters, gauges and histogram totals as a flat
+        dict, leaving out the buckets.
+        """
+        return dict(('%s%s' % (name, format_labels(labels)), value)
+                    for (name, labels, value) in self.samples()
+                    if not name.endswith('_bucket'))
+
+# Shared by everything in the process, like the timings.
+REGISTRY = Metrics()
+
+def in_background(target, *args):
+    """
+    Run `target' on a daemon thread, or on a greenlet once `--engine
+    gevent' has patched the socket module, since a gevent socket (and
+    so a redis connection) only works in the thread it was made in.
+    """
+    if gevent is not None and monkey.is_module_patched('socket'):
+        return gevent.spawn(target, *args)
+    thread = threading.Thread(target=target, args=args)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+class BackgroundServer(ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Answers each request with in_background().
+    """
+    daemon_threads = True
+
+    def process_request(self, request, client_address):
+        in_background(self.process_request_thread, request, client_address)
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.metrics.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug('%s - %s' % (self.client_address[0], format % args))
+
+class MetricsServer(BackgroundServer):
+    pass
+
+def serve_metrics(port, host='127.0.0.1', metrics=REGISTRY):
+    """
+    Serve `metrics' at http://host:port/metrics in the background.
+    """
+    server = MetricsServer((host, port), MetricsHandler)
+    server.metrics = metrics
+    in_background(server.serve_forever)
+    logger.info('Serving metrics at http://%s:%d/metrics' % (host, port))
+    return server
+
+def report_stats(redis_client, key, interval, metrics=REGISTRY):
+    """
+    Every `interval' seconds, write a snapshot of `metrics' to the
+    redis hash `key' in the background. The hash expires if the
+    process stops updating it.
+    """
+    def report():
+        while True:
+            time.sleep(interval)
+            stats = metrics.snapshot()
+            stats['updated'] = time.time()
+            try:
+                pipe = redis_client.pipeline()
+                pipe.delete(key)
+                pipe.hmset(key, stats)
+                pipe.expire(key, int(interval * 3))
+                pipe.execute()
+            except Exception:
+                logger.exception('Failed to write stats to %s' % key)
+
+    return in_background(report)
+
+def time_sockets(metrics=REGISTRY):
+    """
+    Record how long name lookups and opening connections take.
+    Connecting includes the lookup. Connections that are kept alive
+    skip both, so these only count new connections.
+    """
+    getaddrinfo = socket.getaddrinfo
+    create_connection = socket.create_connection
+
+    def timed_getaddrinfo(*args, **kwargs):
+        with metrics.timer('dns_seconds'):
+            return getaddrinfo(*args, **kwargs)
+
+    def timed_create_connection(*args, **kwargs):
+        with metrics.timer('connect_seconds'):
+            return create_connection(*args, **kwargs)
+
+    socket.getaddrinfo = timed_getaddrinfo
+    socket.create_connection = timed_create_connection
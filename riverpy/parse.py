@@ -0,0 +1,183 @@
+import time
+import arrow
+import hashlib
+import feedparser
+import multiprocessing
+from datetime import datetime
+from utils import format_timestamp
+from sanitize import strip_tags
+from timing import StageTimings
+
+def entry_timestamp(entry):
+    """
+    Return an entry's timestamp as best that can be figured.
+
+    If no timestamp can be found, return the current time.
+    """
+    for key in ['published_parsed', 'updated_parsed', 'created_parsed']:
+        if key not in entry: continue
+        if entry[key] is None: continue
+        val = (entry[key])[:6]
+        reported_timestamp = arrow.get(datetime(*val))
+        if reported_timestamp < arrow.utcnow():
+            return reported_timestamp
+    return arrow.utcnow()
+
+def clean_text(text, limit=280, suffix='&nbsp;...'):
+    # Same as bleach.clean(text, tags=[], strip=True), but stops
+    # reading long descriptions once it's got enough.
+    cleaned = strip_tags(text, limit).strip()
+    if len(cleaned) > limit:
+        return ''.join(cleaned[:limit]) + suffix
+    else:
+        return cleaned
+
+def entry_fingerprint(entry):
+    if entry.get('guid'):
+        return entry.get('guid')
+    else:
+        s = ''.join([
+            entry.get('title', ''),
+            entry.get('link', ''),
+        ])
+        s = s.encode('utf-8', 'ignore')
+        return hashlib.sha1(s).hexdigest()
+
+def parse_feed(feed_content):
+    """
+    Parse a feed into (feed, entries) made up of plain dicts, small
+    enough to cheaply pass between processes.
+    """
+    feed_parsed = feedparser.parse(feed_content)
+    feed = {
+        'title': feed_parsed.feed.get('title', ''),
+        'description': feed_parsed.feed.get('description', ''),
+        'link': feed_parsed.feed.get('link', ''),
+    }
+    # Where to subscribe for pushed updates, if anywhere.
+    for link in feed_parsed.feed.get('links', []):
+        if link.get('rel') in ('hub', 'self') and link.get('href'):
+            feed.setdefault(link['rel'], link['href'])
+    entries = []
+    for entry in feed_parsed.entries:
+        entries.append({
+            'fingerprint': entry_fingerprint(entry),
+            'timestamp': entry_timestamp(entry).timestamp,
+            'title': entry.get('title'),
+            'description': entry.get('description'),
+            'link': entry.get('link'),
+            'comments': entry.get('comments'),
+        })
+    return (feed, entries)
+
+def feed_update(entry):
+    """
+    Return the river.js item for a parsed entry, minus its id.
+    """
+    obj = {
+        'pubDate': format_timestamp(arrow.get(entry['timestamp'])),
+    }
+
+    # If both <title> and <description> exist:
+    #   title -> <title>
+    #   body -> <description>
+    if entry.get('title') and entry.get('description'):
+        obj['title'] = clean_text(entry.get('title'))
+        obj['body'] = clean_text(entry.get('description'))
+
+        # Drop the body if it's just a duplicate of the title.
+        if obj['title'] == obj['body']:
+            obj['body'] == ''
+
+    # If <description> exists but <title> doesn't:
+    #   title -> <description>
+    #   body -> ''
+    #
+    # See http://scripting.com/2014/04/07/howToDisplayTitlelessFeedItems.html
+    # for an ad-hoc spec.
+    elif not entry.get('title') and entry.get('description'):
+        obj['title'] = clean_text(entry.get('description'))
+        obj['body'] = ''
+
+    # If neither of the above work but <title> exists:
+    #   title -> <title>
+    #   body -> ''
+    #
+    # A rare occurance -- just about everybody uses both <title>
+    # and <description> and those with title-less feeds just use
+    # <description> (in keeping with the RSS spec) -- but the
+    # Nieman Journalism Lab's RSS feed [1] needs this conditional
+    # so I assume it's not the only one out there.
+    #
+    # [1] http://www.niemanlab.org/feed/
+    elif entry.get('title'):
+        obj['title'] = clean_text(entry.get('title'))
+        obj['body'] = ''
+
+    if entry.get('link'):
+        obj['link'] = entry.get('link')
+
+    if entry.get('comments'):
+        obj['comments'] = entry.get('comments')
+
+    return obj
+
+def feed_updates(entries):
+    return [feed_update(entry) for entry in entries]
+
+def timed(func, arg):
+    start = time.time()
+    result = func(arg)
+    return (result, time.time() - start)
+
+class InlineParser(object):
+    """
+    Parse and clean feeds in the calling thread.
+    """
+    def __init__(self, timings=None):
+        self.timings = timings or StageTimings()
+
+    def parse(self, feed_content):
+        with self.timings.stage('parse'):
+            return parse_feed(feed_content)
+
+    def clean(self, entries):
+        with self.timings.stage('clean'):
+            return feed_updates(entries)
+
+class PoolParser(InlineParser):
+    """
+    Parse and clean feeds on a pool of worker processes so they
+    aren't fighting over the GIL with the downloads.
+
+    Besides how long the work itself took, the time spent waiting on
+    a free worker is recorded as `<stage>-wait'. If that's large, the
+    pool is too small.
+    """
+    def __init__(self, workers, timings=None):
+        InlineParser.__init__(self, timings)
+        self.pool = multiprocessing.Pool(workers)
+
+        # How to block on the pool. GeventEngine swaps this out so
+        # waiting doesn't stall the other greenlets.
+        self.wait = apply
+
+    def call(self, stage, func, arg):
+        start = time.time()
+        (result, elapsed) = self.wait(self.pool.apply, (timed, (func, arg)))
+        self.timings.record(stage, elapsed)
+        self.timings.record('%s-wait' % stage, time.time() - start - elapsed)
+        return result
+
+    def parse(self, feed_content):
+        return self.call('parse', parse_feed, feed_content)
+
+    def clean(self, entries):
+        if not entries:
+            return []
+        return self.call('clean', feed_updates, entries)
+
+def feed_parser(workers, timings=None):
+    if workers > 0:
+        return PoolParser(workers, timings)
+    return InlineParser(timings)
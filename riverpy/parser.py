@@ -1,66 +1,281 @@
+import os
 import re
+import json
 import yaml
+import hashlib
+import logging
+import urlparse
 import requests
+import tempfile
+import threading
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
 from lxml import etree
 
 from utils import slugify
 
+logger = logging.getLogger(__name__)
+
 is_remote = lambda url: url.startswith(('http://', 'https://'))
 
-def parse_subscription_list(location):
-    if location.endswith('.opml'):
-        return parse_opml(location)
-    else:
-        return parse_yaml(location)
-
-def parse_yaml(location):
-    if is_remote(location):
-        resp = requests.get(location)
-        resp.raise_for_status()
-        doc = yaml.load(resp.text)
-    else:
-        doc = yaml.load(open(location))
-
-    for river, feeds in doc.items():
-        yield {
-            'name': slugify(river),
-            'title': river,
-            'feeds': feeds,
-        }
-
-def parse_opml(location):
-    def _parse(loc):
-        if is_remote(loc):
-            resp = requests.get(loc)
-            resp.raise_for_status()
-            return etree.fromstring(resp.text)
-        else:
-            return etree.parse(loc).getroot()
+# A top-level outline of a subscription list. `name' is None if the
+# outline has neither a name nor a text attribute.
+Summit = namedtuple('Summit', 'name title feeds includes')
+
+# Everything riverpy needs from one subscription list: its summits
+# and, for when it's included by another list, every feed and include
+# anywhere in it.
+ListDocument = namedtuple('ListDocument', 'summits feeds includes')
+
+def is_rss(el):
+    return (el.get('type') == 'rss' and
+            el.get('xmlUrl') and
+            not el.get('isComment') == 'true')
 
-    def _is_rss(el):
-        return (el.get('type') == 'rss' and
-                el.get('xmlUrl') and
-                not el.get('isComment') == 'true')
+def is_include(el):
+    return el.get('type') == 'include' and el.get('url')
 
-    head, body = _parse(location)
+def parse_opml_document(location, content):
+    """
+    Parse an OPML subscription list read from `location'. Includes
+    are resolved against `location', so they can be relative.
+    """
+    head, body = etree.fromstring(content)
+    include_url = lambda el: urlparse.urljoin(location, el.get('url'))
 
+    summits = []
     for summit in body:
         if summit.get('name'):
             river_name = summit.get('name')
         elif summit.get('text'):
             river_name = slugify(summit.get('text', ''))
         else:
-            raise ValueError, 'all summits need either a name or text attribute'
+            river_name = None
 
-        if summit.get('type') == 'include':
-            _, parent = _parse(summit.get('url'))
+        if is_include(summit):
+            # What's inside an include is left to the list it names.
+            (feeds, includes) = ([], [include_url(summit)])
         else:
-            parent = summit
-
-        feeds = [el.get('xmlUrl') for el in parent.iterdescendants() if _is_rss(el)]
-        if feeds:
-            yield {
-                'name': river_name,
-                'title': summit.get('text', ''),
-                'feeds': feeds,
-            }
+            descendants = list(summit.iterdescendants())
+            feeds = [el.get('xmlUrl') for el in descendants if is_rss(el)]
+            includes = [include_url(el) for el in descendants if is_include(el)]
+        summits.append(Summit(river_name, summit.get('text', ''), feeds, includes))
+
+    descendants = list(body.iterdescendants())
+    return ListDocument(
+        summits,
+        [el.get('xmlUrl') for el in descendants if is_rss(el)],
+        [include_url(el) for el in descendants if is_include(el)],
+    )
+
+def parse_yaml_document(location, content):
+    doc = yaml.load(content)
+    summits = [Summit(slugify(river), river, feeds, []) for (river, feeds) in doc.items()]
+    return ListDocument(summits, [], [])
+
+class ListCache(object):
+    """
+    Reads subscription lists, downloading remote ones with
+    conditional GETs. The body and validators (ETag and
+    Last-Modified) of each download are remembered, and with a
+    `directory' also kept there so they outlive the process.
+    """
+    def __init__(self, directory=None, session=None):
+        self.directory = directory
+        self.session = session or requests.Session()
+        self.entries = {}
+        self.lock = threading.Lock()
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def paths(self, url):
+        name = hashlib.sha1(url).hexdigest()
+        return (os.path.join(self.directory, '%s.json' % name),
+                os.path.join(self.directory, '%s.body' % name))
+
+    def cached(self, url):
+        """
+        Return (validators, body) from the last download of `url', or
+        None.
+        """
+        with self.lock:
+            entry = self.entries.get(url)
+        if entry is not None or not self.directory:
+            return entry
+        (meta_path, body_path) = self.paths(url)
+        try:
+            with open(meta_path) as fp:
+                validators = json.load(fp)
+            with open(body_path, 'rb') as fp:
+                body = fp.read()
+        except (IOError, ValueError):
+            return None
+        with self.lock:
+            self.entries[url] = (validators, body)
+        return (validators, body)
+
+    def replace(self, fname, data):
+        (fd, tmp) = tempfile.mkstemp(dir=self.directory, prefix='.%s.' % os.path.basename(fname))
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(data)
+            os.rename(tmp, fname)
+        except:
+            os.unlink(tmp)
+            raise
+
+    def store(self, url, validators, body):
+        with self.lock:
+            self.entries[url] = (validators, body)
+        if self.directory:
+            (meta_path, body_path) = self.paths(url)
+            # The validators go last so they never vouch for a body
+            # that isn't there.
+            self.replace(body_path, body)
+            self.replace(meta_path, json.dumps(validators))
+
+    def get(self, url):
+        entry = self.cached(url)
+        headers = {}
+        if entry is not None:
+            (validators, body) = entry
+            if validators.get('etag'):
+                headers['If-None-Match'] = validators['etag']
+            if validators.get('last-modified'):
+                headers['If-Modified-Since'] = validators['last-modified']
+
+        response = self.session.get(url, headers=headers, timeout=30)
+        if response.status_code == 304 and entry is not None:
+            logger.debug('%s is unchanged' % url)
+            return entry[1]
+        response.raise_for_status()
+
+        validators = dict((name, response.headers[name]) for name in ('etag', 'last-modified')
+                          if response.headers.get(name))
+        if validators:
+            self.store(url, validators, response.content)
+        return response.content
+
+    def read(self, location):
+        if is_remote(location):
+            return self.get(location)
+        with open(location, 'rb') as fp:
+            return fp.read()
+
+class ListResolver(object):
+    """
+    Reads a subscription list and every list it includes, however
+    deeply they're nested. Each level of includes is downloaded at
+    once, a list included several times is only read once, and a list
+    is only parsed again once its contents change.
+
+    `changed' is set whenever a list is parsed again or is no longer
+    included, and left for the caller to reset once it's acted on it.
+    """
+    def __init__(self, cache=None, workers=8):
+        self.cache = cache or ListCache()
+        self.workers = workers
+        # location -> (digest, ListDocument)
+        self.documents = {}
+        self.changed = False
+
+    def parse(self, location, content, top_level):
+        if top_level and not location.endswith('.opml'):
+            return parse_yaml_document(location, content)
+        return parse_opml_document(location, content)
+
+    def load(self, location, content=None):
+        """
+        Read `location' (or use its `content' if it's already been
+        read) and everything it includes.
+        """
+        wanted = set([location])
+        level = [location]
+        pool = None
+        try:
+            while level:
+                if content is not None:
+                    contents = [content]
+                    content = None
+                elif len(level) == 1:
+                    contents = [self.cache.read(level[0])]
+                else:
+                    pool = pool or ThreadPool(self.workers)
+                    contents = pool.map(self.cache.read, level)
+
+                next_level = []
+                for (loc, body) in zip(level, contents):
+                    digest = hashlib.sha1(body).hexdigest()
+                    current = self.documents.get(loc)
+                    if current is None or current[0] != digest:
+                        self.documents[loc] = (digest, self.parse(loc, body, loc == location))
+                        self.changed = True
+                    for include in self.documents[loc][1].includes:
+                        if include not in wanted:
+                            wanted.add(include)
+                            next_level.append(include)
+                level = next_level
+        finally:
+            if pool is not None:
+                pool.close()
+
+        for loc in set(self.documents) - wanted:
+            del self.documents[loc]
+            self.changed = True
+
+    def included_feeds(self, location, ancestors, resolved, loops):
+        """
+        Return every feed in the included list at `location' and the
+        lists it includes in turn, and whether a loop was cut short
+        on the way. Lists that include themselves, directly or not,
+        are only followed once.
+        """
+        if location in ancestors:
+            if location not in loops:
+                logger.warning('%s includes itself, ignoring the loop' % location)
+                loops.add(location)
+            return ([], True)
+        if location in resolved:
+            return (resolved[location], False)
+
+        document = self.documents[location][1]
+        feeds = list(document.feeds)
+        looped = False
+        for include in document.includes:
+            (included, cut) = self.included_feeds(include, ancestors | set([location]), resolved, loops)
+            feeds.extend(included)
+            looped = looped or cut
+        # What's left of a loop depends on where it was entered from.
+        if not looped:
+            resolved[location] = feeds
+        return (feeds, looped)
+
+    def rivers(self, location):
+        """
+        Yield the rivers in the list at `location', as last loaded.
+        """
+        (resolved, loops) = ({}, set())
+        for summit in self.documents[location][1].summits:
+            if summit.name is None:
+                raise ValueError, 'all summits need either a name or text attribute'
+            feeds = list(summit.feeds)
+            for include in summit.includes:
+                feeds.extend(self.included_feeds(include, set([location]), resolved, loops)[0])
+            # Lists included more than once name the same feeds.
+            seen = set()
+            feeds = [feed for feed in feeds if not (feed in seen or seen.add(feed))]
+            if feeds:
+                yield {
+                    'name': summit.name,
+                    'title': summit.title,
+                    'feeds': feeds,
+                }
+
+def parse_subscription_list(location, content=None):
+    """
+    Parse the subscription list at `location', or `content' if it's
+    already been read from there.
+    """
+    resolver = ListResolver()
+    resolver.load(location, content)
+    return resolver.rivers(location)
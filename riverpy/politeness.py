@@ -0,0 +1,171 @@
+import math
+import time
+import uuid
+import random
+import logging
+import requests
+from urlparse import urlparse
+from email.utils import parsedate_tz, mktime_tz
+
+from storage import local_script
+
+logger = logging.getLogger(__name__)
+
+# KEYS: holders, next request, blocked until, queued until
+# ARGV: now, token, max concurrent, seconds between requests, slot ttl,
+#       seconds to wait when busy, seconds between deferred requests
+ACQUIRE = """
+local now = tonumber(ARGV[1])
+
+-- Each feed turned away gets the next free place in the host's
+-- queue, so a host with many feeds isn't asked about all of them
+-- again every time it could take one more.
+local function defer(wait)
+    local queued = tonumber(redis.call('GET', KEYS[4]) or 0)
+    local at = math.max(now + tonumber(wait), queued + tonumber(ARGV[7]))
+    redis.call('SET', KEYS[4], tostring(at), 'PX', math.ceil((at - now) * 1000) + 1)
+    return tostring(at - now)
+end
+
+local blocked = tonumber(redis.call('GET', KEYS[3]) or 0)
+if blocked > now then
+    return defer(blocked - now)
+end
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+if tonumber(ARGV[3]) > 0 and redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[3]) then
+    return defer(ARGV[6])
+end
+local next_request = tonumber(redis.call('GET', KEYS[2]) or 0)
+if next_request > now then
+    return defer(next_request - now)
+end
+local interval = tonumber(ARGV[4])
+if interval > 0 then
+    redis.call('SET', KEYS[2], tostring(now + interval), 'PX', math.ceil(interval * 1000))
+end
+redis.call('ZADD', KEYS[1], now + tonumber(ARGV[5]), ARGV[2])
+redis.call('EXPIRE', KEYS[1], math.ceil(tonumber(ARGV[5])))
+return '0'
+"""
+
+# How Lua's tostring() writes a number; str() keeps only 12 digits,
+# which drops the milliseconds from a timestamp.
+lua_number = lambda value: '%.14g' % value
+
+@local_script(ACQUIRE)
+def acquire(client, keys, args):
+    now = float(args[0])
+
+    def defer(wait):
+        queued = float(client.get(keys[3]) or 0)
+        at = max(now + float(wait), queued + float(args[6]))
+        client.set(keys[3], lua_number(at), px=int(math.ceil((at - now) * 1000)) + 1)
+        return lua_number(at - now)
+
+    blocked = float(client.get(keys[2]) or 0)
+    if blocked > now:
+        return defer(blocked - now)
+    client.zremrangebyscore(keys[0], '-inf', now)
+    if float(args[2]) > 0 and client.zcard(keys[0]) >= float(args[2]):
+        return defer(args[5])
+    next_request = float(client.get(keys[1]) or 0)
+    if next_request > now:
+        return defer(next_request - now)
+    interval = float(args[3])
+    if interval > 0:
+        client.set(keys[1], lua_number(now + interval), px=int(math.ceil(interval * 1000)))
+    client.zadd(keys[0], args[1], now + float(args[4]))
+    client.expire(keys[0], int(math.ceil(float(args[4]))))
+    return '0'
+
+class RetryLater(requests.exceptions.HTTPError):
+    """
+    The server answered 429 or 503. `retry_after' is how many
+    seconds it asked us to wait, or None.
+    """
+    def __init__(self, retry_after, *args, **kwargs):
+        requests.exceptions.HTTPError.__init__(self, *args, **kwargs)
+        self.retry_after = retry_after
+
+def feed_host(feed_url):
+    return urlparse(feed_url).netloc.lower()
+
+def parse_retry_after(value, limit=24*60*60):
+    """
+    Return the seconds to wait from a Retry-After header, which is
+    either a number of seconds or an HTTP date.
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        seconds = int(value)
+    else:
+        parsed = parsedate_tz(value)
+        if parsed is None:
+            return None
+        seconds = mktime_tz(parsed) - time.time()
+    return max(0, min(seconds, limit))
+
+class HostLimiter(object):
+    """
+    Limits how many requests go to one host at once and how often,
+    across every worker sharing the redis DB.
+    """
+    def __init__(self, redis_client, concurrency, rate, slot_ttl=120, busy_wait=5):
+        self.redis_client = redis_client
+        self.concurrency = concurrency
+        self.interval = 1.0 / rate if rate else 0
+        self.slot_ttl = slot_ttl
+        self.busy_wait = busy_wait
+        self.acquire_script = redis_client.register_script(ACQUIRE)
+
+        # How far apart feeds turned away are sent back: as often as
+        # the host takes requests, or failing a rate, as often as a
+        # slot might free up.
+        self.spacing = self.interval or float(busy_wait) / max(concurrency, 1)
+
+    def keys(self, host):
+        return ['host:%s:holders' % host,
+                'host:%s:next-request' % host,
+                'host:%s:blocked-until' % host,
+                'host:%s:queued-until' % host]
+
+    def acquire(self, host):
+        """
+        Try to take a slot for `host'. Returns (token, 0) on success,
+        otherwise (None, seconds to wait), where the wait also counts
+        every other feed already waiting for the host.
+        """
+        token = uuid.uuid4().hex
+        wait = float(self.acquire_script(keys=self.keys(host), args=[
+            '%.3f' % time.time(),
+            token,
+            self.concurrency,
+            self.interval,
+            self.slot_ttl,
+            self.busy_wait,
+            self.spacing,
+        ]))
+        if wait > 0:
+            return (None, wait)
+        return (token, 0)
+
+    def release(self, host, token):
+        self.redis_client.zrem(self.keys(host)[0], token)
+
+    def block(self, host, seconds):
+        """
+        Don't send anything to `host' for `seconds'.
+        """
+        until = time.time() + seconds
+        logger.info('Backing off %s for %d seconds' % (host, seconds))
+        self.redis_client.set(self.keys(host)[2], '%.3f' % until, px=int(seconds * 1000) + 1)
+
+def backoff_delay(failures, base, limit):
+    """
+    Exponential backoff with jitter: about base, 2*base, 4*base, ...
+    up to limit.
+    """
+    delay = min(base * (2 ** max(0, failures - 1)), limit)
+    return random.uniform(delay / 2.0, delay)
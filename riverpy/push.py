@@ -0,0 +1,249 @@
+import os
+import hmac
+import time
+import hashlib
+import logging
+import urlparse
+import requests
+import BaseHTTPServer
+
+from metrics import REGISTRY, BackgroundServer, in_background
+from subscriptions import SUBSCRIPTIONS_KEY
+
+try:
+    from hmac import compare_digest
+except ImportError:
+    # Before python 2.7.7.
+    def compare_digest(a, b):
+        if len(a) != len(b):
+            return False
+        result = 0
+        for (x, y) in zip(a, b):
+            result |= ord(x) ^ ord(y)
+        return result == 0
+
+logger = logging.getLogger(__name__)
+
+# Maps the token at the end of each callback URL to its feed.
+CALLBACKS_KEY = 'push:callbacks'
+
+# How long to wait before asking again after a hub turned a
+# subscription down or never confirmed it.
+RETRY_SECONDS = 24*60*60
+
+def push_key(feed_url):
+    return 'push:%s' % feed_url
+
+def callback_token(feed_url):
+    return hashlib.sha1(feed_url).hexdigest()
+
+def discover_hub(feed, links):
+    """
+    Return (hub, topic) from the Link headers of a feed's response,
+    or failing that from the feed itself. Either may be None.
+    """
+    links = links or {}
+    hub = links.get('hub', {}).get('url') or feed.get('hub')
+    topic = links.get('self', {}).get('url') or feed.get('self')
+    return (hub, topic)
+
+def check_signature(secret, body, signature):
+    """
+    Return True if `signature' (an X-Hub-Signature header) is the
+    HMAC of `body' keyed with `secret'.
+    """
+    if not secret or not signature or '=' not in signature:
+        return False
+    (method, digest) = signature.split('=', 1)
+    if method not in ('sha1', 'sha256', 'sha384', 'sha512'):
+        return False
+    expected = hmac.new(secret, body, getattr(hashlib, method)).hexdigest()
+    return compare_digest(expected, digest.strip().lower())
+
+class PushSubscriber(object):
+    """
+    Subscribes feeds to the WebSub hubs they advertise and renews the
+    subscriptions before they run out.
+
+    Each feed's subscription is kept in the push:<url> hash: the hub,
+    the topic, the secret pushes are signed with, its state (pending,
+    subscribed or denied), when it was last requested and when it
+    expires.
+    """
+    def __init__(self, redis_client, session, callback_url, lease_seconds, push_interval):
+        self.redis_client = redis_client
+        self.session = session
+        self.callback_url = callback_url.rstrip('/')
+        self.lease_seconds = lease_seconds
+        self.push_interval = push_interval
+
+    def callback(self, feed_url):
+        return '%s/%s' % (self.callback_url, callback_token(feed_url))
+
+    def is_active(self, state, now):
+        return state.get('state') == 'subscribed' and float(state.get('expires', 0)) > now
+
+    def wants_subscription(self, state, hub, topic, now):
+        if state.get('hub') != hub or state.get('topic') != topic:
+            return True
+        if state.get('state') == 'subscribed':
+            # Renew while there's still time for a couple of polls.
+            return float(state.get('expires', 0)) - now < 2 * self.push_interval
+        return now - float(state.get('requested', 0)) > RETRY_SECONDS
+
+    def update(self, feed_url, feed, links, state):
+        """
+        Subscribe to the hub a feed advertises, or renew an existing
+        subscription, if it's time to.
+        """
+        (hub, topic) = discover_hub(feed, links)
+        if hub is None:
+            # Unchanged feeds aren't parsed; go on what we had.
+            (hub, topic) = (state.get('hub'), state.get('topic'))
+        if hub is None:
+            return
+        topic = topic or feed_url
+        if self.wants_subscription(state, hub, topic, time.time()):
+            self.subscribe(feed_url, hub, topic, state)
+
+    def subscribe(self, feed_url, hub, topic, state):
+        renewal = state.get('hub') == hub and state.get('topic') == topic
+        # Keep the secret when renewing so pushes signed with it
+        # still check out.
+        secret = (renewal and state.get('secret')) or os.urandom(20).encode('hex')
+
+        # Recorded first, as the hub may check back before it answers.
+        pipe = self.redis_client.pipeline()
+        pipe.hset(CALLBACKS_KEY, callback_token(feed_url), feed_url)
+        pipe.hmset(push_key(feed_url), {
+            'hub': hub,
+            'topic': topic,
+            'secret': secret,
+            'state': state['state'] if renewal and state.get('state') == 'subscribed' else 'pending',
+            'requested': int(time.time()),
+        })
+        pipe.execute()
+
+        logger.info('Subscribing to %s at %s' % (topic, hub))
+        try:
+            response = self.session.post(hub, timeout=15, data={
+                'hub.mode': 'subscribe',
+                'hub.topic': topic,
+                'hub.callback': self.callback(feed_url),
+                'hub.secret': secret,
+                'hub.lease_seconds': self.lease_seconds,
+            })
+        except requests.exceptions.RequestException:
+            logger.exception('Failed to subscribe to %s at %s' % (topic, hub))
+            REGISTRY.incr('push_subscribe_total', result='error')
+            return
+        if response.status_code not in (202, 204):
+            logger.warning('%s refused to subscribe to %s (%d)' % (hub, topic, response.status_code))
+            REGISTRY.incr('push_subscribe_total', result='refused')
+            return
+        REGISTRY.incr('push_subscribe_total', result='accepted')
+
+class PushHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Confirms the subscriptions PushSubscriber asked for and passes
+    pushed content on once its signature checks out.
+    """
+    def log_message(self, fmt, *args):
+        logger.debug('%s - %s' % (self.client_address[0], fmt % args))
+
+    def lookup(self):
+        """
+        Return (feed_url, state) for the callback being requested.
+        """
+        redis_client = self.server.redis_client
+        token = urlparse.urlparse(self.path).path.rstrip('/').rsplit('/', 1)[-1]
+        feed_url = redis_client.hget(CALLBACKS_KEY, token)
+        if feed_url is None:
+            return (None, {})
+        return (feed_url, redis_client.hgetall(push_key(feed_url)))
+
+    def respond(self, status, body=''):
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        query = dict(urlparse.parse_qsl(urlparse.urlparse(self.path).query))
+        (feed_url, state) = self.lookup()
+        mode = query.get('hub.mode')
+        if feed_url is None or query.get('hub.topic') != state.get('topic'):
+            self.respond(404)
+            return
+
+        redis_client = self.server.redis_client
+        if mode == 'subscribe' and state.get('state') in ('pending', 'subscribed'):
+            # Hubs may leave the lease out, but anything they do send
+            # has to be a positive number of seconds.
+            try:
+                lease = int(query.get('hub.lease_seconds') or self.server.lease_seconds)
+            except ValueError:
+                lease = 0
+            if lease <= 0:
+                self.respond(400)
+                return
+            redis_client.hmset(push_key(feed_url), {
+                'state': 'subscribed',
+                'expires': int(time.time()) + lease,
+            })
+            logger.info('Subscribed to %s for %d seconds' % (feed_url, lease))
+            self.respond(200, query.get('hub.challenge', ''))
+        elif mode == 'unsubscribe' and not redis_client.sismember(SUBSCRIPTIONS_KEY, feed_url):
+            redis_client.delete(push_key(feed_url))
+            redis_client.hdel(CALLBACKS_KEY, callback_token(feed_url))
+            self.respond(200, query.get('hub.challenge', ''))
+        elif mode == 'denied':
+            logger.warning('Hub denied the subscription to %s: %s' % (feed_url, query.get('hub.reason', '')))
+            redis_client.hset(push_key(feed_url), 'state', 'denied')
+            self.respond(200)
+        else:
+            self.respond(404)
+
+    def do_POST(self):
+        (feed_url, state) = self.lookup()
+        if feed_url is None or not self.server.redis_client.sismember(SUBSCRIPTIONS_KEY, feed_url):
+            # Tells the hub to stop sending.
+            self.respond(410)
+            return
+
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > self.server.max_body_size:
+            self.respond(413)
+            return
+        body = self.rfile.read(length)
+
+        # Hubs are told all is well either way, so that someone
+        # forging pushes can't tell what works.
+        self.respond(202)
+        if not check_signature(state.get('secret'), body, self.headers.get('X-Hub-Signature')):
+            logger.warning('Ignoring push for %s with a bad signature' % feed_url)
+            REGISTRY.incr('pushes_total', result='bad-signature')
+            return
+        logger.info('Push for %s (%d bytes)' % (feed_url, len(body)))
+        REGISTRY.incr('pushes_total', result='ok')
+        self.server.receive(feed_url, body)
+
+class PushServer(BackgroundServer):
+    pass
+
+def serve_push(port, host, checker):
+    """
+    Accept WebSub callbacks on host:port in the background, handing
+    pushed content to `checker' (a ParseFeed) the same way a download
+    would be.
+    """
+    args = checker.cli_args
+    server = PushServer((host, port), PushHandler)
+    server.redis_client = checker.redis_client
+    server.lease_seconds = args.push_lease
+    server.max_body_size = args.max_body_size
+    server.receive = lambda feed_url, body: checker.process_feed(feed_url, body, leased=False)
+    in_background(server.serve_forever)
+    logger.info('Accepting WebSub callbacks on %s:%d for %s' % (host, port, args.push_url))
+    return server
@@ -0,0 +1,194 @@
+import os
+import json
+import mmap
+import time
+import struct
+import logging
+import requests
+import threading
+from io import BytesIO
+from collections import namedtuple
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.response import HTTPResponse
+
+from stream import FeedTooLarge
+
+logger = logging.getLogger(__name__)
+
+# Start of every archive file.
+MAGIC = 'riverrec1\n'
+
+# started, seconds to the headers, seconds in all, status, then the
+# lengths of the URL, the headers (as JSON) and the body that follow.
+HEADER = struct.Struct('!dffHIII')
+
+# Status of a fetch that never got a response. Its headers name the
+# exception and its body is the message.
+FAILED = 0
+
+# Replaced by the body as it's recorded: already decoded, and read
+# to the end.
+DROPPED_HEADERS = ('content-encoding', 'transfer-encoding', 'content-length')
+
+FetchRecord = namedtuple('FetchRecord', 'started first_byte seconds status url headers body')
+
+recorders = {}
+recorders_lock = threading.Lock()
+
+def error_class(name):
+    """
+    Return the exception a failed fetch raised, by name.
+    """
+    if name == FeedTooLarge.__name__:
+        return FeedTooLarge
+    error = getattr(requests.exceptions, name, None)
+    if isinstance(error, type) and issubclass(error, requests.exceptions.RequestException):
+        return error
+    return requests.exceptions.ConnectionError
+
+class FetchRecorder(object):
+    """
+    Appends every fetch to an archive file, one record per write so
+    several threads can share it and a crash leaves at most a torn
+    record at the end.
+    """
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.fp = open(path, 'ab', 0)
+        with self.lock:
+            self.fp.seek(0, os.SEEK_END)
+            if self.fp.tell() == 0:
+                self.fp.write(MAGIC)
+
+    def record(self, started, first_byte, seconds, status, url, headers, body):
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+        headers = json.dumps(headers)
+        with self.lock:
+            self.fp.write(HEADER.pack(started, first_byte, seconds, status, len(url), len(headers), len(body)) + url + headers + body)
+
+    def record_response(self, url, started, first_byte, response, body):
+        headers = dict((name, value) for (name, value) in response.headers.items()
+                       if name.lower() not in DROPPED_HEADERS)
+        self.record(started, first_byte, time.time() - started, response.status_code, url, headers, body)
+
+    def record_error(self, url, started, error):
+        self.record(started, 0, time.time() - started, FAILED, url, {'error': error.__class__.__name__}, str(error))
+
+def open_recorder(path):
+    """
+    Return the FetchRecorder for `path', shared by every checker in
+    the process.
+    """
+    with recorders_lock:
+        if path not in recorders:
+            logger.info('Recording fetches to %s' % path)
+            recorders[path] = FetchRecorder(path)
+        return recorders[path]
+
+class FetchArchive(object):
+    """
+    Reads back what FetchRecorder wrote. The file is mapped rather
+    than read so only the records being replayed need to be in
+    memory.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as fp:
+            if fp.read(len(MAGIC)) != MAGIC:
+                raise ValueError('%s is not a fetch archive' % path)
+            self.map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __iter__(self):
+        offset = len(MAGIC)
+        size = len(self.map)
+        while offset + HEADER.size <= size:
+            (started, first_byte, seconds, status, url_size, headers_size, body_size) = HEADER.unpack_from(self.map, offset)
+            offset += HEADER.size
+            end = offset + url_size + headers_size + body_size
+            if end > size:
+                break
+            url = self.map[offset:offset + url_size]
+            offset += url_size
+            headers = json.loads(self.map[offset:offset + headers_size])
+            offset += headers_size
+            yield FetchRecord(started, first_byte, seconds, status, url,
+                              dict((str(name), value.encode('utf-8')) for (name, value) in headers.items()),
+                              self.map[offset:end])
+            offset = end
+        if offset != size:
+            logger.warning('Ignoring a torn record at the end of %s' % self.path)
+
+    def close(self):
+        self.map.close()
+
+class ReplayAdapter(HTTPAdapter):
+    """
+    Answers requests with whatever record was last handed to
+    `replay', the way the recorded server did.
+    """
+    def __init__(self):
+        HTTPAdapter.__init__(self)
+        self.pending = None
+
+    def replay(self, record):
+        self.pending = record
+
+    def send(self, request, **kwargs):
+        (record, self.pending) = (self.pending, None)
+        if record is None:
+            raise requests.exceptions.ConnectionError('Nothing recorded for %s' % request.url)
+        if record.status == FAILED:
+            raise error_class(record.headers.get('error'))(record.body)
+        raw = HTTPResponse(
+            body=BytesIO(record.body),
+            headers=record.headers,
+            status=record.status,
+            preload_content=False,
+        )
+        return self.build_response(request, raw)
+
+def replay_session(adapter):
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def replay_messages(archive, adapter, checker, scheduler, window, speed=0):
+    """
+    Check every feed in `archive' with `checker', answering its
+    requests from the archive, and yield an update message for the
+    rivers updated by each `window' seconds' worth of the recording.
+
+    With `speed' the checks are paced like they were recorded (1),
+    or that many times faster; without they run back to back.
+    """
+    timings = checker.timings
+    (first, window_end) = (None, None)
+    start = time.time()
+    for record in archive:
+        if first is None:
+            (first, window_end) = (record.started, record.started + window)
+        if record.started >= window_end:
+            window_end = record.started + window
+            with timings.stage('publish'):
+                update_msg = scheduler.pending_update()
+            if update_msg is not None:
+                # Everything until the next message is asked for is
+                # river_writer's doing.
+                with timings.stage('write'):
+                    yield update_msg
+
+        if speed:
+            delay = start + (record.started - first) / speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+        adapter.replay(record)
+        checker.check_feed(record.url)
+
+    with timings.stage('publish'):
+        update_msg = scheduler.pending_update()
+    if update_msg is not None:
+        with timings.stage('write'):
+            yield update_msg
@@ -3,6 +3,8 @@ import logging
 import operator
 from path import path
 from bucket import Bucket
+from codec import to_json
+from collections import OrderedDict
 
 logger = logging.getLogger(__name__)
 
@@ -14,7 +16,152 @@ def serialize_riverjs(river_obj, create_json):
     If callback is provided, make it JSONP.
     """
     serialized = json.dumps(river_obj, sort_keys=True)
+    return wrap_riverjs(serialized, create_json)
+
+def wrap_riverjs(serialized, create_json):
     if create_json:
         return serialized
     else:
         return 'onGetRiverStream(%s)' % serialized
+
+def serialize_fragments(fragments, metadata, create_json):
+    """
+    Assemble a river.js document from already-serialized updates.
+
+    The output is byte-for-byte what serialize_riverjs would produce
+    for the same river object.
+    """
+    serialized = '{"metadata": %s, "updatedFeeds": {"updatedFeed": [%s]}}' % (
+        json.dumps(metadata, sort_keys=True),
+        ', '.join(fragments),
+    )
+    return wrap_riverjs(serialized, create_json)
+
+def to_fragment(stored_update):
+    """
+    Return a stored update as JSON without caching it, for updates
+    that are only serialized once (e.g., archive pages).
+    """
+    if stored_update[:1] == '{':
+        return stored_update
+    return to_json(stored_update)
+
+class FragmentCache(object):
+    """
+    Bounded LRU of river updates serialized to JSON.
+
+    Keyed by the update exactly as stored in redis. An update is
+    never modified once it's been assigned its ids, so only updates
+    that are new (or have been evicted) get decoded and encoded.
+
+    Updates stored with the json codec are already fragments and
+    pass straight through.
+    """
+    def __init__(self, size=10000):
+        self.size = size
+        self.fragments = OrderedDict()
+        self.hits = self.misses = 0
+
+    def fragment(self, stored_update):
+        if stored_update[:1] == '{':
+            return stored_update
+        try:
+            fragment = self.fragments.pop(stored_update)
+            self.hits += 1
+        except KeyError:
+            fragment = to_json(stored_update)
+            self.misses += 1
+            if len(self.fragments) >= self.size:
+                self.fragments.popitem(last=False)
+        self.fragments[stored_update] = fragment
+        return fragment
+
+    def fragments_for(self, stored_updates):
+        return [self.fragment(stored_update) for stored_update in stored_updates]
+
+def deltas_key(river_name):
+    return 'deltas:%s' % river_name
+
+def published_key(river_name):
+    return 'deltas:%s:published' % river_name
+
+class DeltaLog(object):
+    """
+    Works out what's new in each river since it was last written, so
+    clients can fetch only that.
+
+    Updates are identified by the id of their first item. A river's
+    head is the highest id published so far. Each delta holds the
+    updates that showed up between one head and the next, so a client
+    at head `since' can apply the deltas in order to catch up. An
+    update that commits after a higher id was already published rides
+    along with the next delta.
+
+    The last `history' deltas are kept in `deltas:<name>' as
+    "since-head" strings, newest first, and the ids already published
+    in `deltas:<name>:published', so a restarted writer carries on
+    where it left off, late updates and all.
+    """
+    def __init__(self, redis_client, history=100):
+        self.redis_client = redis_client
+        self.history = history
+        self.rivers = {}
+
+    def head(self, river_name):
+        return self.rivers[river_name]['head']
+
+    def deltas(self, river_name):
+        """
+        Return the listed (since, head) pairs, newest first.
+        """
+        return list(self.rivers[river_name]['deltas'])
+
+    def load(self, river_name, ids):
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.lrange(deltas_key(river_name), 0, -1)
+        pipe.smembers(published_key(river_name))
+        (deltas, published) = pipe.execute()
+        deltas = [tuple(int(n) for n in delta.split('-')) for delta in deltas]
+        if deltas and published:
+            head = deltas[0][1]
+            published = set(int(update_id) for update_id in published)
+        elif deltas:
+            # Left by a writer that didn't keep what it published.
+            head = deltas[0][1]
+            published = set(update_id for update_id in ids if update_id <= head)
+        else:
+            # Nothing to say what clients have already seen.
+            (head, published) = (max(ids or [0]), ids)
+        self.rivers[river_name] = {'head': head, 'published': published, 'deltas': deltas}
+        return self.rivers[river_name]
+
+    def update(self, river_name, updates):
+        """
+        Take the newest page of a river as (fragment, update_id)
+        pairs. Returns (since, head, fragments, dropped) for a new
+        delta, where dropped are the (since, head) pairs no longer
+        listed, or None if there isn't one.
+        """
+        ids = set(update_id for (fragment, update_id) in updates)
+        state = self.rivers.get(river_name) or self.load(river_name, ids)
+
+        new = [(fragment, update_id) for (fragment, update_id) in updates if update_id not in state['published']]
+        if not new or max(update_id for (fragment, update_id) in new) <= state['head']:
+            return None
+
+        since = state['head']
+        head = max(update_id for (fragment, update_id) in new)
+        # Anything that fell off the page can't come back.
+        state['published'] = ids
+        state['head'] = head
+        state['deltas'].insert(0, (since, head))
+        dropped = state['deltas'][self.history:]
+        del state['deltas'][self.history:]
+
+        pipe = self.redis_client.pipeline()
+        pipe.lpush(deltas_key(river_name), '%d-%d' % (since, head))
+        pipe.ltrim(deltas_key(river_name), 0, self.history - 1)
+        pipe.delete(published_key(river_name))
+        pipe.sadd(published_key(river_name), *ids)
+        pipe.execute()
+        return (since, head, [fragment for (fragment, update_id) in new], dropped)
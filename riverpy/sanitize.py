@@ -0,0 +1,271 @@
+import re
+import sys
+from html5lib.constants import entities, replacementCharacters
+
+# Strips the tags from an HTML fragment exactly the way
+#
+#     bleach.clean(text, tags=[], strip=True)
+#
+# does, only much faster and without reading past what's needed.
+#
+# bleach drops every tag in its tokenizer, before html5lib's tree
+# builder sees them, so the tree builder never gets to move text
+# around (e.g., out of tables) or switch the tokenizer into
+# script/style mode. What's left is the text the tokenizer emits
+# from its data state, with character references resolved, NULs
+# dropped and &, < and > escaped again. That's what this mimics,
+# jumping from one interesting character to the next with regexes
+# rather than going one character at a time.
+
+SPACE = u'\t\n\x0c\r '
+LETTERS = u'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
+
+TEXT_END = re.compile(u'[<&\x00]')
+NON_SPACE = re.compile(u'[^\t\n\x0c\r ]')
+TAG_NAME_END = re.compile(u'[\t\n\x0c\r />]')
+ATTR_NAME_END = re.compile(u'[\t\n\x0c\r /=>]')
+UNQUOTED_END = re.compile(u'[\t\n\x0c\r >]')
+COMMENT_END = re.compile(u'--!?>')
+COMMENT_CLOSE = re.compile(u'-*!?>')
+DECIMAL = re.compile(u'[0-9]+')
+HEXADECIMAL = re.compile(u'[0-9a-fA-F]+')
+ENTITY_NAME = re.compile(u'[A-Za-z0-9]{1,%d}' % max(len(name) for name in entities))
+
+# html5lib replaces lone surrogates in its input.
+if sys.maxunicode > 0xFFFF:
+    SURROGATES = re.compile(u'[\ud800-\udfff]')
+else:
+    SURROGATES = re.compile(u'([\ud800-\udbff](?![\udc00-\udfff])|(?<![\ud800-\udbff])[\udc00-\udfff])')
+
+(BEFORE_NAME, NAME, AFTER_NAME, BEFORE_VALUE, AFTER_VALUE, SELF_CLOSING) = range(6)
+
+def escape(text):
+    return text.replace(u'&', u'&amp;').replace(u'>', u'&gt;').replace(u'<', u'&lt;')
+
+def normalize(text):
+    """
+    What html5lib does to its input before tokenizing it.
+    """
+    if u'\r' in text:
+        text = text.replace(u'\r\n', u'\n').replace(u'\r', u'\n')
+    return SURROGATES.sub(u'\ufffd', text)
+
+def skip_spaces(text, pos):
+    match = NON_SPACE.search(text, pos)
+    return match.start() if match else len(text)
+
+def skip_tag(text, pos):
+    """
+    Return where the tag whose name starts just before `pos' ends.
+    A tag cut off by the end of the text swallows the rest of it.
+    """
+    end = len(text)
+    match = TAG_NAME_END.search(text, pos)
+    if match is None:
+        return end
+    pos = match.start()
+    state = BEFORE_NAME
+    while True:
+        if state in (BEFORE_NAME, AFTER_NAME, BEFORE_VALUE):
+            pos = skip_spaces(text, pos)
+        if pos >= end:
+            return end
+        char = text[pos]
+
+        if state == BEFORE_NAME:
+            if char == u'>':
+                return pos + 1
+            (state, pos) = (SELF_CLOSING if char == u'/' else NAME, pos + 1)
+        elif state == NAME:
+            match = ATTR_NAME_END.search(text, pos)
+            if match is None:
+                return end
+            (char, pos) = (match.group(), match.end())
+            if char == u'>':
+                return pos
+            state = {u'/': SELF_CLOSING, u'=': BEFORE_VALUE}.get(char, AFTER_NAME)
+        elif state == AFTER_NAME:
+            if char == u'>':
+                return pos + 1
+            (state, pos) = ({u'/': SELF_CLOSING, u'=': BEFORE_VALUE}.get(char, NAME), pos + 1)
+        elif state == BEFORE_VALUE:
+            if char == u'>':
+                return pos + 1
+            elif char in u'"\'':
+                pos = text.find(char, pos + 1)
+                if pos < 0:
+                    return end
+                (state, pos) = (AFTER_VALUE, pos + 1)
+            else:
+                match = UNQUOTED_END.search(text, pos)
+                if match is None:
+                    return end
+                if match.group() == u'>':
+                    return match.end()
+                (state, pos) = (BEFORE_NAME, match.end())
+        elif state == AFTER_VALUE:
+            if char == u'>':
+                return pos + 1
+            elif char == u'/':
+                (state, pos) = (SELF_CLOSING, pos + 1)
+            elif char in SPACE:
+                (state, pos) = (BEFORE_NAME, pos + 1)
+            else:
+                state = BEFORE_NAME
+        elif state == SELF_CLOSING:
+            if char == u'>':
+                return pos + 1
+            state = BEFORE_NAME
+
+def skip_past(text, char, pos):
+    pos = text.find(char, pos)
+    return len(text) if pos < 0 else pos + 1
+
+def skip_nuls(text, pos):
+    while text.startswith(u'\x00', pos):
+        pos += 1
+    return pos
+
+def skip_comment(text, pos):
+    """
+    Return where the comment whose <!-- ends just before `pos' ends.
+    """
+    # <!--> and <!---> are whole comments, NULs notwithstanding.
+    pos = skip_nuls(text, pos)
+    if text.startswith(u'>', pos):
+        return pos + 1
+    elif text.startswith(u'-', pos):
+        pos = skip_nuls(text, pos + 1)
+        if text.startswith(u'>', pos):
+            return pos + 1
+        elif text.startswith(u'-', pos):
+            # As good as having seen the closing --.
+            match = COMMENT_CLOSE.match(text, pos + 1)
+            if match is not None:
+                return match.end()
+    match = COMMENT_END.search(text, pos)
+    return match.end() if match else len(text)
+
+def numeric_reference(value):
+    if value in replacementCharacters:
+        return replacementCharacters[value]
+    elif 0xD800 <= value <= 0xDFFF or value > 0x10FFFF:
+        return u'\ufffd'
+    try:
+        return unichr(value)
+    except ValueError:
+        # Narrow builds can't unichr outside the BMP.
+        return ('\\U%08x' % value).decode('unicode-escape')
+
+def character_reference(text, pos):
+    """
+    Return (characters, pos) for the character reference whose &
+    is just before `pos'.
+    """
+    end = len(text)
+    if pos >= end or text[pos] in SPACE or text[pos] in u'<&':
+        return (u'&', pos)
+
+    if text[pos] == u'#':
+        start = pos + 1
+        is_hex = start < end and text[start] in u'xX'
+        if is_hex:
+            start += 1
+        match = (HEXADECIMAL if is_hex else DECIMAL).match(text, start)
+        if match is None:
+            return (u'&' + text[pos:start], start)
+        pos = match.end()
+        if pos < end and text[pos] == u';':
+            pos += 1
+        return (numeric_reference(int(match.group(), 16 if is_hex else 10)), pos)
+
+    # The longest entity the text starts with, with or without a
+    # semicolon (e.g. `&notit;' is `\xacit;').
+    match = ENTITY_NAME.match(text, pos)
+    if match is not None:
+        name = match.group()
+        if text.startswith(u';', match.end()) and name + u';' in entities:
+            return (entities[name + u';'], match.end() + 1)
+        for length in xrange(len(name), 1, -1):
+            if name[:length] in entities:
+                return (entities[name[:length]], pos + length)
+    return (u'&', pos)
+
+def strip_tags(text, limit=None):
+    """
+    Return `text' with every tag and comment removed, character
+    references resolved, and &, < and > escaped, same as bleach.
+
+    With `limit', stop once it's certain that the stripped result
+    has more than `limit' characters between its leading and
+    trailing whitespace. The first `limit' of those are the same as
+    they'd be otherwise.
+    """
+    if not text:
+        return u''
+    if isinstance(text, str):
+        text = text.decode('utf-8')
+
+    output = []
+    size = 0
+    # Where the first non-whitespace character of the output is.
+    first = None
+
+    end = len(text)
+    pos = 0
+    while pos < end:
+        match = TEXT_END.search(text, pos)
+        stop = match.start() if match else end
+        chunk = u''
+        if stop > pos:
+            chunk = escape(normalize(text[pos:stop]))
+        pos = stop + 1
+
+        if match is None:
+            pass
+        elif text[stop] == u'&':
+            (characters, pos) = character_reference(text, pos)
+            chunk += escape(characters)
+        elif text[stop] == u'<':
+            char = text[pos] if pos < end else None
+            if char == u'!':
+                if text.startswith(u'--', pos + 1):
+                    pos = skip_comment(text, pos + 3)
+                else:
+                    # Doctypes and bogus comments both end at the
+                    # first >.
+                    pos = skip_past(text, u'>', pos + 1)
+            elif char == u'/':
+                char = text[pos + 1] if pos + 1 < end else None
+                if char is None:
+                    (chunk, pos) = (chunk + u'&lt;/', end)
+                elif char in LETTERS:
+                    pos = skip_tag(text, pos + 2)
+                elif char == u'>':
+                    pos += 2
+                else:
+                    pos = skip_past(text, u'>', pos + 1)
+            elif char is not None and char in LETTERS:
+                pos = skip_tag(text, pos + 1)
+            elif char == u'>':
+                (chunk, pos) = (chunk + u'&lt;&gt;', pos + 1)
+            elif char == u'?':
+                pos = skip_past(text, u'>', pos)
+            else:
+                chunk += u'&lt;'
+
+        if not chunk:
+            continue
+        output.append(chunk)
+        if limit is not None:
+            if first is None:
+                stripped = chunk.lstrip()
+                if stripped:
+                    first = size + len(chunk) - len(stripped)
+            size += len(chunk)
+            # Anything but whitespace past the limit means the result
+            # is going to be cut off.
+            if first is not None and size > first + limit:
+                if chunk[max(0, first + limit - size + len(chunk)):].strip():
+                    break
+    return u''.join(output)
@@ -0,0 +1,241 @@
+import time
+import arrow
+import logging
+
+from metrics import REGISTRY
+from timeline import river_store
+from updates import UpdateStream
+from storage import local_script
+from subscriptions import SUBSCRIPTIONS_KEY, FIREHOSE, sync_subscriptions
+
+logger = logging.getLogger(__name__)
+
+# How long a node's list of checked feeds outlives its last check,
+# so the lists of processes that have gone away don't pile up.
+CHECKED_TTL = 24*60*60
+
+# While handing out a batch waits on busy workers, rivers their
+# checks updated are published at most this often.
+PUBLISH_SECONDS = 1
+
+def outdated_feeds(redis_client, limit=None):
+    """
+    Return all the feeds that need to be checked.
+    """
+    if limit is None:
+        return redis_client.zrangebyscore('next_check', '-inf', arrow.utcnow().timestamp)
+    return redis_client.zrangebyscore('next_check', '-inf', arrow.utcnow().timestamp, start=0, num=limit)
+
+def upcoming_feeds(redis_client, num=5):
+    """
+    Return the feeds that are next to be checked.
+    """
+    return redis_client.zrange('next_check', 0, num - 1, withscores=True)
+
+# KEYS: next_check, subscriptions
+# ARGV: now, retry at, max feeds, node id (or ''), lease in milliseconds
+CLAIM_DUE_FEEDS = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[3])
+local claimed = {}
+for _, feed_url in ipairs(due) do
+    if redis.call('SISMEMBER', KEYS[2], feed_url) == 0 then
+        -- Unsubscribed while it was being checked.
+        redis.call('ZREM', KEYS[1], feed_url)
+    else
+        redis.call('ZADD', KEYS[1], ARGV[2], feed_url)
+        if ARGV[4] ~= '' then
+            redis.call('SET', 'lease:' .. feed_url, ARGV[4], 'PX', ARGV[5])
+        end
+        claimed[#claimed + 1] = feed_url
+    end
+end
+return claimed
+"""
+
+@local_script(CLAIM_DUE_FEEDS)
+def claim_due_feeds(client, keys, args):
+    claimed = []
+    for feed_url in client.zrangebyscore(keys[0], '-inf', args[0], start=0, num=int(args[2])):
+        if not client.sismember(keys[1], feed_url):
+            client.zrem(keys[0], feed_url)
+        else:
+            client.zadd(keys[0], feed_url, args[1])
+            if args[3] != '':
+                client.set('lease:' + feed_url, args[3], px=int(args[4]))
+            claimed.append(feed_url)
+    return claimed
+
+def lease_key(feed_url):
+    return 'lease:%s' % feed_url
+
+def checked_key(node_id):
+    """
+    ParseFeed pushes each feed here once it's been checked, waking up
+    the scheduler of the same process. Each has its own so one that
+    wakes up can clear out its list without robbing the others.
+    """
+    return 'next_check:checked:%s' % node_id
+
+def notify_checked(pipe, feed_url, node_id):
+    """
+    Queue the commands that tell the scheduler a check is done.
+    """
+    key = checked_key(node_id)
+    pipe.lpush(key, feed_url)
+    pipe.ltrim(key, 0, 9999)
+    pipe.expire(key, CHECKED_TTL)
+
+class Scheduler(object):
+    """
+    Hands feeds to the workers as soon as they come due and
+    publishes updated rivers as soon as the checks finish.
+
+    Between the two it blocks on its checked_key() until either the
+    next feed is due or a check finishes, so nothing waits on a fixed
+    polling interval or on the slowest feed in a batch.
+    """
+    def __init__(self, redis_client, inbox, args, rivers, codec, timings, subscriptions=None):
+        self.redis_client = redis_client
+        self.inbox = inbox
+        self.cli_args = args
+        self.rivers = rivers
+        self.subscriptions = subscriptions
+        self.codec = codec
+        self.timings = timings
+        self.river_store = river_store(redis_client, args)
+        self.updates = UpdateStream(redis_client, codec, args.writers)
+        self.claim_due = redis_client.register_script(CLAIM_DUE_FEEDS)
+        self.last_publish = 0
+
+    def claim_due_feeds(self):
+        """
+        Return the feeds that are due and push their next check back
+        by --claim-timeout so they aren't handed out twice. Checking
+        a feed sets its real next check.
+
+        Claiming is atomic, so any number of `river' processes can
+        share the schedule. With --distributed each claim is also a
+        lease: only the node holding it may commit the check, and if
+        the node dies the feed simply comes due again once the lease
+        runs out.
+        """
+        now = arrow.utcnow().timestamp
+        return self.claim_due(keys=['next_check', SUBSCRIPTIONS_KEY], args=[
+            now,
+            now + self.cli_args.claim_timeout,
+            self.cli_args.batch_size,
+            self.cli_args.node_id if self.cli_args.distributed else '',
+            self.cli_args.claim_timeout * 1000,
+        ])
+
+    def pending_update(self):
+        """
+        Return the update message for any rivers updated since the
+        last call, after dropping any of their buckets that are past
+        keeping, or None if there weren't any.
+        """
+        pipe = self.redis_client.pipeline()
+        pipe.smembers('updated_rivers')
+        pipe.delete('updated_rivers')
+        (updated_rivers, _) = pipe.execute()
+        if not updated_rivers:
+            return None
+
+        self.river_store.prune(list(updated_rivers))
+
+        return {
+            'available_rivers': self.rivers,
+            'updated_rivers': list(updated_rivers),
+        }
+
+    def publish_updates(self):
+        """
+        Tell river_writer about any rivers updated since the last
+        call.
+        """
+        self.last_publish = time.time()
+        update_msg = self.pending_update()
+        if update_msg is not None:
+            self.updates.publish(update_msg)
+
+    def hand_out(self, due):
+        """
+        Put each feed in the inbox. Putting blocks while the workers
+        are all busy, so before waiting on them whatever they've
+        finished so far is published.
+        """
+        for feed_url in due:
+            if self.inbox.full() and time.time() - self.last_publish >= PUBLISH_SECONDS:
+                with self.timings.stage('publish'):
+                    self.publish_updates()
+            self.inbox.put(feed_url)
+
+    def reload_subscriptions(self):
+        """
+        Apply any changes to the subscription list. Checks already
+        under way carry on; feeds that were dropped just aren't
+        handed out again.
+        """
+        try:
+            rivers = self.subscriptions.read()
+        except Exception:
+            # Say, a half-saved file. Lists are only parsed once
+            # they've been read in full, so it's tried again next time.
+            logger.exception('Failed to reload %s' % self.subscriptions.location)
+            return
+        if rivers is None:
+            return
+
+        (added, removed) = sync_subscriptions(self.redis_client, rivers)
+        self.rivers = rivers + [FIREHOSE]
+        logger.info('Reloaded %s: %d categories, %d feeds added, %d removed' % (
+            self.subscriptions.location, len(rivers), added, removed))
+
+    def seconds_until_due(self):
+        upcoming = upcoming_feeds(self.redis_client, 1)
+        if not upcoming:
+            return self.cli_args.max_wait
+        (feed_url, timestamp) = upcoming[0]
+        wait = int(timestamp - time.time()) + 1
+        return max(1, min(wait, self.cli_args.max_wait))
+
+    def wait(self):
+        """
+        Block until the next feed is due or any check finishes.
+        """
+        key = checked_key(self.cli_args.node_id)
+        timeout = self.seconds_until_due()
+        if self.redis_client.blpop(key, timeout) is not None:
+            # Several checks may have finished; one wake up covers them.
+            self.redis_client.delete(key)
+
+    def run(self):
+        last_summary = last_reload = time.time()
+        while True:
+            start = time.time()
+            if self.subscriptions is not None and start - last_reload >= self.cli_args.reload_interval:
+                with self.timings.stage('reload'):
+                    self.reload_subscriptions()
+                last_reload = start
+
+            with self.timings.stage('claim'):
+                due = self.claim_due_feeds()
+
+            self.hand_out(due)
+
+            with self.timings.stage('publish'):
+                self.publish_updates()
+
+            # One trip around the loop, not counting the wait.
+            REGISTRY.observe('cycle_seconds', time.time() - start)
+            REGISTRY.incr('claimed_total', len(due))
+
+            if time.time() - last_summary >= 60:
+                timings = self.timings.summary()
+                if timings:
+                    logger.info('Timings: %s' % timings)
+                last_summary = time.time()
+
+            # More may already be due.
+            if len(due) < self.cli_args.batch_size:
+                self.wait()
@@ -0,0 +1,957 @@
+import time
+import marshal
+import redis
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Python versions of the Lua scripts riverpy runs, keyed by their
+# source. See local_script. Every script needs one, or --sqlite can't
+# run it, and any change to a script has to be made to its twin too;
+# tests/test_storage.py runs each pair against redis and SQLite and
+# fails for a script that's missing either.
+SCRIPTS = {}
+
+# How often expired keys that nothing asked for are cleared out.
+PURGE_SECONDS = 60
+
+# Commands are committed together at most this often. Redis itself
+# only saves every so often, so a crash losing the last moment of work
+# is nothing new.
+COMMIT_SECONDS = 0.1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS keys (key BLOB PRIMARY KEY, type TEXT NOT NULL, value BLOB, expires REAL);
+CREATE TABLE IF NOT EXISTS hashes (key BLOB, field BLOB, value BLOB, PRIMARY KEY (key, field));
+CREATE TABLE IF NOT EXISTS sets (key BLOB, member BLOB, PRIMARY KEY (key, member));
+CREATE TABLE IF NOT EXISTS zsets (key BLOB, member BLOB, score REAL, PRIMARY KEY (key, member));
+CREATE INDEX IF NOT EXISTS zsets_by_score ON zsets (key, score, member);
+CREATE TABLE IF NOT EXISTS lists (key BLOB, position INTEGER, value BLOB, PRIMARY KEY (key, position));
+CREATE TABLE IF NOT EXISTS streams (key BLOB, ms INTEGER, seq INTEGER, fields BLOB, PRIMARY KEY (key, ms, seq));
+CREATE TABLE IF NOT EXISTS stream_groups (key BLOB, name BLOB, ms INTEGER, seq INTEGER, PRIMARY KEY (key, name));
+CREATE TABLE IF NOT EXISTS stream_pending (key BLOB, name BLOB, ms INTEGER, seq INTEGER, consumer BLOB, PRIMARY KEY (key, name, ms, seq));
+"""
+
+TABLES = {'hash': 'hashes', 'set': 'sets', 'zset': 'zsets', 'list': 'lists', 'stream': 'streams'}
+
+# Consumer groups and what they've been handed, which go with their
+# stream.
+GROUP_TABLES = ['stream_groups', 'stream_pending']
+
+# Stream commands, which redis-py 2.8 can only send through
+# execute_command.
+STREAM_COMMANDS = ['XADD', 'XLEN', 'XGROUP', 'XREADGROUP', 'XACK']
+
+def local_script(source):
+    """
+    Register the decorated function as what SQLiteStore runs in place
+    of the Lua script `source'. It's called as fn(client, keys, args)
+    inside a transaction, with everything as strings like redis would
+    pass them, and should return what the script would.
+    """
+    def register(fn):
+        SCRIPTS[source] = fn
+        return fn
+    return register
+
+def encode(value):
+    """
+    Turn a command argument into the string redis-py would send.
+    """
+    if isinstance(value, str):
+        return value
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+def blob(value):
+    return sqlite3.Binary(encode(value))
+
+def parse_id(value):
+    """
+    Return (ms, seq) for a stream entry id like `1526919030474-55'.
+    """
+    try:
+        (ms, _, seq) = encode(value).partition('-')
+        return (int(ms), int(seq or 0))
+    except ValueError:
+        raise redis.ResponseError('Invalid stream ID specified as stream command argument')
+
+def format_id(ms, seq):
+    return '%d-%d' % (ms, seq)
+
+def score_bound(value):
+    """
+    Return (score, exclusive) for a ZRANGEBYSCORE-style bound.
+    """
+    value = encode(value)
+    exclusive = value.startswith('(')
+    if exclusive:
+        value = value[1:]
+    return (float(value), exclusive)
+
+def index_range(count, start, end):
+    """
+    Return (offset, limit) for redis' inclusive, possibly negative,
+    `start' and `end', or None if the range is empty.
+    """
+    if start < 0:
+        start = max(count + start, 0)
+    if end < 0:
+        end = count + end
+    end = min(end, count - 1)
+    if start > end:
+        return None
+    return (start, end - start + 1)
+
+class SQLiteStore(object):
+    """
+    The parts of redis.Redis that riverpy uses, kept in a SQLite
+    database in WAL mode instead, for running everything in one
+    process without a redis server.
+
+    Every key has a row in `keys' with its type (and the value, for
+    strings); hashes, sets, sorted sets, lists and streams each have
+    a table of their own. Commands run one at a time under a lock,
+    each in a savepoint of its own, as does each pipeline with all its
+    commands. They're committed in batches every COMMIT_SECONDS. WATCH
+    is checked against a version counter kept for every key written.
+    Blocking reads (BLPOP and XREADGROUP) only wake up for clients in
+    the same process, and Lua scripts run their Python twins from
+    SCRIPTS.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        # Commits don't wait for the disk; a crash can only lose the
+        # last few, never corrupt the database.
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SCHEMA)
+
+        self.lock = threading.RLock()
+        self.pushed = threading.Condition(self.lock)
+        self.depth = 0
+        self.batch_started = None
+        self.versions = {}
+        self.expires = dict((str(key), expires) for (key, expires) in
+                            self.conn.execute('SELECT key, expires FROM keys WHERE expires IS NOT NULL'))
+        self.last_purge = time.time()
+
+        self.closed = threading.Event()
+        self.flusher = threading.Thread(target=self.flush)
+        self.flusher.daemon = True
+        self.flusher.start()
+
+    @contextmanager
+    def transaction(self):
+        with self.lock:
+            if self.depth == 0:
+                if self.batch_started is None:
+                    self.conn.execute('BEGIN')
+                    self.batch_started = time.time()
+                self.conn.execute('SAVEPOINT command')
+            self.depth += 1
+            try:
+                yield
+            except:
+                self.depth -= 1
+                if self.depth == 0:
+                    self.conn.execute('ROLLBACK TO command')
+                    self.conn.execute('RELEASE command')
+                raise
+            self.depth -= 1
+            if self.depth == 0:
+                self.conn.execute('RELEASE command')
+                if time.time() - self.batch_started >= COMMIT_SECONDS:
+                    self.commit()
+
+    @contextmanager
+    def savepoint(self):
+        """
+        Undo whatever a command does if it fails, inside a
+        transaction that carries on.
+        """
+        self.conn.execute('SAVEPOINT pipelined')
+        try:
+            yield
+        except:
+            self.conn.execute('ROLLBACK TO pipelined')
+            self.conn.execute('RELEASE pipelined')
+            raise
+        self.conn.execute('RELEASE pipelined')
+
+    def commit(self):
+        if time.time() - self.last_purge > PURGE_SECONDS:
+            self.purge()
+        self.conn.execute('COMMIT')
+        self.batch_started = None
+
+    def flush(self):
+        # Commits whatever is left once things go quiet.
+        while not self.closed.wait(COMMIT_SECONDS):
+            with self.lock:
+                if self.depth == 0 and self.batch_started is not None:
+                    self.commit()
+
+    def close(self):
+        """
+        Stop the flusher, commit whatever hasn't been yet and close
+        the database.
+        """
+        if self.closed.is_set():
+            return
+        self.closed.set()
+        self.flusher.join()
+        with self.lock:
+            if self.batch_started is not None:
+                self.commit()
+            self.conn.close()
+
+    def execute(self, sql, *params):
+        return self.conn.execute(sql, params)
+
+    def touch(self, key):
+        self.versions[key] = self.versions.get(key, 0) + 1
+
+    def version(self, key):
+        return self.versions.get(encode(key), 0)
+
+    def purge(self):
+        now = time.time()
+        for key in [key for (key, expires) in self.expires.items() if expires <= now]:
+            self.remove(key)
+        self.last_purge = now
+
+    def key_type(self, key):
+        """
+        Return the type of `key', first removing it if it expired.
+        """
+        expires = self.expires.get(key)
+        if expires is not None and expires <= time.time():
+            self.remove(key)
+            return None
+        row = self.execute('SELECT type FROM keys WHERE key = ?', blob(key)).fetchone()
+        return row[0] if row else None
+
+    def alive(self, key):
+        expires = self.expires.get(key)
+        if expires is not None and expires <= time.time():
+            self.remove(key)
+
+    def remove(self, key):
+        row = self.execute('SELECT type FROM keys WHERE key = ?', blob(key)).fetchone()
+        if row is None:
+            return False
+        if row[0] in TABLES:
+            self.execute('DELETE FROM %s WHERE key = ?' % TABLES[row[0]], blob(key))
+        if row[0] == 'stream':
+            for table in GROUP_TABLES:
+                self.execute('DELETE FROM %s WHERE key = ?' % table, blob(key))
+        self.execute('DELETE FROM keys WHERE key = ?', blob(key))
+        self.expires.pop(key, None)
+        self.touch(key)
+        return True
+
+    def create(self, key, kind):
+        """
+        Make sure `key' exists as a `kind', ready to be written.
+        """
+        current = self.key_type(key)
+        if current is None:
+            self.execute('INSERT INTO keys (key, type) VALUES (?, ?)', blob(key), kind)
+        elif current != kind:
+            raise redis.ResponseError('WRONGTYPE Operation against a key holding the wrong kind of value')
+        self.touch(key)
+
+    def drop_if_empty(self, key, kind):
+        if self.execute('SELECT 1 FROM %s WHERE key = ? LIMIT 1' % TABLES[kind], blob(key)).fetchone() is None:
+            self.execute('DELETE FROM keys WHERE key = ?', blob(key))
+            self.expires.pop(key, None)
+
+    def set_expiry(self, key, expires):
+        if expires is None:
+            self.expires.pop(key, None)
+        else:
+            self.expires[key] = expires
+        self.execute('UPDATE keys SET expires = ? WHERE key = ?', expires, blob(key))
+
+    # Keys
+
+    def delete(self, *names):
+        with self.transaction():
+            deleted = 0
+            for name in names:
+                key = encode(name)
+                self.alive(key)
+                deleted += self.remove(key)
+            return deleted
+
+    def exists(self, name):
+        with self.transaction():
+            return self.key_type(encode(name)) is not None
+
+    def type(self, name):
+        with self.transaction():
+            return self.key_type(encode(name)) or 'none'
+
+    def keys(self, pattern='*'):
+        with self.transaction():
+            self.purge()
+            return [str(key) for (key,) in self.execute('SELECT key FROM keys WHERE CAST(key AS TEXT) GLOB ?', encode(pattern))]
+
+    def expire(self, name, time_seconds):
+        return self.expireat(name, time.time() + time_seconds)
+
+    def expireat(self, name, when):
+        with self.transaction():
+            key = encode(name)
+            if self.key_type(key) is None:
+                return False
+            self.set_expiry(key, float(when))
+            self.touch(key)
+            return True
+
+    def rename(self, src, dst):
+        with self.transaction():
+            (src, dst) = (encode(src), encode(dst))
+            kind = self.key_type(src)
+            if kind is None:
+                raise redis.ResponseError('no such key')
+            self.alive(dst)
+            self.remove(dst)
+            self.execute('UPDATE keys SET key = ? WHERE key = ?', blob(dst), blob(src))
+            if kind in TABLES:
+                self.execute('UPDATE %s SET key = ? WHERE key = ?' % TABLES[kind], blob(dst), blob(src))
+            if kind == 'stream':
+                for table in GROUP_TABLES:
+                    self.execute('UPDATE %s SET key = ? WHERE key = ?' % table, blob(dst), blob(src))
+            if src in self.expires:
+                self.expires[dst] = self.expires.pop(src)
+            self.touch(src)
+            self.touch(dst)
+            return True
+
+    # Strings
+
+    def get(self, name):
+        with self.transaction():
+            key = encode(name)
+            if self.key_type(key) is None:
+                return None
+            row = self.execute("SELECT value FROM keys WHERE key = ? AND type = 'string'", blob(key)).fetchone()
+            if row is None:
+                raise redis.ResponseError('WRONGTYPE Operation against a key holding the wrong kind of value')
+            return str(row[0])
+
+    def set(self, name, value, ex=None, px=None, nx=False, xx=False):
+        with self.transaction():
+            key = encode(name)
+            exists = self.key_type(key) is not None
+            if (nx and exists) or (xx and not exists):
+                return None
+            self.remove(key)
+            expires = None
+            if ex is not None:
+                expires = time.time() + ex
+            elif px is not None:
+                expires = time.time() + px / 1000.0
+            self.execute("INSERT INTO keys (key, type, value) VALUES (?, 'string', ?)", blob(key), blob(value))
+            self.set_expiry(key, expires)
+            self.touch(key)
+            return True
+
+    def incr(self, name, amount=1):
+        return self.incrby(name, amount)
+
+    def incrby(self, name, amount=1):
+        with self.transaction():
+            key = encode(name)
+            exists = self.key_type(key) is not None
+            try:
+                value = int(self.get(key) or 0) + int(amount)
+            except ValueError:
+                raise redis.ResponseError('value is not an integer or out of range')
+            if not exists:
+                self.execute("INSERT INTO keys (key, type, value) VALUES (?, 'string', ?)", blob(key), blob(value))
+            else:
+                # Unlike SET, keeps the expiry.
+                self.execute('UPDATE keys SET value = ? WHERE key = ?', blob(value), blob(key))
+            self.touch(key)
+            return value
+
+    def getbit(self, name, offset):
+        value = self.get(name) or ''
+        (byte, bit) = divmod(int(offset), 8)
+        if byte >= len(value):
+            return 0
+        return (ord(value[byte]) >> (7 - bit)) & 1
+
+    def setbit(self, name, offset, value):
+        with self.transaction():
+            key = encode(name)
+            current = bytearray(self.get(key) or '')
+            (byte, bit) = divmod(int(offset), 8)
+            if byte >= len(current):
+                current.extend('\x00' * (byte + 1 - len(current)))
+            old = (current[byte] >> (7 - bit)) & 1
+            if int(value):
+                current[byte] |= 1 << (7 - bit)
+            else:
+                current[byte] &= ~(1 << (7 - bit)) & 0xff
+            if self.key_type(key) is None:
+                self.execute("INSERT INTO keys (key, type, value) VALUES (?, 'string', ?)", blob(key), blob(str(current)))
+            else:
+                self.execute('UPDATE keys SET value = ? WHERE key = ?', blob(str(current)), blob(key))
+            self.touch(key)
+            return old
+
+    # Hashes
+
+    def hget(self, name, key):
+        with self.transaction():
+            self.alive(encode(name))
+            row = self.execute('SELECT value FROM hashes WHERE key = ? AND field = ?', blob(name), blob(key)).fetchone()
+            return str(row[0]) if row else None
+
+    def hmget(self, name, keys, *args):
+        if isinstance(keys, basestring):
+            keys = [keys]
+        return [self.hget(name, key) for key in list(keys) + list(args)]
+
+    def hgetall(self, name):
+        with self.transaction():
+            self.alive(encode(name))
+            return dict((str(field), str(value)) for (field, value) in
+                        self.execute('SELECT field, value FROM hashes WHERE key = ?', blob(name)))
+
+    def hset(self, name, key, value):
+        with self.transaction():
+            self.create(encode(name), 'hash')
+            added = self.execute('SELECT 1 FROM hashes WHERE key = ? AND field = ?', blob(name), blob(key)).fetchone() is None
+            self.execute('INSERT OR REPLACE INTO hashes (key, field, value) VALUES (?, ?, ?)', blob(name), blob(key), blob(value))
+            return int(added)
+
+    def hmset(self, name, mapping):
+        if not mapping:
+            raise redis.DataError("'hmset' with 'mapping' of length 0")
+        with self.transaction():
+            self.create(encode(name), 'hash')
+            self.conn.executemany('INSERT OR REPLACE INTO hashes (key, field, value) VALUES (?, ?, ?)',
+                                  [(blob(name), blob(field), blob(value)) for (field, value) in mapping.items()])
+            return True
+
+    def hdel(self, name, *keys):
+        with self.transaction():
+            key = encode(name)
+            if self.key_type(key) is None:
+                return 0
+            deleted = 0
+            for field in keys:
+                deleted += self.execute('DELETE FROM hashes WHERE key = ? AND field = ?', blob(key), blob(field)).rowcount
+            self.drop_if_empty(key, 'hash')
+            self.touch(key)
+            return deleted
+
+    # Sets
+
+    def smembers(self, name):
+        with self.transaction():
+            self.alive(encode(name))
+            return set(str(member) for (member,) in self.execute('SELECT member FROM sets WHERE key = ?', blob(name)))
+
+    def sismember(self, name, value):
+        with self.transaction():
+            self.alive(encode(name))
+            return self.execute('SELECT 1 FROM sets WHERE key = ? AND member = ?', blob(name), blob(value)).fetchone() is not None
+
+    def sadd(self, name, *values):
+        with self.transaction():
+            self.create(encode(name), 'set')
+            added = 0
+            for value in values:
+                added += self.execute('INSERT OR IGNORE INTO sets (key, member) VALUES (?, ?)', blob(name), blob(value)).rowcount
+            return added
+
+    def srem(self, name, *values):
+        with self.transaction():
+            key = encode(name)
+            if self.key_type(key) is None:
+                return 0
+            removed = 0
+            for value in values:
+                removed += self.execute('DELETE FROM sets WHERE key = ? AND member = ?', blob(key), blob(value)).rowcount
+            self.drop_if_empty(key, 'set')
+            self.touch(key)
+            return removed
+
+    # Sorted sets
+
+    def zadd(self, name, *args, **kwargs):
+        """
+        Takes member, score pairs, like redis.Redis (not StrictRedis).
+        """
+        pairs = zip(args[::2], args[1::2]) + kwargs.items()
+        with self.transaction():
+            self.create(encode(name), 'zset')
+            added = 0
+            for (member, score) in pairs:
+                added += self.execute('SELECT 1 FROM zsets WHERE key = ? AND member = ?', blob(name), blob(member)).fetchone() is None
+                self.execute('INSERT OR REPLACE INTO zsets (key, member, score) VALUES (?, ?, ?)',
+                             blob(name), blob(member), float(score))
+            return added
+
+    def zrem(self, name, *values):
+        with self.transaction():
+            key = encode(name)
+            if self.key_type(key) is None:
+                return 0
+            removed = 0
+            for value in values:
+                removed += self.execute('DELETE FROM zsets WHERE key = ? AND member = ?', blob(key), blob(value)).rowcount
+            self.drop_if_empty(key, 'zset')
+            self.touch(key)
+            return removed
+
+    def zscore(self, name, value):
+        with self.transaction():
+            self.alive(encode(name))
+            row = self.execute('SELECT score FROM zsets WHERE key = ? AND member = ?', blob(name), blob(value)).fetchone()
+            return row[0] if row else None
+
+    def zcard(self, name):
+        with self.transaction():
+            self.alive(encode(name))
+            return self.execute('SELECT COUNT(*) FROM zsets WHERE key = ?', blob(name)).fetchone()[0]
+
+    def zrange(self, name, start, end, desc=False, withscores=False, score_cast_func=float):
+        with self.transaction():
+            self.alive(encode(name))
+            if start < 0 or end < 0:
+                bounds = index_range(self.zcard(name), start, end)
+            else:
+                bounds = (start, end - start + 1) if start <= end else None
+            if bounds is None:
+                return []
+            order = 'score DESC, member DESC' if desc else 'score, member'
+            rows = self.execute('SELECT member, score FROM zsets WHERE key = ? ORDER BY %s LIMIT ? OFFSET ?' % order,
+                                blob(name), bounds[1], bounds[0])
+            if withscores:
+                return [(str(member), score_cast_func(score)) for (member, score) in rows]
+            return [str(member) for (member, score) in rows]
+
+    def zrevrange(self, name, start, end, withscores=False, score_cast_func=float):
+        return self.zrange(name, start, end, desc=True, withscores=withscores, score_cast_func=score_cast_func)
+
+    def score_clause(self, min, max):
+        ((low, low_open), (high, high_open)) = (score_bound(min), score_bound(max))
+        clause = 'score %s ? AND score %s ?' % ('>' if low_open else '>=', '<' if high_open else '<=')
+        return (clause, low, high)
+
+    def zrangebyscore(self, name, min, max, start=None, num=None, withscores=False, score_cast_func=float):
+        with self.transaction():
+            self.alive(encode(name))
+            (clause, low, high) = self.score_clause(min, max)
+            limit = (num, start) if start is not None else (-1, 0)
+            rows = self.execute('SELECT member, score FROM zsets WHERE key = ? AND %s ORDER BY score, member LIMIT ? OFFSET ?' % clause,
+                                blob(name), low, high, *limit)
+            if withscores:
+                return [(str(member), score_cast_func(score)) for (member, score) in rows]
+            return [str(member) for (member, score) in rows]
+
+    def zremrangebyscore(self, name, min, max):
+        with self.transaction():
+            key = encode(name)
+            if self.key_type(key) is None:
+                return 0
+            (clause, low, high) = self.score_clause(min, max)
+            removed = self.execute('DELETE FROM zsets WHERE key = ? AND %s' % clause, blob(key), low, high).rowcount
+            self.drop_if_empty(key, 'zset')
+            self.touch(key)
+            return removed
+
+    def zremrangebyrank(self, name, min, max):
+        with self.transaction():
+            key = encode(name)
+            if self.key_type(key) is None:
+                return 0
+            bounds = index_range(self.zcard(key), min, max)
+            if bounds is None:
+                return 0
+            removed = self.execute(
+                'DELETE FROM zsets WHERE key = ? AND member IN '
+                '(SELECT member FROM zsets WHERE key = ? ORDER BY score, member LIMIT ? OFFSET ?)',
+                blob(key), blob(key), bounds[1], bounds[0]).rowcount
+            self.drop_if_empty(key, 'zset')
+            self.touch(key)
+            return removed
+
+    # Lists. Positions are always contiguous (pushes extend either
+    # end and only the ends are ever removed), so lengths and ranges
+    # come straight from the first and last positions.
+
+    def list_bounds(self, key):
+        self.alive(key)
+        # As two subqueries, so each is a single index lookup.
+        return self.execute('SELECT (SELECT MIN(position) FROM lists WHERE key = ?), '
+                            '(SELECT MAX(position) FROM lists WHERE key = ?)', blob(key), blob(key)).fetchone()
+
+    def push(self, name, values, left):
+        with self.transaction():
+            key = encode(name)
+            self.create(key, 'list')
+            (low, high) = self.list_bounds(key)
+            if low is None:
+                (low, high) = (1, 0)
+            for value in values:
+                if left:
+                    low -= 1
+                    position = low
+                else:
+                    high += 1
+                    position = high
+                self.execute('INSERT INTO lists (key, position, value) VALUES (?, ?, ?)', blob(key), position, blob(value))
+            self.pushed.notify_all()
+            return high - low + 1
+
+    def lpush(self, name, *values):
+        return self.push(name, values, left=True)
+
+    def rpush(self, name, *values):
+        return self.push(name, values, left=False)
+
+    def llen(self, name):
+        with self.transaction():
+            (low, high) = self.list_bounds(encode(name))
+            return 0 if low is None else high - low + 1
+
+    def lrange(self, name, start, end):
+        with self.transaction():
+            (low, high) = self.list_bounds(encode(name))
+            if low is None:
+                return []
+            bounds = index_range(high - low + 1, start, end)
+            if bounds is None:
+                return []
+            first = low + bounds[0]
+            return [str(value) for (value,) in self.execute(
+                'SELECT value FROM lists WHERE key = ? AND position BETWEEN ? AND ? ORDER BY position',
+                blob(name), first, first + bounds[1] - 1)]
+
+    def ltrim(self, name, start, end):
+        with self.transaction():
+            key = encode(name)
+            (low, high) = self.list_bounds(key)
+            if low is None:
+                return True
+            bounds = index_range(high - low + 1, start, end)
+            if bounds is None:
+                self.remove(key)
+                return True
+            (first, last) = (low + bounds[0], low + bounds[0] + bounds[1] - 1)
+            if (first, last) != (low, high):
+                self.execute('DELETE FROM lists WHERE key = ? AND (position < ? OR position > ?)', blob(key), first, last)
+                self.touch(key)
+            return True
+
+    def lpop(self, name):
+        with self.transaction():
+            key = encode(name)
+            self.alive(key)
+            row = self.execute('SELECT position, value FROM lists WHERE key = ? ORDER BY position LIMIT 1', blob(key)).fetchone()
+            if row is None:
+                return None
+            self.execute('DELETE FROM lists WHERE key = ? AND position = ?', blob(key), row[0])
+            self.drop_if_empty(key, 'list')
+            self.touch(key)
+            return str(row[1])
+
+    def blpop(self, keys, timeout=0):
+        if isinstance(keys, basestring):
+            keys = [keys]
+        deadline = time.time() + timeout if timeout else None
+        with self.lock:
+            while True:
+                for key in keys:
+                    value = self.lpop(key)
+                    if value is not None:
+                        return (encode(key), value)
+                remaining = deadline - time.time() if deadline else 60*60*24*365
+                if remaining <= 0:
+                    return None
+                self.pushed.wait(remaining)
+
+    # Streams. Each stream's length is kept as the value of its row in
+    # `keys', and the last id handed out is always still in the
+    # stream as trimming only drops the oldest entries.
+
+    def execute_command(self, *args):
+        command = encode(args[0]).upper()
+        if command not in STREAM_COMMANDS:
+            raise redis.ResponseError("unknown command '%s'" % command)
+        return getattr(self, command.lower())(*[encode(arg) for arg in args[1:]])
+
+    def stream_length(self, key):
+        row = self.execute("SELECT value FROM keys WHERE key = ? AND type = 'stream'", blob(key)).fetchone()
+        return int(str(row[0])) if row and row[0] is not None else 0
+
+    def last_id(self, key):
+        row = self.execute('SELECT ms, seq FROM streams WHERE key = ? ORDER BY ms DESC, seq DESC LIMIT 1', blob(key)).fetchone()
+        return tuple(row) if row else (0, 0)
+
+    def xadd(self, key, *args):
+        args = list(args)
+        maxlen = None
+        if args[0].upper() == 'MAXLEN':
+            args.pop(0)
+            if args[0] in ('~', '='):
+                args.pop(0)
+            maxlen = int(args.pop(0))
+        if args.pop(0) != '*':
+            raise redis.ResponseError('Only automatic stream ids are supported')
+        if not args or len(args) % 2:
+            raise redis.ResponseError("wrong number of arguments for 'xadd' command")
+        with self.transaction():
+            self.create(key, 'stream')
+            (last_ms, last_seq) = self.last_id(key)
+            ms = int(time.time() * 1000)
+            seq = last_seq + 1 if ms <= last_ms else 0
+            ms = max(ms, last_ms)
+            self.execute('INSERT INTO streams (key, ms, seq, fields) VALUES (?, ?, ?, ?)',
+                         blob(key), ms, seq, sqlite3.Binary(marshal.dumps(args)))
+            length = self.stream_length(key) + 1
+            if maxlen is not None and length > maxlen:
+                self.execute('DELETE FROM streams WHERE rowid IN (SELECT rowid FROM streams WHERE key = ? '
+                             'ORDER BY ms, seq LIMIT ?)', blob(key), length - maxlen)
+                length = maxlen
+            self.execute('UPDATE keys SET value = ? WHERE key = ?', blob(length), blob(key))
+            self.pushed.notify_all()
+            return format_id(ms, seq)
+
+    def xlen(self, key):
+        with self.transaction():
+            self.alive(key)
+            return self.stream_length(key)
+
+    def xgroup(self, subcommand, key, group, start='$', *options):
+        if subcommand.upper() != 'CREATE':
+            raise redis.ResponseError('Only XGROUP CREATE is supported')
+        with self.transaction():
+            kind = self.key_type(key)
+            if kind is None:
+                if 'MKSTREAM' not in [option.upper() for option in options]:
+                    raise redis.ResponseError('The XGROUP subcommand requires the key to exist. '
+                                              'Note that for CREATE you may want to use the MKSTREAM option '
+                                              'to create an empty stream automatically.')
+                self.create(key, 'stream')
+            elif kind != 'stream':
+                raise redis.ResponseError('WRONGTYPE Operation against a key holding the wrong kind of value')
+            if self.execute('SELECT 1 FROM stream_groups WHERE key = ? AND name = ?', blob(key), blob(group)).fetchone():
+                raise redis.ResponseError('BUSYGROUP Consumer Group name already exists')
+            (ms, seq) = self.last_id(key) if start == '$' else parse_id(start)
+            self.execute('INSERT INTO stream_groups (key, name, ms, seq) VALUES (?, ?, ?, ?)', blob(key), blob(group), ms, seq)
+            return 'OK'
+
+    def read_group(self, key, group, consumer, start, count):
+        """
+        Return the entries XREADGROUP would for one stream.
+        """
+        self.alive(key)
+        row = self.execute('SELECT ms, seq FROM stream_groups WHERE key = ? AND name = ?', blob(key), blob(group)).fetchone()
+        if row is None:
+            raise redis.ResponseError("NOGROUP No such key '%s' or consumer group '%s' in XREADGROUP with GROUP option" % (key, group))
+        limit = -1 if count is None else count
+        if start != '>':
+            # What was handed to this consumer and not yet
+            # acknowledged, even if it's since been trimmed.
+            (ms, seq) = parse_id(start)
+            rows = self.execute(
+                'SELECT p.ms, p.seq, s.fields FROM stream_pending p LEFT JOIN streams s '
+                'ON s.key = p.key AND s.ms = p.ms AND s.seq = p.seq '
+                'WHERE p.key = ? AND p.name = ? AND p.consumer = ? AND (p.ms, p.seq) > (?, ?) '
+                'ORDER BY p.ms, p.seq LIMIT ?', blob(key), blob(group), blob(consumer), ms, seq, limit).fetchall()
+        else:
+            rows = self.execute(
+                'SELECT ms, seq, fields FROM streams WHERE key = ? AND (ms, seq) > (?, ?) '
+                'ORDER BY ms, seq LIMIT ?', blob(key), row[0], row[1], limit).fetchall()
+            for (ms, seq, fields) in rows:
+                self.execute('INSERT OR REPLACE INTO stream_pending (key, name, ms, seq, consumer) VALUES (?, ?, ?, ?, ?)',
+                             blob(key), blob(group), ms, seq, blob(consumer))
+            if rows:
+                self.execute('UPDATE stream_groups SET ms = ?, seq = ? WHERE key = ? AND name = ?',
+                             rows[-1][0], rows[-1][1], blob(key), blob(group))
+        return [[format_id(ms, seq), marshal.loads(str(fields)) if fields is not None else None]
+                for (ms, seq, fields) in rows]
+
+    def xreadgroup(self, *args):
+        args = list(args)
+        if len(args) < 3 or args[0].upper() != 'GROUP':
+            raise redis.ResponseError('Missing GROUP option for XREADGROUP')
+        (group, consumer) = (args[1], args[2])
+        args = args[3:]
+        (count, block) = (None, None)
+        while args and args[0].upper() != 'STREAMS':
+            option = args.pop(0).upper()
+            if option == 'COUNT':
+                count = int(args.pop(0))
+            elif option == 'BLOCK':
+                block = int(args.pop(0))
+            elif option != 'NOACK':
+                raise redis.ResponseError('syntax error')
+        streams = args[1:]
+        if not streams or len(streams) % 2:
+            raise redis.ResponseError("Unbalanced 'xreadgroup' list of streams")
+        pairs = zip(streams[:len(streams) // 2], streams[len(streams) // 2:])
+        waiting = block is not None and all(start == '>' for (key, start) in pairs)
+        deadline = time.time() + block / 1000.0 if block else None
+        with self.lock:
+            while True:
+                reply = []
+                with self.transaction():
+                    for (key, start) in pairs:
+                        entries = self.read_group(key, group, consumer, start, count)
+                        if entries or start != '>':
+                            reply.append([key, entries])
+                if reply or not waiting:
+                    return reply or None
+                remaining = deadline - time.time() if deadline else 60*60*24*365
+                if remaining <= 0:
+                    return None
+                self.pushed.wait(remaining)
+
+    def xack(self, key, group, *ids):
+        with self.transaction():
+            acknowledged = 0
+            for entry_id in ids:
+                (ms, seq) = parse_id(entry_id)
+                acknowledged += self.execute('DELETE FROM stream_pending WHERE key = ? AND name = ? AND ms = ? AND seq = ?',
+                                             blob(key), blob(group), ms, seq).rowcount
+            return acknowledged
+
+    # Pipelines and scripts
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return LocalPipeline(self)
+
+    def register_script(self, script):
+        if script not in SCRIPTS:
+            raise redis.ResponseError('No Python version of this script')
+        return LocalScript(self, SCRIPTS[script])
+
+    def flushdb(self):
+        with self.transaction():
+            for table in ['keys'] + TABLES.values() + GROUP_TABLES:
+                self.execute('DELETE FROM %s' % table)
+            self.expires.clear()
+            self.versions.clear()
+            return True
+
+class LocalScript(object):
+    def __init__(self, store, fn):
+        self.store = store
+        self.fn = fn
+
+    def __call__(self, keys=[], args=[], client=None):
+        keys = [encode(key) for key in keys]
+        args = [encode(arg) for arg in args]
+        if isinstance(client, LocalPipeline):
+            client.commands.append((self.run, (keys, args), {}))
+            return client
+        return self.run(keys, args)
+
+    def run(self, keys, args):
+        with self.store.transaction():
+            return self.fn(self.store, keys, args)
+
+class LocalPipeline(object):
+    """
+    Queues commands and runs them in one transaction. After watch()
+    and until multi() commands run straight away, as with redis-py.
+
+    As in redis, a command that fails doesn't stop the others or undo
+    them; once they've all run, the first error is raised. Unlike
+    redis, a pipeline made with transaction=False still runs all at
+    once, and a script that fails leaves nothing behind.
+    """
+    def __init__(self, store):
+        self.store = store
+        self.reset()
+
+    def reset(self):
+        self.commands = []
+        self.watching = {}
+        self.explicit = False
+
+    def watch(self, *names):
+        for name in names:
+            self.watching[encode(name)] = self.store.version(name)
+
+    def multi(self):
+        self.explicit = True
+
+    def execute(self):
+        try:
+            with self.store.transaction():
+                for (key, version) in self.watching.items():
+                    if self.store.version(key) != version:
+                        raise redis.WatchError('Watched variable changed.')
+                results = []
+                for (command, args, kwargs) in self.commands:
+                    try:
+                        with self.store.savepoint():
+                            results.append(command(*args, **kwargs))
+                    except redis.ResponseError as ex:
+                        results.append(ex)
+        finally:
+            self.reset()
+        for result in results:
+            if isinstance(result, redis.ResponseError):
+                raise result
+        return results
+
+    def __getattr__(self, name):
+        command = getattr(self.store, name)
+
+        def queue(*args, **kwargs):
+            if self.watching and not self.explicit:
+                return command(*args, **kwargs)
+            self.commands.append((command, args, kwargs))
+            return self
+        return queue
+
+# One store per database in each process, shared by every thread, so
+# that blocking reads wake up for the other threads.
+stores = {}
+stores_lock = threading.Lock()
+
+def open_storage(args):
+    """
+    Return the client every part of `river' keeps its state with:
+    redis, or the SQLite database given by --sqlite.
+    """
+    if not args.sqlite:
+        return redis.Redis(
+            host=args.redis_host,
+            port=args.redis_port,
+            db=args.redis_db,
+        )
+    with stores_lock:
+        if args.sqlite not in stores:
+            logger.info('Keeping state in %s' % args.sqlite)
+            stores[args.sqlite] = SQLiteStore(args.sqlite)
+        return stores[args.sqlite]
+
+def close_storage():
+    """
+    Close every SQLite database open_storage() opened, committing
+    what's left.
+    """
+    with stores_lock:
+        for store in stores.values():
+            store.close()
+        stores.clear()
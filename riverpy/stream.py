@@ -0,0 +1,202 @@
+import re
+import requests
+import feedparser
+from lxml import etree
+
+from parse import entry_fingerprint, entry_timestamp
+
+# Elements whose contents feedparser throws away along with the tags.
+UNACCEPTABLE = re.compile(r'<(script|applet|style)\b.*?</\1\s*>', re.I | re.S)
+
+# Where each date ends up in a feedparser entry.
+DATES = {
+    'pubDate': 'published_parsed',
+    'published': 'published_parsed',
+    'issued': 'published_parsed',
+    'date': 'published_parsed',
+    'updated': 'updated_parsed',
+    'modified': 'updated_parsed',
+    'created': 'created_parsed',
+}
+
+class FeedTooLarge(requests.exceptions.RequestException):
+    pass
+
+def discard(response):
+    """
+    Close a response that won't be read to the end. Its connection
+    is closed too so it isn't reused with the rest of the body still
+    waiting to be read.
+    """
+    connection = getattr(response.raw, '_connection', None)
+    if connection is not None:
+        connection.close()
+    response.close()
+
+def read_content(response, limit, chunk_size=64*1024):
+    """
+    Read the body of a response made with stream=True into
+    response.content, giving up once it's over `limit' bytes.
+    """
+    chunks = []
+    size = 0
+    for chunk in response.iter_content(chunk_size):
+        size += len(chunk)
+        if size > limit:
+            discard(response)
+            raise FeedTooLarge('%s is over %d bytes' % (response.url, limit))
+        chunks.append(chunk)
+    response._content = ''.join(chunks)
+    return response.content
+
+def local_name(elem):
+    tag = elem.tag
+    if not isinstance(tag, basestring):
+        # Comments and processing instructions.
+        return None
+    return tag.rsplit('}', 1)[-1]
+
+def element_text(elem):
+    """
+    Return the text of an element, including any markup inside it
+    (e.g., Atom's type="xhtml").
+    """
+    text = elem.text or u''
+    if len(elem):
+        text += u''.join(etree.tostring(child, encoding=unicode) for child in elem)
+    return text
+
+def element_link(elem):
+    if elem.get('href') is not None:
+        if elem.get('rel', 'alternate') == 'alternate':
+            return elem.get('href')
+        return None
+    return elem.text
+
+def stream_entry(elem):
+    """
+    Return the same dict parse_feed does for an <item> or <entry>.
+    """
+    entry = {}
+    content = None
+    for child in elem.iterchildren():
+        name = local_name(child)
+        if name == 'title':
+            entry.setdefault('title', element_text(child))
+        elif name in ('description', 'summary', 'abstract'):
+            entry.setdefault('description', element_text(child))
+        elif name in ('encoded', 'content', 'fullitem') and content is None:
+            content = element_text(child)
+        elif name == 'link':
+            link = element_link(child)
+            if link and 'link' not in entry:
+                entry['link'] = link.strip()
+        elif name in ('guid', 'id'):
+            entry.setdefault('guid', (child.text or u'').strip())
+        elif name == 'comments':
+            entry.setdefault('comments', (child.text or u'').strip())
+        elif name in DATES and child.text:
+            entry.setdefault(DATES[name], feedparser._parse_date(child.text.strip()))
+
+    # feedparser falls back on the full content for the summary.
+    if 'description' not in entry and content is not None:
+        entry['description'] = content
+    if entry.get('description'):
+        entry['description'] = UNACCEPTABLE.sub(u'', entry['description'])
+
+    return {
+        'fingerprint': entry_fingerprint(entry),
+        'timestamp': entry_timestamp(entry).timestamp,
+        'title': entry.get('title'),
+        'description': entry.get('description'),
+        'link': entry.get('link'),
+        'comments': entry.get('comments'),
+    }
+
+class FeedStream(object):
+    """
+    A feed that's parsed as it downloads, so that only one entry at
+    a time is held in memory and the rest of a big feed isn't even
+    downloaded once the caller has seen enough.
+
+    Iterate over it for the entries; `feed' fills in as the feed's
+    title, link and description turn up.
+    """
+    def __init__(self, response, limit, chunk_size=64*1024):
+        self.response = response
+        self.limit = limit
+        self.chunks = response.iter_content(chunk_size)
+        self.buffer = ''
+        self.size = 0
+        self.finished = False
+        self.feed = {'title': '', 'description': '', 'link': ''}
+        # Called once the body has been read or given up on.
+        self.closing = []
+
+    def read(self, size=-1):
+        # Called by iterparse, which only asks for more as it needs it.
+        while not self.buffer:
+            try:
+                chunk = next(self.chunks)
+            except StopIteration:
+                self.finished = True
+                return ''
+            self.size += len(chunk)
+            if self.size > self.limit:
+                raise FeedTooLarge('%s is over %d bytes' % (self.response.url, self.limit))
+            self.buffer = chunk
+        if size < 0:
+            size = len(self.buffer)
+        (data, self.buffer) = (self.buffer[:size], self.buffer[size:])
+        return data
+
+    def feed_element(self, elem):
+        name = local_name(elem)
+        if name == 'link' and elem.get('rel') in ('hub', 'self') and elem.get('href'):
+            self.feed.setdefault(elem.get('rel'), elem.get('href'))
+        elif name == 'link':
+            link = element_link(elem)
+            if link and not self.feed['link']:
+                self.feed['link'] = link.strip()
+        elif name == 'title' and not self.feed['title']:
+            self.feed['title'] = element_text(elem)
+        elif name in ('description', 'subtitle', 'tagline') and not self.feed['description']:
+            self.feed['description'] = element_text(elem)
+
+    def __iter__(self):
+        try:
+            events = etree.iterparse(self, events=('end',), recover=True,
+                                     resolve_entities=False, no_network=True)
+            for (event, elem) in events:
+                name = local_name(elem)
+                parent = elem.getparent()
+                if name in ('item', 'entry'):
+                    yield stream_entry(elem)
+                    # Throw away everything parsed so far.
+                    elem.clear()
+                    while parent is not None and elem.getprevious() is not None:
+                        del parent[0]
+                elif parent is not None and local_name(parent) in ('channel', 'feed'):
+                    self.feed_element(elem)
+        except etree.XMLSyntaxError as ex:
+            raise ValueError(str(ex))
+        finally:
+            self.close()
+
+    def close(self):
+        if not self.finished:
+            discard(self.response)
+            self.finished = True
+        (callbacks, self.closing) = (self.closing, [])
+        for callback in callbacks:
+            callback()
+
+def release_when_read(content, release):
+    """
+    Call `release' once the body of a download has been read: right
+    away, unless `content' is a FeedStream that's yet to be read.
+    """
+    if isinstance(content, FeedStream):
+        content.closing.append(release)
+    else:
+        release()
@@ -0,0 +1,89 @@
+import logging
+
+from parser import ListCache, ListResolver
+
+logger = logging.getLogger(__name__)
+
+# Every feed in the subscription list. Feeds that aren't in it are
+# dropped from the schedule the next time they come due.
+SUBSCRIPTIONS_KEY = 'subscriptions'
+
+FIREHOSE = {'title': 'Firehose', 'name': 'firehose'}
+
+class SubscriptionList(object):
+    """
+    A subscription list that's cheap to read again. Remote lists are
+    fetched with conditional GETs, kept in `cache_dir' if given, and
+    a list is only parsed again once it changes. For OPML that goes
+    for every list it includes too.
+    """
+    def __init__(self, location, cache_dir=None, workers=8):
+        self.location = location
+        self.resolver = ListResolver(ListCache(cache_dir), workers)
+
+    def read(self):
+        """
+        Return the rivers in the list, or None if neither it nor any
+        list it includes has changed since the last read.
+        """
+        self.resolver.load(self.location)
+        if not self.resolver.changed:
+            return None
+        rivers = list(self.resolver.rivers(self.location))
+        self.resolver.changed = False
+        return rivers
+
+def sync_subscriptions(redis_client, rivers):
+    """
+    Make the scheduled feeds, and the rivers each one belongs to,
+    match `rivers'. Returns (added, removed) feed counts.
+
+    Reading takes two round trips (three the first time) and every
+    change is applied at once in a single MULTI/EXEC. Feeds that were
+    dropped lose their schedule and river memberships. Their seen
+    entries are kept, so subscribing again doesn't repeat old items.
+    """
+    wanted = {}
+    for river in rivers:
+        for feed_url in river['feeds']:
+            wanted.setdefault(feed_url, set()).add(river['name'])
+
+    subscribed = redis_client.smembers(SUBSCRIPTIONS_KEY)
+    if not subscribed:
+        # Older versions of riverpy only kept the schedule.
+        known = set(redis_client.zrange('next_check', 0, -1))
+    else:
+        known = subscribed
+
+    feed_urls = list(known | set(wanted))
+    pipe = redis_client.pipeline(transaction=False)
+    for feed_url in feed_urls:
+        pipe.smembers('%s:rivers' % feed_url)
+        pipe.zscore('next_check', feed_url)
+    results = pipe.execute()
+
+    (added, removed) = (0, 0)
+    pipe = redis_client.pipeline()
+    for (n, feed_url) in enumerate(feed_urls):
+        (current, scheduled) = (results[2 * n], results[2 * n + 1])
+        rivers_key = '%s:rivers' % feed_url
+        if feed_url not in wanted:
+            pipe.srem(SUBSCRIPTIONS_KEY, feed_url)
+            pipe.zrem('next_check', feed_url)
+            pipe.delete(rivers_key, '%s:failures' % feed_url)
+            removed += 1
+            continue
+
+        names = wanted[feed_url]
+        if names - current:
+            pipe.sadd(rivers_key, *(names - current))
+        if current - names:
+            pipe.srem(rivers_key, *(current - names))
+        if feed_url not in subscribed:
+            pipe.sadd(SUBSCRIPTIONS_KEY, feed_url)
+        if feed_url not in known:
+            added += 1
+        if scheduled is None:
+            pipe.zadd('next_check', feed_url, -1)
+    pipe.execute()
+    return (added, removed)
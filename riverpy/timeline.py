@@ -0,0 +1,191 @@
+import zlib
+import time
+import logging
+import operator
+import itertools
+
+from codec import loads
+
+logger = logging.getLogger(__name__)
+
+# How many buckets to read per round trip when looking for the
+# newest updates. The first one or two almost always have enough.
+READ_AHEAD = 4
+
+def index_key(river_name):
+    return 'rivers:%s:buckets' % river_name
+
+def legacy_key(river_name):
+    return 'rivers:%s' % river_name
+
+class RiverStore(object):
+    """
+    River updates kept in time buckets.
+
+    Each bucket is a sorted set of stored updates scored by the id of
+    their first item, so newest-first is highest score first. A
+    river's buckets are indexed in `rivers:<name>:buckets' by when
+    they start. Every update goes to the firehose, so its buckets can
+    be spread over several keys by feed.
+
+    Old updates are dropped a whole bucket at a time: once a bucket
+    is more than `max_age' seconds old, or once the buckets after it
+    hold at least `min_updates' updates. Closed buckets never change
+    otherwise.
+    """
+    def __init__(self, redis_client, bucket_seconds=3600, max_age=0, min_updates=100, firehose_shards=1):
+        self.redis_client = redis_client
+        self.bucket_seconds = bucket_seconds
+        self.max_age = max_age
+        self.min_updates = min_updates
+        self.firehose_shards = firehose_shards
+
+    def bucket_start(self, now):
+        return int(now) - int(now) % self.bucket_seconds
+
+    def bucket_key(self, river_name, start, feed_url):
+        key = 'rivers:%s:%d' % (river_name, start)
+        if river_name == 'firehose' and self.firehose_shards > 1:
+            key += ':%d' % ((zlib.crc32(feed_url) & 0xffffffff) % self.firehose_shards)
+        return key
+
+    def add(self, pipe, river_name, update_id, stored_update, feed_url, now=None):
+        """
+        Queue the commands that add a stored update to a river.
+        """
+        start = self.bucket_start(now or time.time())
+        key = self.bucket_key(river_name, start, feed_url)
+        pipe.zadd(key, stored_update, update_id)
+        pipe.zadd(index_key(river_name), key, start)
+        if self.max_age:
+            pipe.expireat(key, start + self.bucket_seconds + self.max_age)
+
+    def buckets(self, river_names):
+        """
+        Return a dict mapping each river to a newest-first list of
+        (start, keys) for its buckets, all in one round trip.
+        """
+        pipe = self.redis_client.pipeline(transaction=False)
+        for river_name in river_names:
+            pipe.zrevrange(index_key(river_name), 0, -1, withscores=True)
+        results = {}
+        for (river_name, index) in zip(river_names, pipe.execute()):
+            buckets = []
+            for (start, keys) in itertools.groupby(index, key=lambda item: int(item[1])):
+                buckets.append((start, [key for (key, score) in keys]))
+            results[river_name] = buckets
+        return results
+
+    def read_buckets(self, buckets, limit=None, withscores=False):
+        """
+        Return the newest `limit' stored updates of each bucket in
+        `buckets', newest first. With `withscores' they come as
+        (stored_update, update_id) pairs.
+        """
+        pipe = self.redis_client.pipeline(transaction=False)
+        for (start, keys) in buckets:
+            for key in keys:
+                pipe.zrevrange(key, 0, -1 if limit is None else limit - 1, withscores=True)
+        results = iter(pipe.execute())
+        updates = []
+        for (start, keys) in buckets:
+            # Shards of the same bucket interleave.
+            merged = []
+            for key in keys:
+                merged.extend(next(results))
+            merged.sort(key=operator.itemgetter(1), reverse=True)
+            if withscores:
+                updates.append([(stored_update, int(score)) for (stored_update, score) in merged[:limit]])
+            else:
+                updates.append([stored_update for (stored_update, score) in merged[:limit]])
+        return updates
+
+    def bucket_updates(self, keys):
+        """
+        Return every stored update in one bucket, newest first.
+        """
+        return self.read_buckets([(None, keys)])[0]
+
+    def latest(self, buckets, limit, withscores=False):
+        """
+        Return the `limit' newest stored updates, reading as few of
+        `buckets' as it takes.
+        """
+        updates = []
+        for n in xrange(0, len(buckets), READ_AHEAD):
+            for bucket in self.read_buckets(buckets[n:n + READ_AHEAD], limit - len(updates), withscores):
+                updates.extend(bucket[:limit - len(updates)])
+                if len(updates) >= limit:
+                    return updates
+        return updates
+
+    def prune(self, river_names, now=None):
+        """
+        Drop the buckets of `river_names' that are too old or that are
+        no longer needed to keep `min_updates' updates around.
+        """
+        if not river_names:
+            return
+        now = now or time.time()
+        if self.max_age:
+            # The keys expire on their own; only the index needs
+            # cleaning up.
+            pipe = self.redis_client.pipeline(transaction=False)
+            for river_name in river_names:
+                pipe.zremrangebyscore(index_key(river_name), '-inf', now - self.max_age - self.bucket_seconds)
+            pipe.execute()
+
+        river_buckets = self.buckets(river_names)
+        pipe = self.redis_client.pipeline(transaction=False)
+        for river_name in river_names:
+            for (start, keys) in river_buckets[river_name]:
+                for key in keys:
+                    pipe.zcard(key)
+        sizes = iter(pipe.execute())
+
+        pipe = self.redis_client.pipeline(transaction=False)
+        for river_name in river_names:
+            kept = 0
+            stale = []
+            for (start, keys) in river_buckets[river_name]:
+                if kept >= self.min_updates:
+                    stale.extend(keys)
+                for key in keys:
+                    kept += next(sizes)
+            if stale:
+                logger.debug('Dropping %d old buckets from %s' % (len(stale), river_name))
+                pipe.delete(*stale)
+                pipe.zrem(index_key(river_name), *stale)
+        pipe.execute()
+
+    def adopt_legacy(self, river_name):
+        """
+        Move a river stored by older versions of riverpy (a plain list
+        at `rivers:<name>') into the current bucket. Returns how many
+        updates were moved.
+        """
+        key = legacy_key(river_name)
+        if self.redis_client.type(key) != 'list':
+            return 0
+        stored_updates = self.redis_client.lrange(key, 0, -1)
+        pipe = self.redis_client.pipeline()
+        for stored_update in stored_updates:
+            update = loads(stored_update)
+            update_id = int(update['item'][0]['id'])
+            self.add(pipe, river_name, update_id, stored_update, update['feedUrl'])
+        pipe.delete(key)
+        pipe.sadd('updated_rivers', river_name)
+        pipe.execute()
+        return len(stored_updates)
+
+def river_store(redis_client, args):
+    """
+    Return the RiverStore `river' was configured with.
+    """
+    return RiverStore(
+        redis_client,
+        bucket_seconds=args.bucket_seconds,
+        max_age=args.max_age,
+        min_updates=args.entries,
+        firehose_shards=args.firehose_shards,
+    )
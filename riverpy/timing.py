@@ -0,0 +1,99 @@
+import os
+import time
+import cProfile
+import threading
+from contextlib import contextmanager
+from collections import defaultdict
+
+from metrics import REGISTRY
+
+class StageTimings(object):
+    """
+    Thread-safe running totals of how long each stage of a feed
+    check takes.
+
+    Every stage is also recorded in `metrics' as a histogram, which
+    unlike the totals is never reset.
+    """
+    def __init__(self, metrics=REGISTRY, profiler=None):
+        self.lock = threading.Lock()
+        self.metrics = metrics
+        self.profiler = profiler
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.totals = defaultdict(float)
+            self.counts = defaultdict(int)
+
+    def record(self, stage, seconds):
+        with self.lock:
+            self.totals[stage] += seconds
+            self.counts[stage] += 1
+        self.metrics.observe('stage_seconds', seconds, stage=stage)
+
+    @contextmanager
+    def stage(self, name):
+        if self.profiler is not None:
+            self.profiler.enter(name)
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, time.time() - start)
+            if self.profiler is not None:
+                self.profiler.exit()
+
+    def summary(self):
+        """
+        Return a one-line summary of the totals and reset them.
+        """
+        with self.lock:
+            parts = ['%s %.1fms avg/%.1fs total (%d)' % (
+                stage,
+                1000 * self.totals[stage] / self.counts[stage],
+                self.totals[stage],
+                self.counts[stage],
+            ) for stage in sorted(self.counts)]
+        self.reset()
+        return ', '.join(parts)
+
+class StageProfiler(object):
+    """
+    A cProfile profile of each stage StageTimings times. A stage only
+    gets what runs in it directly: the profile of the stage around a
+    nested one is paused until it's done.
+
+    Only one thread at a time can be profiled, so this is for runs
+    that check feeds one by one, like `river --replay'.
+    """
+    def __init__(self):
+        self.profiles = {}
+        self.active = []
+
+    def enter(self, name):
+        if self.active:
+            self.active[-1].disable()
+        if name not in self.profiles:
+            self.profiles[name] = cProfile.Profile()
+        self.active.append(self.profiles[name])
+        self.profiles[name].enable()
+
+    def exit(self):
+        self.active.pop().disable()
+        if self.active:
+            self.active[-1].enable()
+
+    def dump(self, directory):
+        """
+        Write each stage's profile to <stage>.prof in `directory',
+        for reading with pstats. Returns the paths written.
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        paths = []
+        for (name, profile) in sorted(self.profiles.items()):
+            path = os.path.join(directory, '%s.prof' % name)
+            profile.dump_stats(path)
+            paths.append(path)
+        return paths
@@ -0,0 +1,190 @@
+import zlib
+import time
+import redis
+import logging
+from collections import defaultdict
+
+from codec import loads
+
+logger = logging.getLogger(__name__)
+
+# The consumer group every river-writer reads through.
+GROUP = 'river-writer'
+
+# Roughly how many updates each stream keeps. A writer that's down
+# for longer than that misses the oldest, which only matters for
+# rivers that haven't been updated since.
+MAX_LENGTH = 10000
+
+# Most entries to read at once.
+READ_COUNT = 1000
+
+# How many writers `river' is splitting updates between.
+WRITERS_KEY = 'updates:writers'
+
+# Rivers that have been written at least once, which are the ones
+# the manifest lists.
+WRITTEN_KEY = 'written_rivers'
+
+# XADD and consumer groups first shipped in redis 5.0. The redis
+# module speaks to them through execute_command, so it's only the
+# server that has to be new enough.
+MIN_REDIS_VERSION = (5, 0)
+
+def check_redis_version(redis_client):
+    """
+    Exit unless the redis server can hold the update streams.
+    """
+    version = redis_client.info('server')['redis_version']
+    if tuple(int(n) for n in version.split('.')[:2]) < MIN_REDIS_VERSION:
+        raise SystemExit('riverpy passes updates through redis streams, which need redis %s or later; this server is %s. Exiting.' % (
+            '.'.join(str(n) for n in MIN_REDIS_VERSION), version))
+
+def stream_key(writer_index):
+    return 'updates:%d' % writer_index
+
+def river_writer_index(river_name, writers):
+    return (zlib.crc32(river_name) & 0xffffffff) % writers
+
+class UpdateStream(object):
+    """
+    Tells river-writer which rivers were updated through a redis
+    stream per writer, split by river name so that each river is only
+    ever written by one of them.
+
+    Entries stay in the stream until the writer has acknowledged
+    them, so a writer that's down or slow catches up instead of
+    missing updates.
+    """
+    def __init__(self, redis_client, codec, writers=1):
+        self.redis_client = redis_client
+        self.codec = codec
+        self.writers = writers
+
+    def announce(self):
+        self.redis_client.set(WRITERS_KEY, self.writers)
+
+    def add(self, pipe, writer_index, available_rivers, river_names):
+        # Only what the manifest needs; the feeds would make every
+        # entry as big as the subscription list.
+        update_msg = {
+            'available_rivers': [{'name': river['name'], 'title': river['title']} for river in available_rivers],
+            'updated_rivers': river_names,
+        }
+        pipe.execute_command('XADD', stream_key(writer_index), 'MAXLEN', '~', MAX_LENGTH,
+                             '*', 'update', self.codec.dumps(update_msg))
+
+    def publish(self, update_msg):
+        """
+        Hand each updated river in `update_msg' to its writer.
+        """
+        writers = defaultdict(list)
+        for river_name in update_msg['updated_rivers']:
+            writers[river_writer_index(river_name, self.writers)].append(river_name)
+        pipe = self.redis_client.pipeline(transaction=False)
+        for (writer_index, river_names) in sorted(writers.items()):
+            self.add(pipe, writer_index, update_msg['available_rivers'], sorted(river_names))
+        pipe.execute()
+
+    def request_manifest(self, available_rivers):
+        """
+        Have the first writer, which writes the manifest, look for
+        newly written rivers.
+        """
+        pipe = self.redis_client.pipeline(transaction=False)
+        self.add(pipe, 0, available_rivers, [])
+        pipe.execute()
+
+class UpdateReader(object):
+    """
+    Reads one writer's stream as a member of the river-writer
+    consumer group.
+    """
+    def __init__(self, redis_client, writer_index=0):
+        self.redis_client = redis_client
+        self.key = stream_key(writer_index)
+        # The same name after a restart, so it gets back what it had
+        # been handed but never acknowledged.
+        self.consumer = 'writer-%d' % writer_index
+
+    def create_group(self):
+        try:
+            # From the start of the stream, so updates made before
+            # the first writer ever ran are written too.
+            self.redis_client.execute_command('XGROUP', 'CREATE', self.key, GROUP, '0', 'MKSTREAM')
+        except redis.ResponseError as ex:
+            if 'BUSYGROUP' not in str(ex):
+                raise
+
+    def read(self, start, block=None):
+        """
+        Return (entry_id, update_msg) pairs after `start', which is
+        '>' for entries no writer has been handed yet. update_msg is
+        None for entries trimmed from the stream before they were
+        acknowledged.
+        """
+        command = ['XREADGROUP', 'GROUP', GROUP, self.consumer, 'COUNT', READ_COUNT]
+        if block is not None:
+            command.extend(['BLOCK', block])
+        command.extend(['STREAMS', self.key, start])
+        reply = self.redis_client.execute_command(*command)
+        if not reply:
+            return []
+        entries = []
+        for (entry_id, fields) in reply[0][1]:
+            fields = dict(zip(fields[::2], fields[1::2])) if fields else {}
+            entries.append((entry_id, loads(fields['update']) if 'update' in fields else None))
+        return entries
+
+    def backlog(self):
+        """
+        Return what this writer was handed before it last stopped but
+        never acknowledged.
+        """
+        (entries, start) = ([], '0')
+        while True:
+            batch = self.read(start)
+            if not batch:
+                return entries
+            entries.extend(batch)
+            start = batch[-1][0]
+
+    def acknowledge(self, entry_ids):
+        for n in xrange(0, len(entry_ids), READ_COUNT):
+            self.redis_client.execute_command('XACK', self.key, GROUP, *entry_ids[n:n + READ_COUNT])
+
+    def messages(self, window):
+        """
+        Yield update messages, merging whatever arrives within
+        `window' seconds of the first into one. Entries are only
+        acknowledged once the next message is asked for, that is once
+        the last one has been written.
+        """
+        self.create_group()
+        entries = self.backlog()
+        if entries:
+            logger.info('Catching up on %d updates to %s' % (len(entries), self.key))
+        while True:
+            if not entries:
+                # BLOCK 0 waits for as long as it takes.
+                entries = self.read('>', 0)
+                deadline = time.time() + window
+                while True:
+                    remaining = int((deadline - time.time()) * 1000)
+                    if remaining <= 0:
+                        break
+                    entries.extend(self.read('>', remaining))
+
+            available_rivers = None
+            updated_rivers = set()
+            for (entry_id, update_msg) in entries:
+                if update_msg is not None:
+                    available_rivers = update_msg['available_rivers']
+                    updated_rivers.update(update_msg['updated_rivers'])
+            if available_rivers is not None:
+                yield {
+                    'available_rivers': available_rivers,
+                    'updated_rivers': sorted(updated_rivers),
+                }
+            self.acknowledge([entry_id for (entry_id, update_msg) in entries])
+            entries = []
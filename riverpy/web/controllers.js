@@ -6,7 +6,18 @@ riverApp.filter('convertDate', function() {
     };
 });
 
-riverApp.controller('RiverController', ['$scope', '$http', function($scope, $http) {
+// How often to check head.js for new updates, in milliseconds.
+var POLL_INTERVAL = 60 * 1000;
+
+function headUrl(riverUrl) {
+    return riverUrl.replace(/\.js$/, '/head.js');
+}
+
+function updateId(feed) {
+    return parseInt(feed.item[0].id, 10);
+}
+
+riverApp.controller('RiverController', ['$scope', '$http', '$q', '$interval', function($scope, $http, $q, $interval) {
     $http.get('manifest.js').success(function(obj) {
 	$scope.loading = true;
 	$scope.rivers = obj;
@@ -14,23 +25,81 @@ riverApp.controller('RiverController', ['$scope', '$http', function($scope, $htt
 	$scope.loading = false;
     });
 
-    $scope.$watch('currentRiver', function() {
-	if ($scope.currentRiver) {
-	    $scope.loading = true;
-	    $http.get($scope.currentRiver.url).success(function(obj) {
+    function load() {
+	$scope.loading = true;
+	var river = $scope.currentRiver;
+	$http.get(river.url).success(function(obj) {
+	    if (river === $scope.currentRiver) {
 		$scope.riverObj = obj;
-	    });
+	    }
+	})['finally'](function() {
 	    $scope.loading = false;
+	});
+    }
+
+    // Fetch only the deltas since the head we have, and fall back
+    // on the whole river when there's a gap (or no deltas at all).
+    function catchUp() {
+	var river = $scope.currentRiver;
+	var have = $scope.riverObj.metadata.head;
+	$scope.loading = true;
+	$http.get(headUrl(river.url)).success(function(head) {
+	    if (river !== $scope.currentRiver || head.head === have) {
+		$scope.loading = false;
+		return;
+	    }
+	    var missing = head.deltas.filter(function(delta) {
+		return delta.since >= have;
+	    }).reverse();
+	    if (!missing.length || missing[0].since !== have) {
+		load();
+		return;
+	    }
+	    $q.all(missing.map(function(delta) {
+		return $http.get(delta.url);
+	    })).then(function(responses) {
+		if (river !== $scope.currentRiver || $scope.riverObj.metadata.head !== have) {
+		    return;
+		}
+		var riverObj = $scope.riverObj;
+		var feeds = riverObj.updatedFeeds.updatedFeed;
+		responses.forEach(function(response) {
+		    feeds = response.data.updatedFeeds.updatedFeed.concat(feeds);
+		    riverObj.metadata.head = response.data.metadata.head;
+		    riverObj.metadata.whenGMT = response.data.metadata.whenGMT;
+		    riverObj.metadata.whenLocal = response.data.metadata.whenLocal;
+		});
+		feeds.sort(function(a, b) {
+		    return updateId(b) - updateId(a);
+		});
+		riverObj.updatedFeeds.updatedFeed = feeds.slice(0, head.pageSize);
+	    }, load)['finally'](function() {
+		$scope.loading = false;
+	    });
+	}).error(load);
+    }
+
+    $scope.$watch('currentRiver', function() {
+	if ($scope.currentRiver) {
+	    load();
 	}
     });
 
     $scope.refresh = function() {
-	$scope.loading = true;
-	if ($scope.currentRiver) {
-	    $http.get($scope.currentRiver.url).success(function(obj) {
-		$scope.riverObj = obj;
-	    });
+	if (!$scope.currentRiver) {
+	    return;
+	}
+	if ($scope.riverObj && $scope.riverObj.metadata.head !== undefined) {
+	    catchUp();
+	} else {
+	    load();
 	}
-	$scope.loading = false;
     };
+
+    $interval(function() {
+	// Without head.js there's nothing cheap to poll.
+	if ($scope.currentRiver && $scope.riverObj && $scope.riverObj.metadata.head !== undefined) {
+	    catchUp();
+	}
+    }, POLL_INTERVAL);
 }]);
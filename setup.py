@@ -7,10 +7,15 @@ setup(
     author = 'Eric Davis',
     author_email = 'eric@davising.com',
     url = 'https://github.com/edavis/riverpy',
+    classifiers = [
+        'Programming Language :: Python :: 2 :: Only',
+        'Programming Language :: Python :: 2.7',
+    ],
     entry_points = {
         'console_scripts': [
             'river = riverpy:main',
             'river-writer = riverpy:river_writer',
+            'river-migrate = riverpy:migrate',
         ],
     },
     install_requires = [
@@ -19,9 +24,11 @@ setup(
         'bleach==1.2.2',
         'boto==2.21.0',
         'feedparser==5.1.3',
+        'html5lib==0.95',
         'lxml==3.2.4',
         'path.py==5.0',
         'python-dateutil==2.2',
+        # The server needs to be redis 5.0 or later for streams.
         'redis==2.8.0',
         'requests==2.1.0',
         'six==1.4.1',
@@ -0,0 +1,45 @@
+"""
+Check that each command line parser can be built and read its own
+--help.
+"""
+import sys
+import unittest
+from StringIO import StringIO
+
+import riverpy
+
+class HelpTest(unittest.TestCase):
+    def help(self, entry_point):
+        (argv, stdout) = (sys.argv, sys.stdout)
+        sys.argv = ['river', '--help']
+        sys.stdout = StringIO()
+        try:
+            with self.assertRaises(SystemExit) as raised:
+                entry_point()
+            return (raised.exception.code, sys.stdout.getvalue())
+        finally:
+            (sys.argv, sys.stdout) = (argv, stdout)
+
+    def test_river(self):
+        (code, output) = self.help(riverpy.main)
+        self.assertEqual(code, 0)
+        self.assertIn('--read-pickle', output)
+        self.assertIn('--sqlite', output)
+
+    def test_river_parser(self):
+        # What bench/roundtrips.py builds its options from.
+        args = riverpy.river_parser().parse_args(['--dedup', 'bloom', 'list.yml'])
+        self.assertEqual((args.feeds, args.dedup, args.codec), ('list.yml', 'bloom', 'json'))
+
+    def test_river_writer(self):
+        (code, output) = self.help(riverpy.river_writer)
+        self.assertEqual(code, 0)
+        self.assertIn('--read-pickle', output)
+
+    def test_river_migrate(self):
+        (code, output) = self.help(riverpy.migrate)
+        self.assertEqual(code, 0)
+        self.assertIn('--read-pickle', output)
+
+if __name__ == '__main__':
+    unittest.main()
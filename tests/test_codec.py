@@ -0,0 +1,58 @@
+"""
+Check stored updates are decoded by the codec that wrote them, and
+that pickles are only read once allow_pickle() has been called.
+"""
+import cPickle
+import unittest
+
+from riverpy import codec
+
+ITEM = {'title': u'Hello', 'link': u'http://example.com/1'}
+
+class CodecTest(unittest.TestCase):
+    def setUp(self):
+        # allow_pickle() is remembered in the module.
+        codec._codecs.clear()
+
+    def tearDown(self):
+        codec._codecs.clear()
+
+    def test_json(self):
+        data = codec.get_codec('json').dumps(ITEM)
+        self.assertEqual(codec.codec_for(data).name, 'json')
+        self.assertEqual(codec.loads(data), ITEM)
+        self.assertEqual(codec.to_json(data), data)
+
+    def test_msgpack(self):
+        if codec.msgpack is None:
+            self.skipTest('msgpack-python is not installed')
+        data = codec.get_codec('msgpack').dumps(ITEM)
+        self.assertEqual(codec.codec_for(data).name, 'msgpack')
+        self.assertEqual(codec.loads(data), ITEM)
+
+    def test_msgpack_headers(self):
+        # Told apart by the first byte alone, so this doesn't need
+        # msgpack installed; MsgpackCodec() would exit without it.
+        codec._codecs['msgpack'] = codec.MsgpackCodec.__new__(codec.MsgpackCodec)
+        for data in ('\x81\xa1a\x01', '\xde\x00\x00', '\xdf\x00\x00\x00\x00'):
+            self.assertEqual(codec.codec_for(data).name, 'msgpack')
+
+    def test_pickle_refused(self):
+        data = cPickle.dumps(ITEM)
+        self.assertEqual(data[:1], '(')
+        self.assertRaises(ValueError, codec.loads, data)
+        self.assertRaises(ValueError, codec.to_json, data)
+
+    def test_pickle_allowed(self):
+        data = cPickle.dumps(ITEM)
+        codec.allow_pickle()
+        self.assertEqual(codec.codec_for(data).name, 'pickle')
+        self.assertEqual(codec.loads(data), ITEM)
+        self.assertEqual(codec.to_json(data), codec.get_codec('json').dumps(ITEM))
+
+    def test_unrecognized(self):
+        for data in ('', 'garbage', '[1, 2]'):
+            self.assertRaises(ValueError, codec.codec_for, data)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+"""
+Check the seen-entry indexes remember what they're told and forget
+the oldest entries past their limit.
+
+They run against an in-memory SQLiteStore, which test_storage checks
+behaves like redis.
+"""
+import unittest
+
+from riverpy.storage import SQLiteStore
+from riverpy.dedup import SortedSetIndex, BloomIndex, seen_index
+
+FEED = 'http://example.com/feed'
+
+class IndexTests(object):
+    kind = None
+
+    def setUp(self):
+        self.store = SQLiteStore(':memory:')
+        self.index = seen_index(self.store, self.kind, limit=10)
+
+    def tearDown(self):
+        self.store.close()
+
+    def test_new_feed(self):
+        self.assertEqual(self.index.lookup(FEED, ['a', 'b']), (True, [False, False]))
+
+    def test_add_then_lookup(self):
+        self.index.add(FEED, ['a', 'b'])
+        self.assertEqual(self.index.lookup(FEED, ['a', 'c', 'b']), (False, [True, False, True]))
+
+    def test_feeds_kept_apart(self):
+        self.index.add(FEED, ['a'])
+        self.assertEqual(self.index.lookup(FEED + '2', ['a']), (True, [False]))
+
+    def test_add_nothing(self):
+        self.index.add(FEED, [])
+        self.assertEqual(self.index.lookup(FEED, ['a']), (True, [False]))
+
+    def test_add_on_pipeline(self):
+        pipe = self.store.pipeline()
+        self.index.add(FEED, ['a'], pipe)
+        self.assertEqual(self.index.lookup(FEED, ['a']), (True, [False]))
+        pipe.execute()
+        self.assertEqual(self.index.lookup(FEED, ['a']), (False, [True]))
+
+    def test_unicode_fingerprints(self):
+        self.index.add(FEED, [u'caf\xe9'])
+        self.assertEqual(self.index.lookup(FEED, [u'caf\xe9']), (False, [True]))
+
+    def test_migrate_legacy(self):
+        # The old list is newest-first.
+        self.store.lpush(self.index.legacy_key(FEED), 'a', 'b')
+        self.assertEqual(self.index.lookup(FEED, ['a', 'b', 'c']), (False, [True, True, False]))
+        self.assertFalse(self.store.exists(self.index.legacy_key(FEED)))
+
+class SortedSetIndexTest(IndexTests, unittest.TestCase):
+    kind = 'zset'
+
+    def test_kind(self):
+        self.assertIsInstance(self.index, SortedSetIndex)
+
+    def test_oldest_trimmed(self):
+        fingerprints = ['f%d' % n for n in xrange(15)]
+        self.index.add(FEED, fingerprints)
+        (_, seen) = self.index.lookup(FEED, fingerprints)
+        self.assertEqual(seen, [False] * 5 + [True] * 10)
+
+class BloomIndexTest(IndexTests, unittest.TestCase):
+    kind = 'bloom'
+
+    def test_kind(self):
+        self.assertIsInstance(self.index, BloomIndex)
+
+    def test_offsets(self):
+        offsets = self.index.offsets('a')
+        self.assertEqual(len(offsets), BloomIndex.hashes)
+        self.assertEqual(offsets, self.index.offsets(u'a'))
+        self.assertTrue(all(0 <= offset < self.index.size for offset in offsets))
+
+    def test_filters_rotate(self):
+        # The previous filter is still consulted after one rotation
+        # and dropped after the next.
+        first = ['f%d' % n for n in xrange(10)]
+        second = ['g%d' % n for n in xrange(10)]
+        third = ['h%d' % n for n in xrange(10)]
+        self.index.add(FEED, first)
+        self.index.add(FEED, second)
+        self.assertEqual(self.index.lookup(FEED, first)[1], [True] * 10)
+        self.index.add(FEED, third)
+        self.assertEqual(self.index.lookup(FEED, second + third)[1], [True] * 20)
+        self.assertLess(sum(self.index.lookup(FEED, first)[1]), 3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+"""
+Check how IntervalModel learns a feed's rate and turns it into the
+time until the next check.
+"""
+import calendar
+import unittest
+
+from riverpy.interval import IntervalModel
+
+# Midnight UTC, so MIDNIGHT + N * HOUR falls in hour N of the day.
+MIDNIGHT = calendar.timegm((2016, 3, 1, 0, 0, 0))
+HOUR = 60 * 60
+
+class IntervalModelTest(unittest.TestCase):
+    def setUp(self):
+        self.model = IntervalModel(min_interval=60, max_interval=2*HOUR, halflife=12*HOUR)
+
+    def test_load(self):
+        self.assertEqual(self.model.load(None), {})
+        self.assertEqual(self.model.load({'rate': '0.5', 'last': '10'}), {'rate': 0.5, 'last': 10.0})
+
+    def test_unknown_feed_checked_soon(self):
+        self.assertEqual(self.model.next_interval({}, MIDNIGHT), 60)
+
+    def test_backlog_gives_first_rate(self):
+        # Five items ten minutes apart: one every 600 seconds.
+        timestamps = [MIDNIGHT + i * 600 for i in xrange(5)]
+        state = self.model.update({}, MIDNIGHT + 3000, timestamps)
+        self.assertAlmostEqual(state['rate'], 1 / 600.0)
+        self.assertEqual(state['last'], MIDNIGHT + 3000)
+
+    def test_single_item_backlog_leaves_rate_unknown(self):
+        state = self.model.update({}, MIDNIGHT, [MIDNIGHT - 100])
+        self.assertNotIn('rate', state)
+
+    def test_rate_moves_towards_observed(self):
+        state = {'rate': 1 / 600.0, 'last': MIDNIGHT}
+        quiet = self.model.update(state, MIDNIGHT + HOUR, [])
+        busy = self.model.update(state, MIDNIGHT + HOUR, [MIDNIGHT + 60] * 60)
+        self.assertLess(quiet['rate'], state['rate'])
+        self.assertGreater(busy['rate'], state['rate'])
+
+    def test_rate_weight_halves_every_halflife(self):
+        # After one halflife of silence, half the old rate is left.
+        state = {'rate': 1.0, 'last': MIDNIGHT}
+        state = self.model.update(state, MIDNIGHT + 12 * HOUR, [])
+        self.assertAlmostEqual(state['rate'], 0.5)
+
+    def test_new_feed_keeps_rate(self):
+        state = {'rate': 1.0, 'last': MIDNIGHT}
+        state = self.model.update(state, MIDNIGHT + HOUR, [], new_feed=True)
+        self.assertEqual(state['rate'], 1.0)
+
+    def test_update_does_not_change_state(self):
+        state = {'rate': 1.0, 'last': MIDNIGHT}
+        self.model.update(state, MIDNIGHT + HOUR, [MIDNIGHT + 60])
+        self.assertEqual(state, {'rate': 1.0, 'last': MIDNIGHT})
+
+    def test_hour_counts(self):
+        state = self.model.update({}, MIDNIGHT + 4 * HOUR, [MIDNIGHT + 3 * HOUR, MIDNIGHT + 3 * HOUR + 5])
+        self.assertEqual(state['h3'], 2)
+
+    def test_hour_counts_halved_past_limit(self):
+        state = dict(('h%d' % hour, 50) for hour in xrange(24))
+        state = self.model.update(state, MIDNIGHT, [MIDNIGHT])
+        self.assertEqual(state['h0'], 25.5)
+        self.assertEqual(state['h1'], 25)
+
+    def test_hour_factor(self):
+        self.assertEqual(self.model.hour_factor({}, MIDNIGHT), 1.0)
+        state = {'h9': 240}
+        self.assertGreater(self.model.hour_factor(state, MIDNIGHT + 9 * HOUR), 1.0)
+        self.assertLess(self.model.hour_factor(state, MIDNIGHT + 3 * HOUR), 1.0)
+
+    def test_interval_targets_one_item(self):
+        state = {'rate': 1 / 600.0}
+        self.assertAlmostEqual(self.model.next_interval(state, MIDNIGHT), 600)
+
+    def test_interval_clamped(self):
+        self.assertEqual(self.model.next_interval({'rate': 1.0}, MIDNIGHT), 60)
+        for rate in (0, 1e-9):
+            interval = self.model.next_interval({'rate': rate}, MIDNIGHT)
+            self.assertTrue(HOUR <= interval <= 2 * HOUR, interval)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+"""
+Check ListResolver follows includes however they're nested, reads
+each list once, and stops at lists that include themselves.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from riverpy.parser import ListResolver
+
+OPML = """<?xml version="1.0"?>
+<opml version="2.0"><head/><body>%s</body></opml>
+"""
+
+def feed(url):
+    return '<outline type="rss" xmlUrl="%s"/>' % url
+
+def include(name):
+    return '<outline type="include" url="%s"/>' % name
+
+def summit(name, *outlines):
+    return '<outline text="%s">%s</outline>' % (name, ''.join(outlines))
+
+class CountingCache(object):
+    def __init__(self):
+        self.reads = []
+
+    def read(self, location):
+        self.reads.append(os.path.basename(location))
+        with open(location, 'rb') as fp:
+            return fp.read()
+
+class ListResolverTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = CountingCache()
+        self.resolver = ListResolver(self.cache, workers=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, *outlines):
+        with open(os.path.join(self.directory, name), 'wb') as fp:
+            fp.write(OPML % ''.join(outlines))
+        return os.path.join(self.directory, name)
+
+    def rivers(self, top):
+        self.resolver.load(top)
+        return dict((river['name'], river['feeds']) for river in self.resolver.rivers(top))
+
+    def test_nested(self):
+        top = self.write('top.opml', summit('News', feed('a'), include('b.opml')))
+        self.write('b.opml', feed('b'), include('c.opml'))
+        self.write('c.opml', summit('Ignored', feed('c')))
+        self.assertEqual(self.rivers(top), {'news': ['a', 'b', 'c']})
+
+    def test_includes_itself(self):
+        top = self.write('top.opml', summit('News', include('a.opml')))
+        self.write('a.opml', feed('a'), include('a.opml'))
+        self.assertEqual(self.rivers(top), {'news': ['a']})
+
+    def test_loop(self):
+        top = self.write('top.opml', summit('News', include('a.opml')), summit('Sports', include('b.opml')))
+        self.write('a.opml', feed('a'), include('b.opml'))
+        self.write('b.opml', feed('b'), include('a.opml'))
+        # Each river gets the whole loop, whichever end it came in by.
+        self.assertEqual(self.rivers(top), {'news': ['a', 'b'], 'sports': ['b', 'a']})
+
+    def test_loop_back_to_top(self):
+        top = self.write('top.opml', summit('News', feed('top'), include('a.opml')))
+        self.write('a.opml', feed('a'), include('top.opml'))
+        self.assertEqual(self.rivers(top), {'news': ['top', 'a']})
+
+    def test_shared_include_read_once(self):
+        top = self.write('top.opml', summit('News', include('a.opml'), include('b.opml')))
+        self.write('a.opml', feed('a'), include('shared.opml'))
+        self.write('b.opml', feed('b'), include('shared.opml'))
+        self.write('shared.opml', feed('shared'), feed('a'))
+        self.assertEqual(self.rivers(top), {'news': ['a', 'shared', 'b']})
+        self.assertEqual(sorted(self.cache.reads), ['a.opml', 'b.opml', 'shared.opml', 'top.opml'])
+
+    def test_changed(self):
+        top = self.write('top.opml', summit('News', include('a.opml')))
+        self.write('a.opml', feed('a'))
+        self.resolver.load(top)
+        self.assertTrue(self.resolver.changed)
+
+        self.resolver.changed = False
+        self.resolver.load(top)
+        self.assertFalse(self.resolver.changed)
+
+        self.write('top.opml', summit('News', feed('b')))
+        self.resolver.load(top)
+        self.assertTrue(self.resolver.changed)
+        self.assertEqual(sorted(self.resolver.documents), [top])
+
+    def test_summit_without_name(self):
+        top = self.write('top.opml', '<outline>%s</outline>' % feed('a'))
+        self.resolver.load(top)
+        self.assertRaises(ValueError, list, self.resolver.rivers(top))
+
+if __name__ == '__main__':
+    unittest.main()
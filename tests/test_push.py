@@ -0,0 +1,154 @@
+"""
+Check WebSub pushes are only accepted with a good signature, and
+that hubs' verification requests confirm, cancel or deny the
+subscriptions PushSubscriber asked for.
+"""
+import hmac
+import time
+import hashlib
+import requests
+import threading
+import unittest
+
+from riverpy.storage import SQLiteStore
+from riverpy.subscriptions import SUBSCRIPTIONS_KEY
+from riverpy.push import (PushServer, PushHandler, CALLBACKS_KEY, push_key,
+                          callback_token, check_signature, discover_hub)
+
+FEED = 'http://example.com/feed'
+TOPIC = 'http://example.com/topic'
+SECRET = 'sekrit'
+
+def sign(body, method='sha1', secret=SECRET):
+    return '%s=%s' % (method, hmac.new(secret, body, getattr(hashlib, method)).hexdigest())
+
+class SignatureTest(unittest.TestCase):
+    def test_good(self):
+        for method in ('sha1', 'sha256', 'sha512'):
+            self.assertTrue(check_signature(SECRET, 'body', sign('body', method)))
+        # Hubs don't all send the digest in lower case.
+        digest = hmac.new(SECRET, 'body', hashlib.sha1).hexdigest()
+        self.assertTrue(check_signature(SECRET, 'body', 'sha1=%s' % digest.upper()))
+
+    def test_bad(self):
+        self.assertFalse(check_signature(SECRET, 'body', sign('other')))
+        self.assertFalse(check_signature(SECRET, 'body', sign('body', secret='wrong')))
+        self.assertFalse(check_signature(SECRET, 'body', sign('body')[:-1]))
+        self.assertFalse(check_signature(SECRET, 'body', 'md5=' + hashlib.md5('body').hexdigest()))
+        self.assertFalse(check_signature(SECRET, 'body', 'nonsense'))
+        self.assertFalse(check_signature(SECRET, 'body', None))
+        self.assertFalse(check_signature(None, 'body', sign('body')))
+
+class DiscoverHubTest(unittest.TestCase):
+    def test_links_first(self):
+        links = {'hub': {'url': 'http://hub/'}, 'self': {'url': TOPIC}}
+        feed = {'hub': 'http://other-hub/', 'self': 'http://other/'}
+        self.assertEqual(discover_hub(feed, links), ('http://hub/', TOPIC))
+
+    def test_feed(self):
+        self.assertEqual(discover_hub({'hub': 'http://hub/'}, None), ('http://hub/', None))
+        self.assertEqual(discover_hub({}, {}), (None, None))
+
+class PushHandlerTest(unittest.TestCase):
+    def setUp(self):
+        self.store = SQLiteStore(':memory:')
+        self.store.sadd(SUBSCRIPTIONS_KEY, FEED)
+        self.store.hset(CALLBACKS_KEY, callback_token(FEED), FEED)
+        self.store.hmset(push_key(FEED), {'topic': TOPIC, 'secret': SECRET, 'state': 'pending'})
+
+        self.received = []
+        self.pushed = threading.Event()
+        self.server = PushServer(('127.0.0.1', 0), PushHandler)
+        self.server.redis_client = self.store
+        self.server.lease_seconds = 3600
+        self.server.max_body_size = 1000
+        self.server.receive = self.receive
+        thread = threading.Thread(target=self.server.serve_forever, args=(0.01,))
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:%d/push/%s' % (self.server.server_address[1], callback_token(FEED))
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.store.close()
+
+    def receive(self, feed_url, body):
+        self.received.append((feed_url, body))
+        self.pushed.set()
+
+    def verify(self, mode, **params):
+        params.update({'hub.mode': mode, 'hub.topic': TOPIC, 'hub.challenge': 'xyz'})
+        return requests.get(self.url, params=params)
+
+    def push(self, body, signature):
+        response = requests.post(self.url, data=body, headers={'X-Hub-Signature': signature})
+        # The body is handed over after the hub has its answer, so
+        # give it a moment to turn up.
+        self.pushed.wait(0.1)
+        return response
+
+    def test_subscribe(self):
+        response = self.verify('subscribe', **{'hub.lease_seconds': '600'})
+        self.assertEqual((response.status_code, response.content), (200, 'xyz'))
+        state = self.store.hgetall(push_key(FEED))
+        self.assertEqual(state['state'], 'subscribed')
+        self.assertAlmostEqual(int(state['expires']), time.time() + 600, delta=5)
+
+    def test_subscribe_default_lease(self):
+        self.verify('subscribe')
+        expires = int(self.store.hget(push_key(FEED), 'expires'))
+        self.assertAlmostEqual(expires, time.time() + 3600, delta=5)
+
+    def test_bad_lease(self):
+        for lease in ('soon', '-5', '0'):
+            response = self.verify('subscribe', **{'hub.lease_seconds': lease})
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.store.hget(push_key(FEED), 'state'), 'pending')
+
+    def test_wrong_topic(self):
+        response = requests.get(self.url, params={'hub.mode': 'subscribe', 'hub.topic': 'http://other/'})
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.store.hget(push_key(FEED), 'state'), 'pending')
+
+    def test_unknown_callback(self):
+        response = requests.get(self.url + 'x', params={'hub.mode': 'subscribe', 'hub.topic': TOPIC})
+        self.assertEqual(response.status_code, 404)
+
+    def test_unsubscribe_still_wanted(self):
+        self.assertEqual(self.verify('unsubscribe').status_code, 404)
+        self.assertTrue(self.store.exists(push_key(FEED)))
+
+    def test_unsubscribe(self):
+        self.store.srem(SUBSCRIPTIONS_KEY, FEED)
+        response = self.verify('unsubscribe')
+        self.assertEqual((response.status_code, response.content), (200, 'xyz'))
+        self.assertFalse(self.store.exists(push_key(FEED)))
+        self.assertIsNone(self.store.hget(CALLBACKS_KEY, callback_token(FEED)))
+
+    def test_denied(self):
+        self.assertEqual(self.verify('denied').status_code, 200)
+        self.assertEqual(self.store.hget(push_key(FEED), 'state'), 'denied')
+
+    def test_push(self):
+        response = self.push('<rss/>', sign('<rss/>'))
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(self.received, [(FEED, '<rss/>')])
+
+    def test_push_bad_signature(self):
+        response = self.push('<rss/>', sign('<rss/>', secret='wrong'))
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(self.received, [])
+
+    def test_push_too_large(self):
+        body = 'x' * 1001
+        self.assertEqual(self.push(body, sign(body)).status_code, 413)
+        self.assertEqual(self.received, [])
+
+    def test_push_unsubscribed(self):
+        self.store.srem(SUBSCRIPTIONS_KEY, FEED)
+        self.assertEqual(self.push('<rss/>', sign('<rss/>')).status_code, 410)
+        self.assertEqual(self.received, [])
+
+if __name__ == '__main__':
+    unittest.main()
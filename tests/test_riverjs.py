@@ -0,0 +1,114 @@
+"""
+Check river.js documents assembled from cached fragments come out
+the same as serializing the whole river, and that DeltaLog hands
+out every update exactly once.
+"""
+import json
+import cPickle
+import unittest
+
+from riverpy import codec
+from riverpy.storage import SQLiteStore
+from riverpy.riverjs import (FragmentCache, DeltaLog, serialize_fragments, serialize_riverjs,
+                             to_fragment, deltas_key, published_key)
+
+UPDATES = [
+    {'feedTitle': u'Example', 'item': [{'id': '2', 'title': u'caf\xe9'}]},
+    {'feedTitle': u'Other', 'item': [{'id': '1', 'title': u'Hello'}]},
+]
+METADATA = {'docs': 'http://riverjs.org/', 'version': '3'}
+
+class FragmentCacheTest(unittest.TestCase):
+    def setUp(self):
+        # Older updates may be pickled.
+        codec.allow_pickle()
+        self.cache = FragmentCache(size=2)
+
+    def tearDown(self):
+        codec._codecs.clear()
+
+    def test_same_as_serialize_riverjs(self):
+        river = {'metadata': METADATA, 'updatedFeeds': {'updatedFeed': UPDATES}}
+        stored = [cPickle.dumps(update) for update in UPDATES]
+        for create_json in (True, False):
+            self.assertEqual(
+                serialize_fragments(self.cache.fragments_for(stored), METADATA, create_json),
+                serialize_riverjs(river, create_json),
+            )
+
+    def test_json_passes_through(self):
+        stored = json.dumps(UPDATES[0], sort_keys=True)
+        self.assertIs(self.cache.fragment(stored), stored)
+        self.assertIs(to_fragment(stored), stored)
+        self.assertEqual(len(self.cache.fragments), 0)
+
+    def test_hits_and_misses(self):
+        stored = cPickle.dumps(UPDATES[0])
+        self.assertEqual(self.cache.fragment(stored), self.cache.fragment(stored))
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        self.assertEqual(to_fragment(stored), self.cache.fragment(stored))
+
+    def test_least_recently_used_evicted(self):
+        (a, b, c) = [cPickle.dumps({'n': n}) for n in xrange(3)]
+        self.cache.fragments_for([a, b, a, c])
+        self.assertEqual(list(self.cache.fragments), [a, c])
+
+def page(*ids):
+    # Newest first, like the river.
+    return [('f%d' % update_id, update_id) for update_id in sorted(ids, reverse=True)]
+
+class DeltaLogTest(unittest.TestCase):
+    def setUp(self):
+        self.store = SQLiteStore(':memory:')
+        self.log = DeltaLog(self.store, history=2)
+
+    def tearDown(self):
+        self.store.close()
+
+    def test_first_page_already_published(self):
+        self.assertIsNone(self.log.update('river', page(1, 2, 3)))
+        self.assertEqual(self.log.head('river'), 3)
+        self.assertEqual(self.log.deltas('river'), [])
+
+    def test_new_updates(self):
+        self.log.update('river', page(1, 2))
+        self.assertEqual(self.log.update('river', page(1, 2, 3, 4)), (2, 4, ['f4', 'f3'], []))
+        self.assertEqual(self.log.head('river'), 4)
+        self.assertEqual(self.log.deltas('river'), [(2, 4)])
+        self.assertIsNone(self.log.update('river', page(1, 2, 3, 4)))
+
+    def test_late_update_rides_along(self):
+        self.log.update('river', page(1, 3))
+        # 2 committed after 3 was published: nothing to announce yet.
+        self.assertIsNone(self.log.update('river', page(1, 2, 3)))
+        self.assertEqual(self.log.update('river', page(1, 2, 3, 4)), (3, 4, ['f4', 'f2'], []))
+
+    def test_history_trimmed(self):
+        self.log.update('river', page(1))
+        self.log.update('river', page(1, 2))
+        self.log.update('river', page(1, 2, 3))
+        self.assertEqual(self.log.update('river', page(1, 2, 3, 4))[3], [(1, 2)])
+        self.assertEqual(self.log.deltas('river'), [(3, 4), (2, 3)])
+        self.assertEqual(self.store.lrange(deltas_key('river'), 0, -1), ['3-4', '2-3'])
+
+    def test_rivers_kept_apart(self):
+        self.log.update('a', page(1))
+        self.log.update('b', page(5))
+        self.assertEqual(self.log.update('a', page(1, 2)), (1, 2, ['f2'], []))
+        self.assertEqual(self.log.head('b'), 5)
+
+    def test_restart(self):
+        self.log.update('river', page(1, 3))
+        self.log.update('river', page(1, 3, 4))
+        log = DeltaLog(self.store, history=2)
+        # Still knows 2 hasn't been published.
+        self.assertEqual(log.update('river', page(1, 2, 3, 4, 5)), (4, 5, ['f5', 'f2'], []))
+        self.assertEqual(log.deltas('river'), [(4, 5), (3, 4)])
+
+    def test_restart_without_published(self):
+        self.store.lpush(deltas_key('river'), '1-3')
+        self.assertEqual(self.log.update('river', page(1, 2, 3, 4)), (3, 4, ['f4'], []))
+        self.assertEqual(self.store.smembers(published_key('river')), set(['1', '2', '3', '4']))
+
+if __name__ == '__main__':
+    unittest.main()
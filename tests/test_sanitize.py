@@ -0,0 +1,69 @@
+"""
+Check strip_tags gives exactly what bleach.clean(text, tags=[],
+strip=True) does. bench/cleantext.py runs a bigger corpus and times
+the two.
+"""
+import random
+import bleach
+import unittest
+
+from riverpy.sanitize import strip_tags
+
+FRAGMENTS = [
+    u'',
+    u'Plain title',
+    u'<p>A <b>bold</b> <a href="http://example.com/?a=1&b=2">link</a>.</p>',
+    u'<img src="x.png" alt="a > b"/>After the image',
+    u'<script>if (a < b && c) alert("x")</script>after',
+    u'<table>before<tr><td>cell</td></tr></table>after',
+    u'<!-- comment --> <!--> <!---> <!----> <!-- a --!> b',
+    u'<!DOCTYPE html PUBLIC "-//W3C//DTD>x">text',
+    u'<?xml version="1.0"?>text',
+    u'a < b > c & d',
+    u'<>empty</>tags</ >bogus</3>',
+    u'&amp; &amp &lt; &gt; &quot; &nbsp; &copy &notit; &notin; &bogus;',
+    u'&#65; &#x41; &#X41 &#0; &#128; &#150; &#xD800; &#x110000; &#x1F600; &#; &#x;',
+    u'line\r\nbreaks\rand\nmore',
+    u'nul\x00chars',
+    u'caf\xe9 \u2014 \U0001F600 \ud800',
+    u'<a href="unterminated>text',
+    u"<a b='c'd e=f g>text",
+    u'<a =x>y<a b="c"/>z',
+    u'trailing <',
+    u'trailing </',
+    u'trailing &',
+]
+
+JUNK = list(u'<>/!-?=\'"&#;xX019aZ \n\r\t\x00\xe9') + [
+    u'amp', u'lt', u'not', u'notin', u'<!--', u'-->', u'<a ', u'</', u'&#x', u'<p>',
+]
+
+class StripTagsTest(unittest.TestCase):
+    def assertSameAsBleach(self, text):
+        self.assertEqual(strip_tags(text), bleach.clean(text, tags=[], strip=True), repr(text))
+
+    def test_fragments(self):
+        for text in FRAGMENTS:
+            self.assertSameAsBleach(text)
+
+    def test_junk(self):
+        rnd = random.Random(0)
+        for n in xrange(500):
+            self.assertSameAsBleach(u''.join(rnd.choice(JUNK) for _ in xrange(rnd.randint(1, 20))))
+
+    def test_bytes(self):
+        self.assertEqual(strip_tags('<b>caf\xc3\xa9</b>'), u'caf\xe9')
+
+    def test_limit(self):
+        text = u'  ' + u'<b>word</b> ' * 100
+        full = strip_tags(text)
+        limited = strip_tags(text, limit=20)
+        self.assertLess(len(limited), len(full))
+        self.assertEqual(limited.strip()[:20], full.strip()[:20])
+
+    def test_limit_not_reached(self):
+        text = u'<p>' + u'x' * 20 + u'</p>   '
+        self.assertEqual(strip_tags(text, limit=20), strip_tags(text))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+"""
+Check each river process's scheduler is woken up by its own checks
+finishing, without taking the wake-ups meant for the others.
+"""
+import time
+import unittest
+
+from riverpy import river_parser
+from riverpy.codec import get_codec
+from riverpy.timing import StageTimings
+from riverpy.storage import SQLiteStore
+from riverpy.scheduler import Scheduler, checked_key, notify_checked
+
+class WaitTest(unittest.TestCase):
+    def setUp(self):
+        self.store = SQLiteStore(':memory:')
+
+    def tearDown(self):
+        self.store.close()
+
+    def scheduler(self, node_id):
+        args = river_parser().parse_args(['--node-id', node_id, '--max-wait', '5', '-'])
+        return Scheduler(self.store, None, args, [], get_codec('json'), StageTimings())
+
+    def notify(self, node_id, *feed_urls):
+        pipe = self.store.pipeline()
+        for feed_url in feed_urls:
+            notify_checked(pipe, feed_url, node_id)
+        pipe.execute()
+
+    def test_wakes_up_on_own_checks(self):
+        self.notify('a', 'http://example.com/1', 'http://example.com/2')
+        start = time.time()
+        self.scheduler('a').wait()
+        self.assertLess(time.time() - start, 1)
+        # One wake up covers every check that had finished.
+        self.assertEqual(self.store.llen(checked_key('a')), 0)
+
+    def test_leaves_other_nodes_alone(self):
+        self.notify('a', 'http://example.com/1')
+        self.notify('b', 'http://example.com/2')
+        self.scheduler('a').wait()
+        self.assertEqual(self.store.lrange(checked_key('b'), 0, -1), ['http://example.com/2'])
+
+if __name__ == '__main__':
+    unittest.main()
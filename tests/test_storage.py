@@ -0,0 +1,433 @@
+"""
+Check that SQLiteStore answers the commands and scripts riverpy uses
+the way redis does, by running each against both and comparing.
+
+Needs a redis server, whose DB is flushed before every test; set
+RIVERPY_TEST_REDIS to host:port/db (default 127.0.0.1:6379/15):
+
+    $ python -m unittest discover tests
+"""
+import os
+import re
+import time
+import redis
+import shutil
+import tempfile
+import unittest
+
+import riverpy
+from riverpy.storage import SQLiteStore, SCRIPTS
+from riverpy.dedup import BLOOM_ADD
+from riverpy.politeness import ACQUIRE
+from riverpy.scheduler import CLAIM_DUE_FEEDS
+
+ENTRY_ID = re.compile(r'^\d+-\d+$')
+
+def redis_client():
+    (address, _, db) = os.environ.get('RIVERPY_TEST_REDIS', '127.0.0.1:6379/15').partition('/')
+    (host, _, port) = address.partition(':')
+    client = redis.Redis(host=host, port=int(port or 6379), db=int(db or 0))
+    try:
+        client.ping()
+    except redis.ConnectionError:
+        return None
+    return client
+
+class StoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.redis = redis_client()
+        if self.redis is None:
+            self.skipTest('no redis server to compare against')
+        self.redis.flushdb()
+        self.sqlite = SQLiteStore(':memory:')
+
+    def tearDown(self):
+        self.sqlite.close()
+
+    def both(self, fn):
+        """
+        Run fn(client) against redis and SQLiteStore and check they
+        give the same result, or raise the same kind of error.
+        """
+        results = []
+        for client in (self.redis, self.sqlite):
+            try:
+                results.append(('returned', fn(client)))
+            except redis.RedisError as ex:
+                results.append(('raised', ex.__class__))
+        self.assertEqual(results[0], results[1])
+        return results[0][1]
+
+    def state(self, keys):
+        """
+        Check every key in `keys' has the same type and contents in
+        both.
+        """
+        def dump(client):
+            contents = []
+            for key in keys:
+                kind = client.type(key)
+                if kind == 'string':
+                    contents.append((key, kind, client.get(key)))
+                elif kind == 'hash':
+                    contents.append((key, kind, client.hgetall(key)))
+                elif kind == 'set':
+                    contents.append((key, kind, sorted(client.smembers(key))))
+                elif kind == 'zset':
+                    contents.append((key, kind, client.zrange(key, 0, -1, withscores=True)))
+                elif kind == 'list':
+                    contents.append((key, kind, client.lrange(key, 0, -1)))
+                else:
+                    contents.append((key, kind))
+            return contents
+        self.both(dump)
+
+class CommandTest(StoreTestCase):
+    def test_strings(self):
+        self.both(lambda c: [
+            c.set('a', 'x'),
+            c.get('a'),
+            c.get('missing'),
+            c.set('a', 'y', nx=True),
+            c.set('b', 'y', xx=True),
+            c.set('b', 'y', nx=True),
+            c.incr('n'),
+            c.incrby('n', 5),
+            c.incr('n', -2),
+            c.exists('n'),
+            c.type('n'),
+            c.type('missing'),
+            c.delete('a', 'b', 'missing'),
+            c.exists('a'),
+        ])
+        self.both(lambda c: c.set('text', 'x') and c.incr('text'))
+
+    def test_bits(self):
+        self.both(lambda c: [
+            c.setbit('bits', 3, 1),
+            c.setbit('bits', 3, 1),
+            c.setbit('bits', 20, 1),
+            c.setbit('bits', 20, 0),
+            c.getbit('bits', 3),
+            c.getbit('bits', 4),
+            c.getbit('bits', 1000),
+            c.get('bits'),
+        ])
+
+    def test_keys(self):
+        self.both(lambda c: [
+            c.set('feed:1', 'a'),
+            c.sadd('feed:2', 'b'),
+            c.set('other', 'c'),
+            sorted(c.keys('feed:*')),
+            c.rename('feed:2', 'feed:3'),
+            c.smembers('feed:3'),
+            c.exists('feed:2'),
+            c.rename('feed:1', 'other'),
+            c.get('other'),
+        ])
+        self.both(lambda c: c.rename('missing', 'somewhere'))
+
+    def test_expiry(self):
+        self.both(lambda c: [
+            c.set('short', 'x', px=50),
+            c.set('long', 'x', ex=60),
+            c.hset('hash', 'f', 'v'),
+            c.expire('hash', 60),
+            c.expire('missing', 60),
+            c.sadd('gone', 'm'),
+            c.expireat('gone', int(time.time()) - 1),
+            c.exists('gone'),
+        ])
+        time.sleep(0.1)
+        self.both(lambda c: [c.get('short'), c.get('long'), c.hgetall('hash'), c.exists('short')])
+        self.both(lambda c: [c.incr('long'), c.get('long')])
+
+    def test_wrong_type(self):
+        for command in [
+            lambda c: c.get('hash'),
+            lambda c: c.incr('hash'),
+            lambda c: c.sadd('hash', 'x'),
+            lambda c: c.zadd('hash', 'x', 1),
+            lambda c: c.lpush('hash', 'x'),
+        ]:
+            self.both(lambda c: c.hset('hash', 'f', 'v') and command(c))
+
+    def test_hashes(self):
+        self.both(lambda c: [
+            c.hset('h', 'a', '1'),
+            c.hset('h', 'a', '2'),
+            c.hmset('h', {'b': '3', 'c': 4}),
+            c.hget('h', 'a'),
+            c.hget('h', 'missing'),
+            c.hmget('h', ['a', 'missing', 'c']),
+            c.hmget('h', 'a', 'b'),
+            c.hgetall('h'),
+            c.hgetall('missing'),
+            c.hdel('h', 'a', 'missing'),
+            c.hdel('h', 'b', 'c'),
+            c.exists('h'),
+        ])
+
+    def test_sets(self):
+        self.both(lambda c: [
+            c.sadd('s', 'a', 'b', 'a'),
+            c.sadd('s', 'c'),
+            c.sismember('s', 'a'),
+            c.sismember('s', 'z'),
+            sorted(c.smembers('s')),
+            c.srem('s', 'a', 'z'),
+            c.srem('s', 'b', 'c'),
+            c.exists('s'),
+            c.smembers('missing'),
+        ])
+
+    def test_sorted_sets(self):
+        self.both(lambda c: [
+            c.zadd('z', 'a', 1, 'b', 2.5, 'c', 2.5),
+            c.zadd('z', 'a', 3, 'd', -1),
+            c.zadd('z', e=10),
+            c.zscore('z', 'a'),
+            c.zscore('z', 'missing'),
+            c.zcard('z'),
+            c.zrange('z', 0, -1),
+            c.zrange('z', 1, 2, withscores=True),
+            c.zrange('z', -2, -1),
+            c.zrange('z', 3, 1),
+            c.zrange('z', 0, 100),
+            c.zrange('z', 0, 1, desc=True),
+            c.zrevrange('z', 0, -1, withscores=True),
+            c.zrangebyscore('z', '-inf', '+inf'),
+            c.zrangebyscore('z', 2.5, 3, withscores=True),
+            c.zrangebyscore('z', '(2.5', 10),
+            c.zrangebyscore('z', '-inf', 10, start=1, num=2),
+            c.zrem('z', 'd', 'missing'),
+            c.zremrangebyscore('z', '(3', '+inf'),
+            c.zrange('z', 0, -1),
+            c.zremrangebyrank('z', 0, -3),
+            c.zrange('z', 0, -1),
+            c.zremrangebyrank('z', 0, -1),
+            c.exists('z'),
+        ])
+
+    def test_lists(self):
+        self.both(lambda c: [
+            c.rpush('l', 'a', 'b'),
+            c.lpush('l', 'c', 'd'),
+            c.llen('l'),
+            c.llen('missing'),
+            c.lrange('l', 0, -1),
+            c.lrange('l', 1, 2),
+            c.lrange('l', -2, 100),
+            c.lrange('l', 3, 1),
+            c.ltrim('l', 1, -2),
+            c.lrange('l', 0, -1),
+            c.lpop('l'),
+            c.lpop('l'),
+            c.lpop('l'),
+            c.exists('l'),
+            c.ltrim('missing', 0, 1),
+        ])
+        self.both(lambda c: [c.rpush('l', 'a', 'b'), c.ltrim('l', 5, 10), c.exists('l')])
+
+    def test_blpop(self):
+        self.both(lambda c: [
+            c.rpush('second', 'x', 'y'),
+            c.blpop(['first', 'second'], timeout=1),
+            c.blpop('second', timeout=1),
+            c.blpop(['first', 'second'], timeout=1),
+        ])
+
+class PipelineTest(StoreTestCase):
+    def test_transaction(self):
+        def transaction(c):
+            pipe = c.pipeline()
+            pipe.set('a', '1')
+            pipe.incr('a')
+            pipe.hmset('h', {'f': 'v'})
+            pipe.hgetall('h')
+            pipe.zadd('z', 'm', 1)
+            pipe.zrange('z', 0, -1, withscores=True)
+            return pipe.execute()
+        self.both(transaction)
+
+    def test_failing_command(self):
+        for transaction in (True, False):
+            def failing(c):
+                c.flushdb()
+                pipe = c.pipeline(transaction=transaction)
+                pipe.set('a', 'x')
+                pipe.hset('a', 'f', 'v')
+                pipe.set('b', 'y')
+                pipe.execute()
+            self.both(failing)
+            self.state(['a', 'b'])
+
+    def test_watch(self):
+        def watch(c, other):
+            pipe = c.pipeline()
+            pipe.watch('k', 'untouched')
+            value = pipe.get('k')
+            other.set('k', 'changed')
+            pipe.multi()
+            pipe.set('k', 'mine')
+            try:
+                pipe.execute()
+            except redis.WatchError:
+                return (value, 'conflict', c.get('k'))
+            return (value, 'committed', c.get('k'))
+        self.both(lambda c: c.set('k', 'original') and watch(c, c))
+
+        def unchanged(c):
+            pipe = c.pipeline()
+            pipe.watch('k')
+            pipe.multi()
+            pipe.incr('k')
+            return (pipe.execute(), c.get('k'))
+        self.both(unchanged)
+
+class StreamTest(StoreTestCase):
+    def normalize(self, reply, ids):
+        """
+        Replace entry ids, which depend on the clock, with the order
+        they were first seen in.
+        """
+        if isinstance(reply, (list, tuple)):
+            return [self.normalize(part, ids) for part in reply]
+        if isinstance(reply, str) and ENTRY_ID.match(reply):
+            return 'id-%d' % ids.setdefault(reply, len(ids))
+        return reply
+
+    def test_consumer_group(self):
+        def consume(c):
+            ids = {}
+            replies = []
+            command = lambda *args: replies.append(self.normalize(c.execute_command(*args), ids))
+            command('XGROUP', 'CREATE', 's', 'g', '0', 'MKSTREAM')
+            try:
+                command('XGROUP', 'CREATE', 's', 'g', '0', 'MKSTREAM')
+            except redis.ResponseError as ex:
+                replies.append(str(ex).split()[0])
+            for n in xrange(3):
+                command('XADD', 's', 'MAXLEN', '~', 100, '*', 'n', n)
+            command('XLEN', 's')
+            command('XREADGROUP', 'GROUP', 'g', 'c', 'COUNT', 2, 'STREAMS', 's', '>')
+            command('XREADGROUP', 'GROUP', 'g', 'c', 'STREAMS', 's', '0')
+            command('XACK', 's', 'g', [entry_id for (entry_id, n) in sorted(ids.items(), key=lambda pair: pair[1])][0])
+            command('XREADGROUP', 'GROUP', 'g', 'c', 'STREAMS', 's', '0')
+            command('XREADGROUP', 'GROUP', 'g', 'c', 'BLOCK', 10, 'STREAMS', 's', '>')
+            command('XREADGROUP', 'GROUP', 'g', 'c', 'BLOCK', 10, 'STREAMS', 's', '>')
+            return replies
+        self.both(consume)
+
+    def test_trimmed_while_pending(self):
+        def trim(c):
+            ids = {}
+            command = lambda *args: self.normalize(c.execute_command(*args), ids)
+            command('XGROUP', 'CREATE', 's', 'g', '0', 'MKSTREAM')
+            command('XADD', 's', '*', 'n', 1)
+            command('XREADGROUP', 'GROUP', 'g', 'c', 'STREAMS', 's', '>')
+            command('XADD', 's', 'MAXLEN', '=', 1, '*', 'n', 2)
+            return [command('XLEN', 's'),
+                    command('XREADGROUP', 'GROUP', 'g', 'c', 'STREAMS', 's', '0')]
+        self.both(trim)
+
+    def test_missing_group(self):
+        self.both(lambda c: c.execute_command('XREADGROUP', 'GROUP', 'g', 'c', 'STREAMS', 'missing', '>'))
+        self.both(lambda c: c.execute_command('XGROUP', 'CREATE', 'missing', 'g', '0'))
+
+def lua_scripts():
+    """
+    Return every Lua script defined at the top of a riverpy module.
+    """
+    scripts = {}
+    for (name, module) in vars(riverpy).items():
+        if getattr(module, '__name__', '').startswith('riverpy.'):
+            for (attr, value) in vars(module).items():
+                if isinstance(value, str) and 'redis.call(' in value:
+                    scripts[value] = '%s.%s' % (module.__name__, attr)
+    return scripts
+
+# Add a script here once ScriptTest runs it.
+TESTED_SCRIPTS = set([CLAIM_DUE_FEEDS, ACQUIRE, BLOOM_ADD])
+
+class ScriptCoverageTest(unittest.TestCase):
+    def test_every_script_has_a_tested_twin(self):
+        for (script, name) in lua_scripts().items():
+            self.assertIn(script, SCRIPTS, '%s has no @local_script twin' % name)
+            self.assertIn(script, TESTED_SCRIPTS, '%s has no test against redis in ScriptTest' % name)
+
+class ScriptTest(StoreTestCase):
+    """
+    Each Lua script against its @local_script twin.
+    """
+    def test_claim_due_feeds(self):
+        now = int(time.time())
+        keys = ['next_check', 'subscriptions']
+
+        def claim(c, node_id):
+            c.zadd('next_check', 'due-1', now - 30, 'due-2', now - 20, 'dropped', now - 10, 'later', now + 60)
+            c.sadd('subscriptions', 'due-1', 'due-2', 'later')
+            script = c.register_script(CLAIM_DUE_FEEDS)
+            return [script(keys=keys, args=[now, now + 900, 10, node_id, 60000]),
+                    script(keys=keys, args=[now, now + 900, 10, node_id, 60000])]
+        self.both(lambda c: claim(c, ''))
+        self.state(keys + ['lease:due-1', 'lease:due-2'])
+
+        self.both(lambda c: c.flushdb() and claim(c, 'node-1'))
+        self.state(keys + ['lease:due-1', 'lease:due-2', 'lease:later'])
+
+    def test_acquire(self):
+        keys = ['holders', 'next-request', 'blocked-until', 'queued-until']
+        now = round(time.time(), 3)
+
+        def acquire(c, at, token, concurrency=2, interval=0.5):
+            script = c.register_script(ACQUIRE)
+            return float(script(keys=keys, args=['%.3f' % at, token, concurrency, interval, 120, 5, interval or 2.5]))
+
+        def run(c):
+            waits = [acquire(c, now, 'a'), acquire(c, now, 'b'), acquire(c, now, 'c'),
+                     acquire(c, now + 0.5, 'd'), acquire(c, now + 1, 'e'),
+                     acquire(c, now + 1, 'f', interval=0), acquire(c, now + 1, 'g', interval=0)]
+            c.set('blocked-until', '%.3f' % (now + 30))
+            waits.append(acquire(c, now + 2, 'h'))
+            return ([round(wait, 3) for wait in waits],
+                    round(float(c.get('queued-until')) - now, 3),
+                    c.zrange('holders', 0, -1))
+        self.both(run)
+
+    def test_bloom_add(self):
+        keys = ['current', 'previous', 'count']
+
+        def add(c):
+            script = c.register_script(BLOOM_ADD)
+            results = []
+            for offsets in ([1, 5, 9], [2, 30], [7], [64, 3]):
+                results.append(script(keys=keys, args=[3, len(offsets)] + offsets))
+            return results
+        self.both(add)
+        self.state(keys)
+
+class CloseTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'river.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_commits_what_is_left(self):
+        store = SQLiteStore(self.path)
+        store.set('a', 'x')
+        store.rpush('l', 'y')
+        store.close()
+        self.assertFalse(store.flusher.is_alive())
+        store.close()
+
+        store = SQLiteStore(self.path)
+        self.assertEqual(store.get('a'), 'x')
+        self.assertEqual(store.lrange('l', 0, -1), ['y'])
+        store.close()
+
+if __name__ == '__main__':
+    unittest.main()
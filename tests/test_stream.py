@@ -0,0 +1,130 @@
+"""
+Check FeedStream picks out the same entries and feed details as
+parse_feed, and stops downloading when it's told to.
+"""
+import unittest
+
+from riverpy.parse import parse_feed
+from riverpy.stream import FeedStream, FeedTooLarge, release_when_read
+
+RSS = """<?xml version="1.0" encoding="utf-8"?>
+<rss version="2.0" xmlns:content="http://purl.org/rss/1.0/modules/content/"
+     xmlns:atom="http://www.w3.org/2005/Atom" xmlns:dc="http://purl.org/dc/elements/1.1/">
+<channel>
+  <title>Example</title>
+  <link>http://example.com/</link>
+  <description>An example feed</description>
+  <atom:link rel="hub" href="http://hub.example.com/"/>
+  <item>
+    <title>First &amp; foremost</title>
+    <link> http://example.com/1 </link>
+    <guid>urn:1</guid>
+    <description>Some &lt;b&gt;bold&lt;/b&gt; text</description>
+    <comments>http://example.com/1#comments</comments>
+    <pubDate>Tue, 01 Mar 2016 12:00:00 GMT</pubDate>
+  </item>
+  <item>
+    <title>No guid</title>
+    <link>http://example.com/2</link>
+    <content:encoded><![CDATA[<p>Only content</p>]]></content:encoded>
+    <dc:date>2016-03-02T08:30:00Z</dc:date>
+  </item>
+</channel>
+</rss>
+"""
+
+ATOM = """<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom">
+  <title>Atom example</title>
+  <subtitle>Subtitle</subtitle>
+  <link rel="self" href="http://example.com/atom"/>
+  <link href="http://example.com/"/>
+  <entry>
+    <title>Entry</title>
+    <id>tag:example.com,2016:1</id>
+    <link rel="edit" href="http://example.com/edit/1"/>
+    <link rel="alternate" href="http://example.com/a/1"/>
+    <summary>Summary</summary>
+    <updated>2016-03-01T10:00:00Z</updated>
+  </entry>
+</feed>
+"""
+
+class FakeRaw(object):
+    def __init__(self):
+        self._connection = self
+
+    def close(self):
+        self.closed = True
+
+class FakeResponse(object):
+    url = 'http://example.com/feed'
+
+    def __init__(self, body, chunk_size=50):
+        self.body = body
+        self.chunk_size = chunk_size
+        self.read = 0
+        self.raw = FakeRaw()
+        self.closed = False
+
+    def iter_content(self, chunk_size):
+        for start in xrange(0, len(self.body), self.chunk_size):
+            chunk = self.body[start:start + self.chunk_size]
+            self.read += len(chunk)
+            yield chunk
+
+    def close(self):
+        self.closed = True
+
+class FeedStreamTest(unittest.TestCase):
+    def assertSameAsParseFeed(self, body):
+        stream = FeedStream(FakeResponse(body), limit=len(body))
+        entries = list(stream)
+        (feed, expected) = parse_feed(body)
+        self.assertEqual(entries, expected)
+        self.assertEqual(stream.feed, feed)
+
+    def test_rss(self):
+        self.assertSameAsParseFeed(RSS)
+
+    def test_atom(self):
+        self.assertSameAsParseFeed(ATOM)
+
+    def test_dates(self):
+        entries = list(FeedStream(FakeResponse(RSS), limit=len(RSS)))
+        self.assertEqual([entry['timestamp'] for entry in entries], [1456833600, 1456907400])
+
+    def test_too_large(self):
+        stream = FeedStream(FakeResponse(RSS), limit=100)
+        self.assertRaises(FeedTooLarge, list, stream)
+
+    def test_stop_early(self):
+        response = FakeResponse(RSS * 20)
+        released = []
+        stream = FeedStream(response, limit=len(response.body))
+        release_when_read(stream, lambda: released.append(True))
+        for entry in stream:
+            break
+        stream.close()
+        self.assertLess(response.read, len(response.body))
+        self.assertTrue(response.closed)
+        self.assertTrue(response.raw.closed)
+        self.assertEqual(released, [True])
+
+    def test_read_to_end(self):
+        response = FakeResponse(RSS)
+        released = []
+        stream = FeedStream(response, limit=len(RSS))
+        release_when_read(stream, lambda: released.append(True))
+        self.assertEqual(released, [])
+        list(stream)
+        self.assertFalse(response.closed)
+        self.assertEqual(released, [True])
+
+    def test_release_right_away(self):
+        released = []
+        release_when_read(RSS, lambda: released.append(True))
+        self.assertEqual(released, [True])
+
+if __name__ == '__main__':
+    unittest.main()
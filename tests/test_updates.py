@@ -0,0 +1,86 @@
+"""
+Check updates reach the one writer responsible for each river, get
+merged, and are handed out again after a restart until they've been
+acknowledged.
+
+Runs against an in-memory SQLiteStore, which test_storage checks
+answers the stream commands the way redis does.
+"""
+import unittest
+
+from riverpy.codec import get_codec
+from riverpy.storage import SQLiteStore
+from riverpy.updates import UpdateStream, UpdateReader, river_writer_index, check_redis_version, WRITERS_KEY
+
+RIVERS = [{'name': 'news', 'title': 'News', 'feeds': ['http://example.com/feed']}]
+AVAILABLE = [{'name': 'news', 'title': 'News'}]
+
+def update_msg(*river_names):
+    return {'available_rivers': RIVERS, 'updated_rivers': list(river_names)}
+
+class UpdatesTest(unittest.TestCase):
+    def setUp(self):
+        self.store = SQLiteStore(':memory:')
+        self.stream = UpdateStream(self.store, get_codec('json'))
+        self.reader = UpdateReader(self.store)
+
+    def tearDown(self):
+        self.store.close()
+
+    def test_announce(self):
+        UpdateStream(self.store, get_codec('json'), writers=3).announce()
+        self.assertEqual(self.store.get(WRITERS_KEY), '3')
+
+    def test_messages_merged(self):
+        messages = self.reader.messages(0.01)
+        self.stream.publish(update_msg('b', 'a'))
+        self.stream.publish(update_msg('c', 'a'))
+        self.assertEqual(next(messages), {'available_rivers': AVAILABLE, 'updated_rivers': ['a', 'b', 'c']})
+
+    def test_split_between_writers(self):
+        names = ['river%d' % n for n in xrange(20)]
+        UpdateStream(self.store, get_codec('json'), writers=3).publish(update_msg(*names))
+        for writer_index in xrange(3):
+            message = next(UpdateReader(self.store, writer_index).messages(0.01))
+            expected = [name for name in names if river_writer_index(name, 3) == writer_index]
+            self.assertEqual(message['updated_rivers'], sorted(expected))
+
+    def test_request_manifest(self):
+        self.stream.request_manifest(RIVERS)
+        self.assertEqual(next(self.reader.messages(0.01)), {'available_rivers': AVAILABLE, 'updated_rivers': []})
+
+    def test_backlog_after_restart(self):
+        self.stream.publish(update_msg('a'))
+        next(self.reader.messages(0.01))
+        # Never asked for the next message, so never acknowledged.
+        restarted = UpdateReader(self.store)
+        self.assertEqual(next(restarted.messages(0.01))['updated_rivers'], ['a'])
+
+    def test_acknowledged(self):
+        messages = self.reader.messages(0.01)
+        self.stream.publish(update_msg('a'))
+        next(messages)
+        self.stream.publish(update_msg('b'))
+        next(messages)
+        self.assertEqual([msg['updated_rivers'] for (entry_id, msg) in UpdateReader(self.store).backlog()], [['b']])
+
+class ServerInfo(object):
+    def __init__(self, version):
+        self.version = version
+
+    def info(self, section=None):
+        return {'redis_version': self.version}
+
+class RedisVersionTest(unittest.TestCase):
+    def test_new_enough(self):
+        for version in ('5.0.0', '6.2.14', '10.0.1'):
+            check_redis_version(ServerInfo(version))
+
+    def test_too_old(self):
+        for version in ('2.8.24', '4.0.14'):
+            with self.assertRaises(SystemExit) as raised:
+                check_redis_version(ServerInfo(version))
+            self.assertIn(version, str(raised.exception))
+
+if __name__ == '__main__':
+    unittest.main()